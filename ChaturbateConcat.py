@@ -0,0 +1,264 @@
+"""Merge the per-segment downloads of ChaturbateScrape.py into one MKV per stream session.
+
+Scans Downloads/<user>/<session> folders, checks every segment with the same checks the RAM
+script uses, and pipes the segments in order into ffmpeg (-c copy, no re-encode), the same way
+the RAM script feeds its muxer. Sessions are handled in parallel by a process pool. What was
+merged is remembered in Downloads/concat_index.json, so running it again only does new or
+changed sessions. Sessions that are too small to be worth keeping are skipped as junk.
+
+Usage: python ChaturbateConcat.py [--user someone] [--jobs 4] [--delete-junk] [--delete-segments]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ts_checks as checks
+
+# === CONFIGURATION ===
+DOWNLOADS_DIR = "Downloads"
+INDEX_FILE = "concat_index.json"  # kept in DOWNLOADS_DIR
+JOBS = max((os.cpu_count() or 2) // 2, 1)  # sessions merged at the same time
+CHECK_MODE = "fast"  # "fast", "deep", "ffmpeg" (see CORRUPTION_CHECK_MODE in the RAM script) or "off"
+TEMP_SEGMENT_DIR = "F:/TempSegments"  # Temp path for the "deep" and "ffmpeg" checks, ideally a RAM disk
+JUNK_SEGMENTS = 15  # sessions with fewer segments than this are junk (~30 seconds)
+JUNK_MB = 5  # ...and so are sessions or RAM-script MKVs smaller than this
+ACTIVE_SECONDS = 120  # a session written to this recently is probably still recording and is left alone
+DROP_CORRUPT = 0  # 1 = leave segments that fail the check out of the MKV, 0 = keep them (they just look glitchy)
+
+SEGMENT_FILE = re.compile(r"^(\d+)\.ts$")
+
+def session_segments(folder):
+    """[(index, path, offset, length)] of a session in order; offset is None for one-file-per-segment."""
+    segments = []
+    for name in os.listdir(folder):
+        match = SEGMENT_FILE.match(name)
+        if match:
+            path = os.path.join(folder, name)
+            segments.append((int(match.group(1)), path, None, os.path.getsize(path)))
+    # Append mode sessions (OUTPUT_MODE = "append") are one .ts with a .idx next to it.
+    for index_path in glob.glob(os.path.join(glob.escape(folder), "*.idx")):
+        ts_path = index_path[:-4] + ".ts"
+        if not os.path.exists(ts_path):
+            continue
+        with open(index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3:
+                    index, offset, length = map(int, fields)
+                    segments.append((index, ts_path, offset, length))
+    segments.sort()
+    return segments
+
+def session_signature(folder, segments):
+    """Changes whenever segments are added to or rewritten in the session."""
+    paths = {path for _, path, _, _ in segments}
+    newest = max((os.path.getmtime(path) for path in paths), default=0)
+    return [len(segments), sum(length for _, _, _, length in segments), round(newest, 3)]
+
+def read_segment(path, offset, length):
+    with open(path, "rb") as f:
+        if offset is not None:
+            f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise OSError(f"{path}: expected {length} bytes, got {len(data)}")
+    return data
+
+def output_file(folder):
+    username = os.path.basename(os.path.dirname(folder))
+    return os.path.join(folder, f"{username} [{os.path.basename(folder)}].mkv")
+
+def merge_session(folder, check_mode=CHECK_MODE, drop_corrupt=DROP_CORRUPT, delete_segments=False):
+    """Check and merge one session; runs in a pool worker and returns its index entry."""
+    started = time.time()
+    username = os.path.basename(os.path.dirname(folder))
+    segments = session_segments(folder)
+    entry = {
+        "signature": session_signature(folder, segments),
+        "output": output_file(folder),
+        "segments": len(segments),
+        "missing": [],
+        "corrupt": [],
+        "unreadable": [],
+    }
+    indices = [index for index, _, _, _ in segments]
+    if indices:
+        present = set(indices)
+        entry["missing"] = [index for index in range(indices[0], indices[-1] + 1) if index not in present]
+
+    # stderr goes to a file: nobody reads a pipe while segments are written, and a full one would block ffmpeg.
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            ["ffmpeg", "-y", "-v", "error", "-f", "mpegts", "-i", "pipe:0", "-c", "copy", entry["output"]],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        write_error = None
+        try:
+            for index, path, offset, length in segments:
+                try:
+                    ts_bytes = read_segment(path, offset, length)
+                except OSError:
+                    # Deleted or cut short since the scan: merge the rest and note it in the index.
+                    entry["unreadable"].append(index)
+                    continue
+                clean = True
+                if check_mode != "off":
+                    clean = checks.check_segment(username, index, ts_bytes, check_mode, TEMP_SEGMENT_DIR)
+                    if not clean:
+                        entry["corrupt"].append(index)
+                if clean or not drop_corrupt:
+                    process.stdin.write(ts_bytes)
+        except OSError as e:
+            # ffmpeg quit early; its own message below says why.
+            write_error = e
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            process.wait()
+        stderr.seek(0)
+        errors = stderr.read().decode("utf-8", "replace").strip()
+    entry["status"] = "merged" if process.returncode == 0 and write_error is None else "failed"
+    if entry["status"] == "failed":
+        entry["error"] = errors.splitlines()[-1] if errors else str(write_error or f"ffmpeg exited with {process.returncode}")
+    entry["seconds"] = round(time.time() - started, 1)
+
+    if entry["status"] == "merged" and delete_segments:
+        remove_segments(folder, segments)
+    return entry
+
+def remove_segments(folder, segments):
+    for path in {path for _, path, _, _ in segments}:
+        os.remove(path)
+    for index_path in glob.glob(os.path.join(glob.escape(folder), "*.idx")):
+        os.remove(index_path)
+
+def find_sessions(downloads, user=None):
+    pattern = os.path.join(glob.escape(downloads), glob.escape(user) if user else "*", "*")
+    return sorted(folder for folder in glob.glob(pattern) if os.path.isdir(folder))
+
+def load_index(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_index(path, index):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1)
+    os.replace(temp_path, path)
+
+def small_mkvs(folder, merged_outputs=()):
+    """Finished MKVs of the RAM script below JUNK_MB, i.e. streams that only ever got a few broken segments.
+
+    MKVs this tool merged (merged_outputs) are never junk: with --delete-segments they are all that is left.
+    """
+    now = time.time()
+    return [path for path in glob.glob(os.path.join(glob.escape(folder), "*.mkv"))
+            if os.path.abspath(path) not in merged_outputs
+            and os.path.getsize(path) < JUNK_MB * 1024 * 1024 and now - os.path.getmtime(path) > ACTIVE_SECONDS]
+
+def plan(folders, index, delete_junk, force=False):
+    """Split sessions into ones to merge and ones to skip, dropping junk on the way."""
+    todo = []
+    skipped = {"merged": 0, "recording": 0, "junk": 0, "empty": 0}
+    now = time.time()
+    merged_outputs = {os.path.abspath(entry["output"]) for entry in index.values()
+                      if entry.get("status") == "merged" and entry.get("output")}
+    for folder in folders:
+        segments = session_segments(folder)
+        if not segments:
+            # No segments: a RAM-script session, or a .ts session whose segments were already deleted.
+            for path in small_mkvs(folder, merged_outputs):
+                skipped["junk"] += 1
+                print(f"[junk] {path}")
+                if delete_junk:
+                    os.remove(path)
+            skipped["empty"] += 1
+            continue
+        signature = session_signature(folder, segments)
+        entry = index.get(folder)
+        if entry and entry.get("signature") == signature and not force:
+            if entry["status"] == "junk":
+                skipped["junk"] += 1
+                continue
+            if entry["status"] == "merged" and os.path.exists(entry["output"]):
+                skipped["merged"] += 1
+                continue
+        if now - signature[2] < ACTIVE_SECONDS:
+            skipped["recording"] += 1
+            continue
+        if len(segments) < JUNK_SEGMENTS or signature[1] < JUNK_MB * 1024 * 1024:
+            skipped["junk"] += 1
+            index[folder] = {"signature": signature, "status": "junk", "segments": len(segments)}
+            print(f"[junk] {folder} ({len(segments)} segments, {signature[1] / 1024 / 1024:.1f} MB)")
+            if delete_junk:
+                remove_segments(folder, segments)
+            continue
+        todo.append(folder)
+    return todo, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--downloads", default=DOWNLOADS_DIR)
+    parser.add_argument("--user", help="only sessions of this username")
+    parser.add_argument("--jobs", type=int, default=JOBS)
+    parser.add_argument("--check", default=CHECK_MODE, choices=["fast", "deep", "ffmpeg", "off"])
+    parser.add_argument("--drop-corrupt", action="store_true", default=bool(DROP_CORRUPT), help="leave corrupt segments out of the MKV")
+    parser.add_argument("--delete-junk", action="store_true", help="delete junk sessions and tiny MKVs instead of only listing them")
+    parser.add_argument("--delete-segments", action="store_true", help="delete a session's .ts files once its MKV is written")
+    parser.add_argument("--force", action="store_true", help="merge again even if the index says a session is done")
+    args = parser.parse_args()
+    if not shutil.which("ffmpeg"):
+        sys.exit("ffmpeg not found on PATH")
+
+    index_path = os.path.join(args.downloads, INDEX_FILE)
+    # Loaded even with --force, which only ignores what it says is done: its merged MKVs are never junk.
+    index = load_index(index_path)
+    folders = find_sessions(args.downloads, args.user)
+    todo, skipped = plan(folders, index, args.delete_junk, args.force)
+    print(f"[*] {len(folders)} sessions: {len(todo)} to merge, {skipped['merged']} already merged, "
+          f"{skipped['recording']} still recording, {skipped['junk']} junk")
+    save_index(index_path, index)
+    if not todo:
+        return
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        futures = {pool.submit(merge_session, folder, args.check, args.drop_corrupt, args.delete_segments): folder for folder in todo}
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                entry = {"status": "failed", "error": str(e), "signature": None}
+            index[folder] = entry
+            # Saved after every session, so an interrupted run keeps what it finished.
+            save_index(index_path, index)
+            if entry["status"] != "merged":
+                failed += 1
+                print(f"[!] {folder}: {entry.get('error', 'ffmpeg failed')}")
+                continue
+            unreadable = f", {len(entry['unreadable'])} unreadable" if entry["unreadable"] else ""
+            print(f"[+] {os.path.basename(entry['output'])}: {entry['segments']} segments, "
+                  f"{len(entry['missing'])} missing, {len(entry['corrupt'])} corrupt{unreadable} ({entry['seconds']}s)")
+    if failed:
+        sys.exit(f"{failed} sessions failed")
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -1,209 +1,961 @@
-import tkinter as tk
-from tkinter import ttk, messagebox
-import threading
-import requests
-import re
-import json
-import time
-import os
-import pyperclip
-from datetime import datetime
-from urllib.parse import urljoin, urlparse
-
-# === CONFIGURATION ===
-CHECK_INTERVAL = 1
-RETRY_TIMEOUT = 30  # seconds
-MAX_RETRIES = 5
-HEADERS = {"User-Agent": "Mozilla/5.0"}
-
-class StreamDownloader(threading.Thread):
-    def __init__(self, url, gui):
-        super().__init__(daemon=True)
-        self.url = url
-        self.username = extract_username_from_url(url)
-        self.gui = gui
-        self.running = True
-        self.retries = 0
-        self.last_index = -1
-        self.current_index = -1
-        self.folder = None
-
-    def run(self):
-        while self.running and self.retries < MAX_RETRIES:
-            try:
-                self.gui.update_status(self.username, "Fetching")
-                m3u8_url = extract_hls_url(self.url)
-                latest_ts_url = get_latest_ts_url(m3u8_url)
-                print(f"[DEBUG] Latest TS URL: {latest_ts_url}")
-                base_url, index = parse_base_and_index(latest_ts_url)
-
-                if index <= self.last_index:
-                    self.folder = get_output_folder(self.username)
-                elif self.folder is None:
-                    self.folder = get_output_folder(self.username)
-
-                self.current_index = index
-                self.last_index = max(self.last_index, index)
-                self.download_loop(base_url, index)
-                break
-            except Exception as e:
-                print(f"[!] Error during stream fetch for {self.username}: {e}")
-                self.retries += 1
-                self.gui.update_status(self.username, f"Retrying ({self.retries})")
-                time.sleep(5)
-
-        if self.retries >= MAX_RETRIES:
-            self.gui.update_status(self.username, "Stream ended")
-
-    def download_loop(self, base_url, start_index):
-        self.gui.update_status(self.username, "Downloading")
-        start_time = time.time()
-        current_index = start_index
-        downloaded = set()
-
-        while self.running:
-            self.current_index = current_index
-            ts_url = f"{base_url}{current_index}.ts"
-            ts_path = os.path.join(self.folder, f"{current_index:06d}.ts")
-            try:
-                resp = requests.get(ts_url, headers=HEADERS, timeout=10, stream=True)
-                if resp.status_code == 200:
-                    with open(ts_path, "wb") as f:
-                        for chunk in resp.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                    downloaded.add(current_index)
-                    self.gui.update_segment(self.username, current_index)
-                    current_index += 1
-                    start_time = time.time()
-                else:
-                    time.sleep(CHECK_INTERVAL)
-            except:
-                time.sleep(CHECK_INTERVAL)
-
-            if time.time() - start_time > RETRY_TIMEOUT:
-                raise Exception("Retry timeout")
-
-def extract_hls_url(page_url):
-    res = requests.get(page_url, headers=HEADERS)
-    res.raise_for_status()
-    html = res.text
-    match = re.search(r'window\.initialRoomDossier\s*=\s*"({.+?})";', html)
-    if not match:
-        raise Exception("Could not find stream JSON")
-    json_str = bytes(match.group(1), "utf-8").decode("unicode_escape")
-    data = json.loads(json_str)
-    hls_url = data.get("hls_source")
-    if not hls_url:
-        raise Exception("No hls_source found in JSON")
-    return hls_url
-
-def get_latest_ts_url(m3u8_url):
-    print("[*] Fetching .m3u8 playlist...")
-    res = requests.get(m3u8_url, headers=HEADERS)
-    res.raise_for_status()
-    lines = res.text.strip().splitlines()
-
-    chunklists = [line for line in lines if line.startswith("chunklist_") and line.endswith(".m3u8")]
-    if chunklists:
-        selected_chunklist = chunklists[-1]
-        print(f"[+] Found sub-playlist: {selected_chunklist}")
-        chunklist_url = urljoin(m3u8_url.rsplit("/", 1)[0] + "/", selected_chunklist)
-
-        res = requests.get(chunklist_url, headers=HEADERS)
-        res.raise_for_status()
-        lines = res.text.strip().splitlines()
-        ts_files = [line for line in lines if line and not line.startswith("#")]
-        if not ts_files:
-            raise Exception("No .ts files found in sub-playlist")
-        return urljoin(chunklist_url.rsplit("/", 1)[0] + "/", ts_files[-1])
-    else:
-        ts_files = [line for line in lines if line and not line.startswith("#")]
-        if not ts_files:
-            raise Exception("No .ts files found in playlist")
-        return urljoin(m3u8_url.rsplit("/", 1)[0] + "/", ts_files[-1])
-
-def parse_base_and_index(ts_url):
-    match = re.search(r"(.+?_)(\d+)\.ts", ts_url)
-    if not match:
-        raise Exception("Could not parse .ts base and index")
-    return match.group(1), int(match.group(2))
-
-def extract_username_from_url(url):
-    parsed = urlparse(url)
-    parts = parsed.path.strip("/").split("/")
-    return parts[0] if parts else "unknown"
-
-def get_output_folder(username):
-    date_str = datetime.now().strftime("%Y-%m-%d %H-%M")
-    folder = os.path.join("Downloads", username, date_str)
-    os.makedirs(folder, exist_ok=True)
-    return folder
-
-class DownloaderGUI:
-    def __init__(self):
-        self.window = tk.Tk()
-        self.window.title("Stream Downloader")
-        self.downloaders = {}
-
-        frame = tk.Frame(self.window)
-        frame.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
-
-        self.tree = ttk.Treeview(frame, columns=("username", "status", "segment"), show="headings")
-        self.tree.heading("username", text="Username")
-        self.tree.heading("status", text="Status")
-        self.tree.heading("segment", text="Current Segment")
-        self.tree.column("username", width=150)
-        self.tree.column("status", width=120)
-        self.tree.column("segment", width=120)
-        self.tree.pack(fill=tk.BOTH, expand=True)
-
-        input_frame = tk.Frame(self.window)
-        input_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
-
-        self.entry = tk.Entry(input_frame)
-        self.entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
-        self.add_button = tk.Button(input_frame, text="Add Stream", command=self.add_stream)
-        self.add_button.pack(side=tk.LEFT, padx=5)
-
-        self.clear_button = tk.Button(self.window, text="Clear Finished Tasks", command=self.clear_finished)
-        self.clear_button.pack(pady=(0, 10))
-
-    def add_stream(self):
-        url = self.entry.get().strip()
-        if not url:
-            url = pyperclip.paste().strip()
-        if not url.startswith("http"):
-            messagebox.showerror("Invalid URL", "Please enter a valid stream URL.")
-            return
-
-        username = extract_username_from_url(url)
-        if username in self.downloaders:
-            messagebox.showinfo("Already Added", f"Stream for '{username}' is already being downloaded.")
-            return
-
-        self.tree.insert("", "end", iid=username, values=(username, "Initializing", "-"))
-        downloader = StreamDownloader(url, self)
-        self.downloaders[username] = downloader
-        downloader.start()
-
-    def update_status(self, username, status):
-        if username in self.tree.get_children():
-            self.tree.set(username, "status", status)
-
-    def update_segment(self, username, segment):
-        if username in self.tree.get_children():
-            self.tree.set(username, "segment", str(segment))
-
-    def clear_finished(self):
-        for item in self.tree.get_children():
-            status = self.tree.set(item, "status")
-            if status == "Stream ended":
-                self.tree.delete(item)
-                del self.downloaders[item]
-
-    def run(self):
-        self.window.mainloop()
-
-if __name__ == "__main__":
-    app = DownloaderGUI()
-    app.run()
+import tkinter as tk
+from tkinter import ttk, messagebox
+import threading
+import requests
+import re
+import json
+import time
+import os
+import pyperclip
+import queue
+import atexit
+import heapq
+from collections import deque, namedtuple
+from array import array
+from bisect import bisect_right
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse
+
+# === CONFIGURATION ===
+CHECK_INTERVAL = 1
+RETRY_TIMEOUT = 30  # seconds
+MAX_RETRIES = 5
+PREFETCH_WINDOW = 4  # Segment fetches a stream may have in flight at once while catching up to the live edge
+CATCH_UP = 1  # 1 = on every start/retry also grab the older segments the chunklist still lists, 0 = start at the live edge
+FETCH_MODE = "probe"  # "probe" = guess the next segment number, "playlist" = only fetch segments the chunklist has announced
+QUALITY = "max"  # "max" = highest bitrate variant, a height like 720 = the best one up to that height (the RAM version also has "auto" and a bandwidth cap)
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+POOL_MAXSIZE = 100  # Keep-alive connections kept open per CDN/edge host
+POOL_STATS_INTERVAL = 5  # seconds between HTTP pool stat refreshes in the GUI
+GUI_REFRESH_INTERVAL = 100  # milliseconds between GUI table refreshes; updates from streams are queued until then
+ENABLE_RATE_LIMIT = 1  # 1 = all rooms share the request budgets below, 0 = no limit
+RATE_LIMITS = {"page": 5, "playlist": 30, "segment": 60}  # requests per second across all rooms
+RATE_BACKOFF = 0.5  # a 429 multiplies that request kind's rate by this
+RATE_MIN_FRACTION = 0.1  # never throttle below this fraction of the configured rate
+RATE_RECOVERY_DELAY = 30  # seconds without a 429 before the rate starts recovering
+RATE_RECOVERY = 0.02  # fraction of the configured rate regained per second while recovering
+OUTPUT_MODE = "files"  # "files" = one 000123.ts per segment, "append" = one growing session .ts plus a .idx of segment offsets
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024  # bytes the disk writer gathers per session before each write in append mode
+WRITE_FLUSH_INTERVAL = 5  # seconds buffered segments may wait before they are written anyway
+WRITE_QUEUE_SIZE = 256  # segments waiting for the disk writer before downloads block on it
+PREALLOCATE_MB = 0  # append mode: reserve disk space for the session file in steps of this many MB (0 = off)
+FSYNC_POLICY = "never"  # "never", "write" = after every write, "close" = when a segment/session file is closed
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.throttled_at = 0
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rate < self.base_rate and now - self.throttled_at > RATE_RECOVERY_DELAY:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * RATE_RECOVERY * elapsed)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+class RateLimiter:
+    """Global token buckets per request kind ("page", "playlist", "segment") shared by all rooms.
+
+    Waiters are served lowest priority value first, so a segment that is about to drop out
+    of the live window gets the next token before one that was only just announced.
+    A 429 shrinks that kind's rate and honours Retry-After; the rate creeps back afterwards.
+    """
+
+    def __init__(self, limits):
+        self.buckets = {kind: TokenBucket(rate) for kind, rate in limits.items()}
+        self.waiters = {kind: [] for kind in limits}
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.throttled = 0
+
+    def _try_take(self, kind, ticket):
+        """Return 0 if ticket got a token, otherwise how long to wait before trying again."""
+        bucket = self.buckets[kind]
+        now = time.monotonic()
+        bucket.refill(now)
+        if now < bucket.blocked_until:
+            return bucket.blocked_until - now
+        if self.waiters[kind][0] != ticket:
+            return 0.05
+        if bucket.tokens < 1:
+            return (1 - bucket.tokens) / bucket.rate
+        bucket.tokens -= 1
+        heapq.heappop(self.waiters[kind])
+        self.cond.notify_all()
+        return 0
+
+    def _enqueue(self, kind, priority):
+        ticket = (float("inf") if priority is None else priority, next(self.counter))
+        heapq.heappush(self.waiters[kind], ticket)
+        return ticket
+
+    def _abandon(self, kind, ticket):
+        if ticket in self.waiters[kind]:
+            self.waiters[kind].remove(ticket)
+            heapq.heapify(self.waiters[kind])
+            self.cond.notify_all()
+
+    def acquire(self, kind, priority=0):
+        if not ENABLE_RATE_LIMIT or kind not in self.buckets:
+            return
+        with self.cond:
+            ticket = self._enqueue(kind, priority)
+            try:
+                while True:
+                    wait = self._try_take(kind, ticket)
+                    if not wait:
+                        return
+                    self.cond.wait(min(wait, 1))
+            except BaseException:
+                self._abandon(kind, ticket)
+                raise
+
+    def feedback(self, kind, status_code, retry_after=None):
+        if status_code != 429 or kind not in self.buckets:
+            return
+        with self.cond:
+            bucket = self.buckets[kind]
+            now = time.monotonic()
+            bucket.refill(now)
+            bucket.rate = max(bucket.base_rate * RATE_MIN_FRACTION, bucket.rate * RATE_BACKOFF)
+            bucket.tokens = min(bucket.tokens, 0)
+            bucket.throttled_at = now
+            bucket.blocked_until = max(bucket.blocked_until, now + parse_retry_after(retry_after, 1 / bucket.rate))
+            self.throttled += 1
+
+    def stats_text(self):
+        with self.cond:
+            rates = ", ".join(f"{kind} {bucket.rate:.1f}/{bucket.base_rate:g}" for kind, bucket in self.buckets.items())
+        return f"Rate limits (req/s): {rates} | 429s: {self.throttled}"
+
+def parse_retry_after(value, default):
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return default
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS)
+
+class SessionPool:
+    """One keep-alive requests.Session per host, shared by every downloader."""
+
+    def __init__(self, pool_maxsize=POOL_MAXSIZE):
+        self.pool_maxsize = pool_maxsize
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session_for(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(HEADERS)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+        return session
+
+    def get(self, url, kind="segment", priority=None, **kwargs):
+        """kind picks the rate limit budget; priority is how many segments are left before this one
+        leaves the live window (lower is fetched first), None for requests with no deadline."""
+        RATE_LIMITER.acquire(kind, priority)
+        resp = self.session_for(url).get(url, **kwargs)
+        RATE_LIMITER.feedback(kind, resp.status_code, resp.headers.get("Retry-After"))
+        return resp
+
+    def stats(self):
+        """Requests served, new connections opened (pool misses) and requests on a reused connection (pool hits)."""
+        total_requests = 0
+        new_connections = 0
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            pools = session.get_adapter("https://").poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    total_requests += pool.num_requests
+                    new_connections += pool.num_connections
+        return {
+            "hosts": len(sessions),
+            "requests": total_requests,
+            "new_connections": new_connections,
+            "reused": max(total_requests - new_connections, 0),
+        }
+
+    def stats_text(self):
+        stats = self.stats()
+        reuse = 100 * stats["reused"] / stats["requests"] if stats["requests"] else 0
+        return (f"HTTP pool: {stats['requests']} requests, {stats['new_connections']} new connections, "
+                f"{stats['reused']} reused ({reuse:.0f}%) across {stats['hosts']} hosts")
+
+HTTP_POOL = SessionPool()
+
+def read_index(index_path):
+    """Segment number -> (offset, length) from an append mode .idx file."""
+    entries = {}
+    with open(index_path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3:
+                index, offset, length = map(int, fields)
+                entries[index] = (offset, length)
+    return entries
+
+def read_indexed_segment(ts_path, entry):
+    """Read one segment back out of an append mode session file, entry being its (offset, length)."""
+    offset, length = entry
+    with open(ts_path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+class SegmentRuns:
+    """Set of segment indices stored as runs of consecutive numbers, e.g. 100-2400 and 2402-9000.
+
+    A recording that runs for days stays a handful of runs instead of a list of every index.
+    Adding the next index, len() and the number of missing ones are O(1), lookups a binary search.
+    """
+
+    __slots__ = ("starts", "ends", "count")
+
+    def __init__(self, indices=()):
+        self.starts = array("q")  # first index of each run, ascending
+        self.ends = array("q")  # last index of each run
+        self.count = 0
+        for index in indices:
+            self.add(index)
+
+    def add(self, index):
+        """False if index was in already."""
+        starts, ends = self.starts, self.ends
+        if not ends or index > ends[-1] + 1:
+            starts.append(index)
+            ends.append(index)
+        elif index == ends[-1] + 1:
+            ends[-1] = index
+        else:
+            # Out of order, e.g. a hole filled from the chunklist backlog.
+            i = bisect_right(starts, index) - 1
+            if i >= 0 and index <= ends[i]:
+                return False
+            joins_left = i >= 0 and ends[i] + 1 == index
+            joins_right = starts[i + 1] - 1 == index
+            if joins_left and joins_right:
+                ends[i] = ends[i + 1]
+                del starts[i + 1]
+                del ends[i + 1]
+            elif joins_left:
+                ends[i] = index
+            elif joins_right:
+                starts[i + 1] = index
+            else:
+                starts.insert(i + 1, index)
+                ends.insert(i + 1, index)
+        self.count += 1
+        return True
+
+    def copy(self):
+        runs = SegmentRuns()
+        runs.starts, runs.ends, runs.count = array("q", self.starts), array("q", self.ends), self.count
+        return runs
+
+    def __contains__(self, index):
+        i = bisect_right(self.starts, index) - 1
+        return i >= 0 and index <= self.ends[i]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
+
+    @property
+    def first(self):
+        return self.starts[0] if self.count else None
+
+    @property
+    def last(self):
+        return self.ends[-1] if self.count else None
+
+    @property
+    def missing(self):
+        """Indices between the first and the last one that are not in."""
+        return self.ends[-1] - self.starts[0] + 1 - self.count if self.count else 0
+
+    def gaps(self):
+        """(first, last) of every run of missing indices, in order."""
+        for i in range(1, len(self.starts)):
+            yield self.ends[i - 1] + 1, self.starts[i] - 1
+
+class SessionWriter:
+    """Where one stream session's segments end up on disk; only the DiskWriter thread touches the files.
+
+    In "files" mode every segment is its own 000123.ts written with a single write call.
+    In "append" mode segments are appended to "<folder>/<user> [<date>].ts" and gathered
+    into WRITE_BUFFER_SIZE writes; "<same name>.idx" gets one "index offset length" line per
+    segment once its bytes are written, so the index never points past the data on disk.
+    """
+
+    __slots__ = ("folder", "mode", "ts_path", "index_path", "file", "index_file", "offset", "written", "allocated",
+                 "buffer", "buffered", "buffered_entries", "buffered_since", "segments", "indices")
+
+    def __init__(self, folder, username, mode=None):
+        self.folder = folder
+        self.mode = mode or OUTPUT_MODE
+        name = f"{username} [{os.path.basename(folder)}]"
+        self.ts_path = os.path.join(folder, name + ".ts")
+        self.index_path = os.path.join(folder, name + ".idx")
+        self.file = None
+        self.index_file = None
+        self.offset = 0  # end of the data handed to the writer
+        self.written = 0  # end of the data actually on disk
+        self.allocated = 0
+        self.buffer = []
+        self.buffered = 0
+        self.buffered_entries = []
+        self.buffered_since = None
+        self.segments = 0
+        self.indices = SegmentRuns()  # handed to the writer so far, for live gap counts
+
+    def write(self, index, data):
+        self.indices.add(index)
+        DISK_WRITER.submit(self, index, data)
+
+    def close(self):
+        DISK_WRITER.submit(self, None, None)
+
+    def _open(self):
+        if os.path.exists(self.index_path):
+            # Same session picked up again: continue after the last indexed segment.
+            entries = read_index(self.index_path).values()
+            self.written = self.offset = max((offset + length for offset, length in entries), default=0)
+        self.file = open(self.ts_path, "r+b" if os.path.exists(self.ts_path) else "wb")
+        self.file.seek(self.written)
+        self.index_file = open(self.index_path, "a", encoding="utf-8")
+
+    def _append(self, index, data):
+        """Called by the writer thread; returns bytes written to disk right away."""
+        self.segments += 1
+        if self.mode != "append":
+            with open(os.path.join(self.folder, f"{index:06d}.ts"), "wb") as f:
+                f.write(data)
+                if FSYNC_POLICY in ("write", "close"):
+                    f.flush()
+                    os.fsync(f.fileno())
+            return len(data)
+        if self.file is None:
+            self._open()
+        self.buffer.append(data)
+        self.buffered_entries.append(f"{index} {self.offset} {len(data)}\n")
+        self.buffered += len(data)
+        self.offset += len(data)
+        if self.buffered_since is None:
+            self.buffered_since = time.monotonic()
+        if self.buffered >= WRITE_BUFFER_SIZE:
+            return self._flush()
+        return 0
+
+    def _preallocate(self, end):
+        if not PREALLOCATE_MB or end <= self.allocated:
+            return
+        step = PREALLOCATE_MB * 1024 * 1024
+        self.allocated = (end // step + 1) * step
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(self.file.fileno(), 0, self.allocated)
+            else:
+                # Windows: growing the file up front still saves NTFS from extending it on every write.
+                self.file.truncate(self.allocated)
+        except OSError as e:
+            print(f"[!] Could not preallocate {self.ts_path}: {e}")
+            self.allocated = float("inf")
+
+    def _flush(self):
+        if not self.buffered:
+            return 0
+        self._preallocate(self.written + self.buffered)
+        data = b"".join(self.buffer)
+        self.file.write(data)
+        self.file.flush()
+        if FSYNC_POLICY == "write":
+            os.fsync(self.file.fileno())
+        self.index_file.write("".join(self.buffered_entries))
+        self.index_file.flush()
+        self.written += len(data)
+        self.buffer = []
+        self.buffered_entries = []
+        self.buffered = 0
+        self.buffered_since = None
+        return len(data)
+
+    def _close(self):
+        written = 0
+        if self.file is not None:
+            written = self._flush()
+            # Drop any preallocated tail so the file ends with the last segment.
+            self.file.truncate(self.written)
+            if FSYNC_POLICY == "close":
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+        return written
+
+class DiskWriter(threading.Thread):
+    """One thread that does all segment disk writes, so downloads never wait on the disk.
+
+    Downloaders hand over whole segments; in append mode they are gathered per session
+    and written in WRITE_BUFFER_SIZE pieces, or after WRITE_FLUSH_INTERVAL at the latest.
+    The queue is bounded, so a disk that can't keep up slows the downloads instead of filling RAM.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True, name="disk-writer")
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.open_sessions = set()
+        self.dirty = set()
+        self.stats_lock = threading.Lock()
+        self.segments = 0
+        self.bytes = 0
+        self.writes = 0
+        self.started = False
+        self.start_lock = threading.Lock()
+
+    def submit(self, session, index, data):
+        if not self.started:
+            with self.start_lock:
+                if not self.started:
+                    self.start()
+                    self.started = True
+        self.queue.put((session, index, data))
+
+    def run(self):
+        while True:
+            try:
+                session, index, data = self.queue.get(timeout=WRITE_FLUSH_INTERVAL / 2)
+            except queue.Empty:
+                self._flush_due(0)
+                continue
+            if session is None:
+                for open_session in list(self.open_sessions):
+                    self._safely(open_session._close)
+                break
+            if data is None:
+                self._safely(session._close)
+                self.open_sessions.discard(session)
+                self.dirty.discard(session)
+            else:
+                with self.stats_lock:
+                    self.segments += 1
+                self._safely(session._append, index, data)
+                if session.file is not None:
+                    self.open_sessions.add(session)
+                if session.buffered:
+                    self.dirty.add(session)
+                else:
+                    self.dirty.discard(session)
+            self._flush_due(WRITE_FLUSH_INTERVAL)
+
+    def _flush_due(self, age):
+        now = time.monotonic()
+        for session in list(self.dirty):
+            if session.buffered_since is None or now - session.buffered_since >= age:
+                self._safely(session._flush)
+                self.dirty.discard(session)
+
+    def _safely(self, method, *args):
+        try:
+            written = method(*args)
+        except Exception as e:
+            print(f"[!] Disk write failed: {e}")
+            return
+        if written:
+            with self.stats_lock:
+                self.bytes += written
+                self.writes += 1
+
+    def close(self):
+        """Write out everything still buffered and close the session files."""
+        if self.started and self.is_alive():
+            self.queue.put((None, None, None))
+            self.join(timeout=30)
+
+    def stats_text(self):
+        with self.stats_lock:
+            per_write = self.bytes / self.writes / 1024 / 1024 if self.writes else 0
+            return (f"Disk writer: {self.segments} segments, {self.bytes / 1024 / 1024:.0f} MB in {self.writes} writes "
+                    f"({per_write:.1f} MB/write), {self.queue.qsize()} queued, {OUTPUT_MODE} mode")
+
+DISK_WRITER = DiskWriter()
+atexit.register(DISK_WRITER.close)
+
+class StreamDownloader(threading.Thread):
+    def __init__(self, url, gui):
+        super().__init__(daemon=True)
+        self.url = url
+        self.username = extract_username_from_url(url)
+        self.gui = gui
+        self.running = True
+        self.retries = 0
+        self.last_index = -1
+        self.current_index = -1
+        self.last_written = -1
+        self.recovered = 0
+        self.folder = None
+        self.session = None
+        self.requests = 0
+        self.segments_fetched = 0
+        self.stats_lock = threading.Lock()
+
+    def run(self):
+        while self.running and self.retries < MAX_RETRIES:
+            try:
+                self.gui.update_status(self.username, "Fetching")
+                m3u8_url = extract_hls_url(self.url)
+                if FETCH_MODE == "playlist":
+                    m3u8_url = get_chunklist_url(m3u8_url)
+                ts_urls = get_ts_urls(m3u8_url)
+                latest_ts_url = ts_urls[-1]
+                print(f"[DEBUG] Latest TS URL: {latest_ts_url}")
+                base_url, index = parse_base_and_index(latest_ts_url)
+
+                new_folder = index <= self.last_index or self.folder is None
+                if new_folder:
+                    self.folder = get_output_folder(self.username)
+                    if self.session is not None:
+                        self.session.close()
+                    self.session = SessionWriter(self.folder, self.username)
+                start_index = self.catch_up_start(index, segment_index(-1, ts_urls[0]), new_folder)
+
+                self.current_index = start_index
+                self.last_index = max(self.last_index, index)
+                if FETCH_MODE == "playlist":
+                    self.playlist_loop(m3u8_url, start_index, index)
+                else:
+                    self.download_loop(base_url, start_index, index)
+                break
+            except Exception as e:
+                print(f"[!] Error during stream fetch for {self.username}: {e}")
+                self.retries += 1
+                self.gui.update_status(self.username, f"Retrying ({self.retries})")
+                time.sleep(5)
+
+        if self.session is not None:
+            self.session.close()
+        if self.retries >= MAX_RETRIES:
+            self.gui.update_status(self.username, "Stream ended")
+
+    def note_written(self, index, live_index):
+        self.last_written = index
+        if index < live_index:
+            # Older than the live edge we (re)started at, so only the catch-up could have saved it.
+            self.recovered += 1
+
+    def catch_up_start(self, live_index, oldest_index, new_folder):
+        """Where to start downloading: the live edge, or with CATCH_UP as far back as the chunklist still goes."""
+        if not CATCH_UP or oldest_index < 0:
+            return live_index
+        if not new_folder and self.last_written >= 0:
+            # Same stream as before the error: fill the gap from where we left off.
+            return min(max(oldest_index, self.last_written + 1), live_index)
+        return oldest_index
+
+    def fetch_segment(self, ts_url, priority=None):
+        """Download one segment into memory; None if the CDN doesn't have it (yet).
+
+        Writing is left to the DiskWriter once the loop takes the segment in order.
+        """
+        with self.stats_lock:
+            self.requests += 1
+        resp = HTTP_POOL.get(ts_url, priority=priority, timeout=10, stream=True)
+        if resp.status_code != 200:
+            resp.close()
+            return None
+        return resp.content
+
+    def write_segment(self, index, data, live_index):
+        self.session.write(index, data)
+        self.note_written(index, live_index)
+        self.segments_fetched += 1
+        missing = self.session.indices.missing
+        self.gui.update_segment(self.username, f"{index} ({missing} missing)" if missing else index)
+
+    def download_loop(self, base_url, start_index, live_index):
+        self.gui.update_status(self.username, "Downloading")
+        start_time = time.time()
+        current_index = start_index
+        pool = ThreadPoolExecutor(max_workers=PREFETCH_WINDOW, thread_name_prefix=f"prefetch-{self.username}")
+        pending = {}
+        window = 1
+        missed = False
+
+        try:
+            while self.running:
+                self.current_index = current_index
+                # Keep `window` fetches in flight; the loop takes them in order and hands them to the disk writer.
+                for index in range(current_index, current_index + window):
+                    if index not in pending:
+                        pending[index] = pool.submit(self.fetch_segment, f"{base_url}{index}.ts")
+                self.gui.update_prefetch(self.username, len(pending))
+                try:
+                    data = pending.pop(current_index).result()
+                except Exception:
+                    data = None
+                if data is not None:
+                    self.write_segment(current_index, data, live_index)
+                    current_index += 1
+                    start_time = time.time()
+                    # Only widen the window while segments are there on the first try, i.e. while
+                    # we are behind the live edge. At the edge it stays a single probe.
+                    window = 1 if missed else min(window * 2, PREFETCH_WINDOW)
+                    missed = False
+                else:
+                    missed = True
+                    window = 1
+                    for index, future in list(pending.items()):
+                        if future.done() and (future.exception() or future.result() is None):
+                            del pending[index]
+                    time.sleep(CHECK_INTERVAL)
+
+                if time.time() - start_time > RETRY_TIMEOUT:
+                    self.print_request_stats()
+                    raise Exception("Retry timeout")
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.gui.update_prefetch(self.username, 0)
+
+    def playlist_loop(self, chunklist_url, start_index, live_index):
+        """Refresh the chunklist every target duration and fetch only segments it has announced."""
+        self.gui.update_status(self.username, "Downloading")
+        start_time = time.time()
+        pool = ThreadPoolExecutor(max_workers=PREFETCH_WINDOW, thread_name_prefix=f"prefetch-{self.username}")
+        pending = {}
+        seen = set()
+        first_refresh = True
+
+        try:
+            while self.running:
+                wait = CHECK_INTERVAL
+                try:
+                    with self.stats_lock:
+                        self.requests += 1
+                    res = HTTP_POOL.get(chunklist_url, kind="playlist", timeout=10)
+                    if res.status_code == 200:
+                        target_duration, entries = parse_media_playlist(chunklist_url, res.text)
+                        if first_refresh:
+                            # Start at start_index (the live edge, or where catch-up begins): mark anything older as done.
+                            seen.update(seq for seq, ts_url in entries if segment_index(seq, ts_url) < start_index)
+                            first_refresh = False
+                        fetched = False
+                        unseen = [(seq, ts_url) for seq, ts_url in entries if seq not in seen]
+                        for position, (seq, ts_url) in enumerate(unseen):
+                            if not self.running:
+                                break
+                            for ahead_seq, ahead_url in unseen[position:position + PREFETCH_WINDOW]:
+                                if ahead_seq not in pending:
+                                    # Segments near the start of the list are the next to drop out of the window.
+                                    pending[ahead_seq] = pool.submit(self.fetch_segment, ahead_url, ahead_seq - entries[0][0])
+                            self.gui.update_prefetch(self.username, len(pending))
+                            try:
+                                data = pending.pop(seq).result()
+                            except Exception:
+                                data = None
+                            if data is None:
+                                # Leave it unseen so the next refresh retries it while it is still listed.
+                                break
+                            index = segment_index(seq, ts_url)
+                            self.current_index = index
+                            self.write_segment(index, data, live_index)
+                            seen.add(seq)
+                            fetched = True
+                            start_time = time.time()
+                        # Forget sequence numbers that have dropped out of the window.
+                        listed = {seq for seq, ts_url in entries}
+                        seen.intersection_update(listed)
+                        for seq in [seq for seq in pending if seq not in listed]:
+                            pending.pop(seq).cancel()
+                        wait = target_duration if fetched else target_duration / 2
+                except:
+                    pass
+
+                if time.time() - start_time > RETRY_TIMEOUT:
+                    self.print_request_stats()
+                    raise Exception("Retry timeout")
+                time.sleep(wait)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.gui.update_prefetch(self.username, 0)
+
+    def print_request_stats(self):
+        if self.segments_fetched:
+            print(f"[*] {self.username}: {self.requests / self.segments_fetched:.2f} requests per segment "
+                  f"({self.requests} requests, {self.segments_fetched} segments, {FETCH_MODE} mode, "
+                  f"{self.recovered} recovered from the chunklist backlog)")
+
+def extract_hls_url(page_url):
+    res = HTTP_POOL.get(page_url, kind="page")
+    res.raise_for_status()
+    html = res.text
+    match = re.search(r'window\.initialRoomDossier\s*=\s*"({.+?})";', html)
+    if not match:
+        raise Exception("Could not find stream JSON")
+    json_str = bytes(match.group(1), "utf-8").decode("unicode_escape")
+    data = json.loads(json_str)
+    hls_url = data.get("hls_source")
+    if not hls_url:
+        raise Exception("No hls_source found in JSON")
+    return hls_url
+
+def get_ts_urls(m3u8_url):
+    """Every segment URL the (sub-)playlist currently lists, oldest first."""
+    print("[*] Fetching .m3u8 playlist...")
+    res = HTTP_POOL.get(m3u8_url, kind="playlist")
+    res.raise_for_status()
+    lines = res.text.strip().splitlines()
+
+    variants = parse_master_playlist(m3u8_url, res.text)
+    if variants:
+        variant = choose_variant(variants, QUALITY)
+        print(f"[+] Found sub-playlist: {variant.url} ({describe_variant(variant)} of {len(variants)} variants)")
+        chunklist_url = variant.url
+
+        res = HTTP_POOL.get(chunklist_url, kind="playlist")
+        res.raise_for_status()
+        lines = res.text.strip().splitlines()
+        ts_files = [line for line in lines if line and not line.startswith("#")]
+        if not ts_files:
+            raise Exception("No .ts files found in sub-playlist")
+        return [urljoin(chunklist_url.rsplit("/", 1)[0] + "/", ts_file) for ts_file in ts_files]
+    else:
+        ts_files = [line for line in lines if line and not line.startswith("#")]
+        if not ts_files:
+            raise Exception("No .ts files found in playlist")
+        return [urljoin(m3u8_url.rsplit("/", 1)[0] + "/", ts_file) for ts_file in ts_files]
+
+def get_chunklist_url(m3u8_url):
+    res = HTTP_POOL.get(m3u8_url, kind="playlist")
+    res.raise_for_status()
+    variants = parse_master_playlist(m3u8_url, res.text)
+    if not variants:
+        return m3u8_url
+    return choose_variant(variants, QUALITY).url
+
+Variant = namedtuple("Variant", "bandwidth height url")
+
+def parse_master_playlist(m3u8_url, text):
+    """[Variant] from the #EXT-X-STREAM-INF entries of a master playlist, lowest bitrate first."""
+    variants = []
+    info = None
+    for line in text.strip().splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            info = line
+        elif line and not line.startswith("#") and (info is not None or line.startswith("chunklist_")):
+            bandwidth = re.search(r"[:,]BANDWIDTH=(\d+)", info or "")
+            resolution = re.search(r"RESOLUTION=\d+x(\d+)", info or "")
+            variants.append(Variant(
+                int(bandwidth.group(1)) if bandwidth else 0,
+                int(resolution.group(1)) if resolution else 0,
+                urljoin(m3u8_url.rsplit("/", 1)[0] + "/", line),
+            ))
+            info = None
+    variants.sort(key=lambda variant: (variant.bandwidth, variant.height))
+    return variants
+
+def choose_variant(variants, quality):
+    """The highest variant for "max", else the best one no taller than the height `quality` (or the smallest)."""
+    height = str(quality).lower().rstrip("p")
+    if not height.isdigit():
+        return variants[-1]
+    fitting = [variant for variant in variants if variant.height and variant.height <= int(height)]
+    return fitting[-1] if fitting else variants[0]
+
+def describe_variant(variant):
+    height = f"{variant.height}p " if variant.height else ""
+    return f"{height}{variant.bandwidth / 1e6:.1f} Mbps"
+
+def parse_media_playlist(playlist_url, text):
+    """Return (target_duration, [(media_sequence, ts_url), ...]) for a media playlist."""
+    target_duration = CHECK_INTERVAL
+    media_sequence = 0
+    ts_files = []
+    for line in text.strip().splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-TARGETDURATION:"):
+            target_duration = float(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            media_sequence = int(line.split(":", 1)[1])
+        elif line and not line.startswith("#"):
+            ts_files.append(urljoin(playlist_url.rsplit("/", 1)[0] + "/", line))
+    return target_duration, [(media_sequence + i, ts_url) for i, ts_url in enumerate(ts_files)]
+
+def segment_index(media_sequence, ts_url):
+    """Segment number used for file names; falls back to the media sequence."""
+    try:
+        return parse_base_and_index(ts_url)[1]
+    except Exception:
+        return media_sequence
+
+def parse_base_and_index(ts_url):
+    match = re.search(r"(.+?_)(\d+)\.ts", ts_url)
+    if not match:
+        raise Exception("Could not parse .ts base and index")
+    return match.group(1), int(match.group(2))
+
+def extract_username_from_url(url):
+    parsed = urlparse(url)
+    parts = parsed.path.strip("/").split("/")
+    return parts[0] if parts else "unknown"
+
+def get_output_folder(username):
+    date_str = datetime.now().strftime("%Y-%m-%d %H-%M")
+    folder = os.path.join("Downloads", username, date_str)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+GUI_COLUMNS = ('username', 'status', 'segment', 'prefetch')
+
+class GUIEvents:
+    """Table updates from downloader threads, applied by the Tk thread in batches.
+
+    deque append/popleft are atomic, so streams never wait on a lock or on Tk, and Tk is
+    only ever touched from its own thread.
+    """
+
+    def __init__(self):
+        self.queue = deque()
+
+    def push(self, username, column, value):
+        self.queue.append((username, column, value))
+
+    def drain(self):
+        """Take everything queued so far, merged to the latest value per room and column."""
+        changes = {}
+        for _ in range(len(self.queue)):
+            username, column, value = self.queue.popleft()
+            changes.setdefault(username, {})[column] = value
+        return changes
+
+class DownloaderGUI:
+    def __init__(self):
+        self.window = tk.Tk()
+        self.window.title("Stream Downloader")
+        self.downloaders = {}
+
+        frame = tk.Frame(self.window)
+        frame.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+
+        self.events = GUIEvents()
+        self.rows = {}  # username (the tree iid) -> current row values
+        self.tree = ttk.Treeview(frame, columns=GUI_COLUMNS, show="headings")
+        self.tree.heading("username", text="Username")
+        self.tree.heading("status", text="Status")
+        self.tree.heading("segment", text="Current Segment")
+        self.tree.heading("prefetch", text="Prefetch")
+        self.tree.column("username", width=150)
+        self.tree.column("status", width=120)
+        self.tree.column("segment", width=120)
+        self.tree.column("prefetch", width=80)
+        self.tree.pack(fill=tk.BOTH, expand=True)
+
+        input_frame = tk.Frame(self.window)
+        input_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        self.entry = tk.Entry(input_frame)
+        self.entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.add_button = tk.Button(input_frame, text="Add Stream", command=self.add_stream)
+        self.add_button.pack(side=tk.LEFT, padx=5)
+
+        self.clear_button = tk.Button(self.window, text="Clear Finished Tasks", command=self.clear_finished)
+        self.clear_button.pack(pady=(0, 10))
+
+        self.pool_label = tk.Label(self.window, anchor="w")
+        self.pool_label.pack(fill=tk.X, padx=10, pady=(0, 5))
+        self.refresh_pool_stats()
+        self.drain_events()
+
+    def add_stream(self):
+        url = self.entry.get().strip()
+        if not url:
+            url = pyperclip.paste().strip()
+        if not url.startswith("http"):
+            messagebox.showerror("Invalid URL", "Please enter a valid stream URL.")
+            return
+
+        username = extract_username_from_url(url)
+        if username in self.downloaders:
+            messagebox.showinfo("Already Added", f"Stream for '{username}' is already being downloaded.")
+            return
+
+        self.add_row(username, (username, "Initializing", "-", "-"))
+        downloader = StreamDownloader(url, self)
+        self.downloaders[username] = downloader
+        downloader.start()
+
+    def add_row(self, username, values):
+        self.tree.insert("", "end", iid=username, values=values)
+        self.rows[username] = list(values)
+
+    def update_status(self, username, status):
+        self.events.push(username, "status", status)
+
+    def update_segment(self, username, segment):
+        self.events.push(username, "segment", str(segment))
+
+    def update_prefetch(self, username, in_flight):
+        self.events.push(username, "prefetch", f"{in_flight}/{PREFETCH_WINDOW}")
+
+    def drain_events(self):
+        self.apply_events()
+        self.window.after(GUI_REFRESH_INTERVAL, self.drain_events)
+
+    def apply_events(self):
+        """Apply queued updates with one Tk call per room that actually changed."""
+        for username, columns in self.events.drain().items():
+            row = self.rows.get(username)
+            if row is None:
+                continue
+            changed = False
+            for column, value in columns.items():
+                index = GUI_COLUMNS.index(column)
+                if row[index] != value:
+                    row[index] = value
+                    changed = True
+            if changed:
+                self.tree.item(username, values=row)
+
+    def refresh_pool_stats(self):
+        self.pool_label.config(text=f"{HTTP_POOL.stats_text()}\n{RATE_LIMITER.stats_text()}\n{DISK_WRITER.stats_text()}")
+        self.window.after(POOL_STATS_INTERVAL * 1000, self.refresh_pool_stats)
+
+    def clear_finished(self):
+        for item in self.tree.get_children():
+            status = self.tree.set(item, "status")
+            if status == "Stream ended":
+                self.tree.delete(item)
+                del self.rows[item]
+                del self.downloaders[item]
+
+    def run(self):
+        self.window.mainloop()
+
+if __name__ == "__main__":
+    app = DownloaderGUI()
+    app.run()
@@ -1,424 +1,3901 @@
-import tkinter as tk
-from tkinter import ttk, messagebox
-import threading
-import requests
-import re
-import json
-import time
-import os
-import pyperclip
-import subprocess
-from datetime import datetime
-from urllib.parse import urljoin, urlparse
-
-from io import BytesIO
-
-# === CONFIGURATION ===
-CHECK_INTERVAL = 1
-RETRY_TIMEOUT = 30  # seconds
-MAX_RETRIES = 5
-LIST_FILE = "list.txt"
-HEADERS = {"User-Agent": "Mozilla/5.0"}
-TEMP_SEGMENT_DIR = "F:/TempSegments"  # Editable temp path for segment checking
-ENABLE_CORRUPTION_CHECK = 1  # 1 = enable checking, 0 = disable (Uses drive to check for corrupt segments, ideally set up a RAM disk and set path to that above)
-
-# === ERROR PATTERNS ===
-ERROR_PATTERNS = [
-    r"non-existing PPS",
-    r"no frame!",
-    r"Invalid data found when processing input",
-    r"Decode error rate",
-    r"Could not open encoder",
-    r"Decoding error",
-    r"Task finished with error code",
-    r"Terminating thread with return code",
-    r"Cannot determine format of input",
-]
-
-IGNORED_PATTERNS = [
-    r"non monotonically increasing dts",
-    r"Nothing was written into output file",
-]
-
-def is_relevant_error(line):
-    return any(re.search(p, line) for p in ERROR_PATTERNS)
-
-def is_ignored_warning(line):
-    return any(re.search(p, line) for p in IGNORED_PATTERNS)
-
-class FFmpegWriter:
-    def __init__(self, output_dir, username):
-        self.output_dir = output_dir
-        self.username = username
-        self.start_time = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-        self.output_file = os.path.join(output_dir, f"{username} [{self.start_time}].mkv")
-        self.log_file = os.path.join(output_dir, f"{username} [{self.start_time}].txt")
-
-        self.process = subprocess.Popen(
-            [
-                "ffmpeg", "-y", "-f", "mpegts", "-i", "pipe:0",
-                "-c", "copy", self.output_file
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-
-        self.lock = threading.Lock()
-        self.segments = []
-        self.corrupt_segments = []
-
-    def write_segment(self, segment_index, ts_bytes):
-        if ENABLE_CORRUPTION_CHECK:
-            if not self.check_ts(segment_index, ts_bytes):
-                self.corrupt_segments.append(segment_index)
-
-        with self.lock:
-            try:
-                self.process.stdin.write(ts_bytes)
-                self.segments.append(segment_index)
-            except Exception as e:
-                print(f"[FFmpegWriter] Failed to write segment {segment_index}: {e}")
-
-    def check_ts(self, segment_index, ts_bytes):
-        try:
-            os.makedirs(TEMP_SEGMENT_DIR, exist_ok=True)
-            temp_path = os.path.join(TEMP_SEGMENT_DIR, f"temp_{segment_index:06d}.ts")
-            with open(temp_path, "wb") as temp_file:
-                temp_file.write(ts_bytes)
-            result = subprocess.run(
-                ["ffmpeg", "-v", "error", "-i", temp_path, "-f", "null", "-"],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            os.remove(temp_path)
-            errors = [
-                line for line in result.stderr.splitlines()
-                if is_relevant_error(line) and not is_ignored_warning(line)
-            ]
-            return not errors
-        except Exception:
-            return False
-
-    def close(self):
-        try:
-            self.process.stdin.close()
-            self.process.wait()
-        except:
-            pass
-        self._write_log()
-
-    def _write_log(self):
-        with open(self.log_file, "w", encoding="utf-8") as f:
-            if self.segments:
-                f.write(f"Start segment: {self.segments[0]:06d}.ts\n")
-                f.write(f"End segment:   {self.segments[-1]:06d}.ts\n")
-            f.write(f"Total segments used: {len(self.segments)}\n")
-
-            all_indices = set(range(self.segments[0], self.segments[-1] + 1))
-            missing = sorted(all_indices - set(self.segments))
-            if missing:
-                f.write("\nMissing segments:\n")
-                for m in missing:
-                    f.write(f"  {m:06d}.ts\n")
-            else:
-                f.write("\nNo segments missing.\n")
-
-            if ENABLE_CORRUPTION_CHECK:
-                if self.corrupt_segments:
-                    f.write("\nCorrupt segments:\n")
-                    for s in self.corrupt_segments:
-                        f.write(f"  {s:06d}.ts\n")
-                else:
-                    f.write("\nNo corrupt segments detected.\n")
-            else:
-                f.write("\nCorrupt segments checking disabled.\n")
-
-class StreamDownloader(threading.Thread):
-    def __init__(self, url, gui, infinite=False):
-        super().__init__(daemon=True)
-        self.url = url
-        self.username = extract_username_from_url(url)
-        self.gui = gui
-        self.running = False
-        self.retries = 0
-        self.last_index = -1
-        self.current_index = -1
-        self.folder = None
-        self.infinite = infinite
-
-    def run(self):
-        self.running = True
-        while self.running and (self.infinite or self.retries < MAX_RETRIES):
-            try:
-                self.gui.update_status(self.username, "Fetching")
-                m3u8_url = extract_hls_url(self.url)
-                latest_ts_url = get_latest_ts_url(m3u8_url)
-                print(f"[DEBUG] Latest TS URL: {latest_ts_url}")
-                base_url, index = parse_base_and_index(latest_ts_url)
-
-                if index <= self.last_index:
-                    self.folder = get_output_folder(self.username)
-                elif self.folder is None:
-                    self.folder = get_output_folder(self.username)
-
-                self.current_index = index
-                self.last_index = max(self.last_index, index)
-                self.download_loop(base_url, index)
-                break
-            except Exception as e:
-                print(f"[!] Error during stream fetch for {self.username}: {e}")
-                self.retries += 1
-                self.gui.update_status(self.username, f"Retrying ({self.retries})")
-                time.sleep(5)
-
-        if not self.running:
-            self.gui.update_status(self.username, "Stopped")
-        elif not self.infinite and self.retries >= MAX_RETRIES:
-            self.gui.update_status(self.username, "Stream ended")
-
-    def download_loop(self, base_url, start_index):
-        self.gui.update_status(self.username, "Downloading")
-        start_time = time.time()
-        current_index = start_index
-        writer = FFmpegWriter(self.folder, self.username)
-
-        try:
-            while self.running:
-                self.current_index = current_index
-                ts_url = f"{base_url}{current_index}.ts"
-                try:
-                    resp = requests.get(ts_url, headers=HEADERS, timeout=10)
-                    if resp.status_code == 200:
-                        ts_bytes = resp.content
-                        writer.write_segment(current_index, ts_bytes)
-                        self.gui.update_segment(self.username, current_index)
-                        current_index += 1
-                        start_time = time.time()
-                    else:
-                        time.sleep(CHECK_INTERVAL)
-                except:
-                    time.sleep(CHECK_INTERVAL)
-
-                if time.time() - start_time > RETRY_TIMEOUT:
-                    raise Exception("Retry timeout")
-        finally:
-            writer.close()
-
-    def stop(self):
-        self.running = False
-
-    def restart(self):
-        self.stop()
-        new_thread = StreamDownloader(self.url, self.gui, self.infinite)
-        self.gui.replace_downloader(self.username, new_thread)
-        new_thread.start()
-
-    def toggle_infinite(self):
-        self.infinite = not self.infinite
-        self.gui.update_infinite(self.username, self.infinite)
-
-def extract_hls_url(page_url):
-    res = requests.get(page_url, headers=HEADERS)
-    res.raise_for_status()
-    html = res.text
-    match = re.search(r'window\.initialRoomDossier\s*=\s*"({.+?})";', html)
-    if not match:
-        raise Exception("Could not find stream JSON")
-    json_str = bytes(match.group(1), "utf-8").decode("unicode_escape")
-    data = json.loads(json_str)
-    hls_url = data.get("hls_source")
-    if not hls_url:
-        raise Exception("No hls_source found in JSON")
-    return hls_url
-
-def get_latest_ts_url(m3u8_url):
-    res = requests.get(m3u8_url, headers=HEADERS)
-    res.raise_for_status()
-    lines = res.text.strip().splitlines()
-    chunklists = [line for line in lines if line.startswith("chunklist_") and line.endswith(".m3u8")]
-    if chunklists:
-        chunklist_url = urljoin(m3u8_url.rsplit("/", 1)[0] + "/", chunklists[-1])
-        res = requests.get(chunklist_url, headers=HEADERS)
-        res.raise_for_status()
-        lines = res.text.strip().splitlines()
-        ts_files = [line for line in lines if line and not line.startswith("#")]
-        if not ts_files:
-            raise Exception("No .ts files found in sub-playlist")
-        return urljoin(chunklist_url.rsplit("/", 1)[0] + "/", ts_files[-1])
-    else:
-        ts_files = [line for line in lines if line and not line.startswith("#")]
-        if not ts_files:
-            raise Exception("No .ts files found in playlist")
-        return urljoin(m3u8_url.rsplit("/", 1)[0] + "/", ts_files[-1])
-
-def parse_base_and_index(ts_url):
-    match = re.search(r"(.+?_)(\d+)\.ts", ts_url)
-    if not match:
-        raise Exception("Could not parse .ts base and index")
-    return match.group(1), int(match.group(2))
-
-def extract_username_from_url(url):
-    parsed = urlparse(url)
-    parts = parsed.path.strip("/").split("/")
-    return parts[0] if parts else "unknown"
-
-def get_output_folder(username):
-    date_str = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-    folder = os.path.join("Downloads", username, date_str)
-    os.makedirs(folder, exist_ok=True)
-    return folder
-
-def save_list(downloaders):
-    with open(LIST_FILE, "w") as f:
-        for username, downloader in downloaders.items():
-            f.write(f"{downloader.url}|{int(downloader.infinite)}\n")
-
-def load_list():
-    if not os.path.exists(LIST_FILE):
-        return []
-    with open(LIST_FILE, "r") as f:
-        return [line.strip().split("|") for line in f if line.strip()]
-
-class DownloaderGUI:
-    def __init__(self):
-        self.window = tk.Tk()
-        self.window.title("Stream Downloader")
-        self.downloaders = {}
-
-        frame = tk.Frame(self.window)
-        frame.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
-
-        tree_frame = tk.Frame(frame)
-        tree_frame.pack(fill=tk.BOTH, expand=True)
-
-        self.tree = ttk.Treeview(tree_frame, columns=("username", "status", "segment", "infinite"), show="headings")
-        self.tree.heading("username", text="Username")
-        self.tree.heading("status", text="Status")
-        self.tree.heading("segment", text="Current Segment")
-        self.tree.heading("infinite", text="Infinite")
-        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.tree.configure(yscrollcommand=scrollbar.set)
-
-        self.tree.bind("<Button-3>", self.show_context_menu)
-
-        input_frame = tk.Frame(self.window)
-        input_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
-
-        self.entry = tk.Entry(input_frame)
-        self.entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
-        self.add_button = tk.Button(input_frame, text="Add Stream", command=self.add_stream)
-        self.add_button.pack(side=tk.LEFT, padx=5)
-
-        self.clear_button = tk.Button(self.window, text="Clear Finished Tasks", command=self.clear_finished)
-        self.clear_button.pack()
-
-        control_frame = tk.Frame(self.window)
-        control_frame.pack(pady=(5, 10))
-        tk.Button(control_frame, text="Start All", command=self.start_all).pack(side=tk.LEFT, padx=5)
-        tk.Button(control_frame, text="Stop All", command=self.stop_all).pack(side=tk.LEFT, padx=5)
-
-        self.context_menu = tk.Menu(self.window, tearoff=0)
-        self.context_menu.add_command(label="Stop Task", command=self.stop_task)
-        self.context_menu.add_command(label="Restart Task", command=self.restart_task)
-        self.context_menu.add_command(label="Toggle Infinite", command=self.toggle_infinite)
-
-        self.load_previous_tasks()
-
-    def load_previous_tasks(self):
-        for url, infinite in load_list():
-            username = extract_username_from_url(url)
-            self.tree.insert("", "end", iid=username, values=(username, "Stopped", "-", "On" if infinite == "1" else "Off"))
-            self.downloaders[username] = StreamDownloader(url, self, infinite == "1")
-
-    def replace_downloader(self, username, new_downloader):
-        self.downloaders[username] = new_downloader
-        save_list(self.downloaders)
-
-    def add_stream(self):
-        url = self.entry.get().strip()
-        if not url:
-            url = pyperclip.paste().strip()
-        if not url.startswith("http"):
-            messagebox.showerror("Invalid URL", "Please enter a valid stream URL.")
-            return
-
-        username = extract_username_from_url(url)
-        if username in self.downloaders:
-            messagebox.showinfo("Already Added", f"Stream for '{username}' is already in the list.")
-            return
-
-        self.tree.insert("", "end", iid=username, values=(username, "Initializing", "-", "Off"))
-        downloader = StreamDownloader(url, self)
-        self.downloaders[username] = downloader
-        save_list(self.downloaders)
-        downloader.start()
-
-    def update_status(self, username, status):
-        if username in self.tree.get_children():
-            self.tree.set(username, "status", status)
-
-    def update_segment(self, username, segment):
-        if username in self.tree.get_children():
-            self.tree.set(username, "segment", str(segment))
-
-    def update_infinite(self, username, state):
-        if username in self.tree.get_children():
-            self.tree.set(username, "infinite", "On" if state else "Off")
-            save_list(self.downloaders)
-
-    def clear_finished(self):
-        for item in self.tree.get_children():
-            status = self.tree.set(item, "status")
-            if status == "Stream ended" or status == "Stopped":
-                self.tree.delete(item)
-                if item in self.downloaders:
-                    del self.downloaders[item]
-        save_list(self.downloaders)
-
-    def start_all(self):
-        for username in list(self.downloaders):
-            downloader = self.downloaders[username]
-            if not downloader.running:
-                new_thread = StreamDownloader(downloader.url, self, downloader.infinite)
-                self.replace_downloader(username, new_thread)
-                new_thread.start()
-
-    def stop_all(self):
-        for downloader in self.downloaders.values():
-            downloader.stop()
-
-    def show_context_menu(self, event):
-        item = self.tree.identify_row(event.y)
-        if item:
-            self.tree.selection_set(item)
-            self.context_menu.post(event.x_root, event.y_root)
-
-    def stop_task(self):
-        selected = self.tree.selection()
-        for item in selected:
-            if item in self.downloaders:
-                self.downloaders[item].stop()
-
-    def restart_task(self):
-        selected = self.tree.selection()
-        for item in selected:
-            if item in self.downloaders:
-                self.downloaders[item].restart()
-
-    def toggle_infinite(self):
-        selected = self.tree.selection()
-        for item in selected:
-            if item in self.downloaders:
-                self.downloaders[item].toggle_infinite()
-
-    def run(self):
-        self.window.mainloop()
-
-if __name__ == "__main__":
-    app = DownloaderGUI()
-    app.run()
\ No newline at end of file
+import threading
+import requests
+import re
+import json
+import time
+import os
+import sys
+import glob
+import shutil
+import zlib
+import argparse
+import socket
+import subprocess
+import asyncio
+import contextlib
+import heapq
+from collections import deque, namedtuple
+from array import array
+from bisect import bisect_right
+import itertools
+import multiprocessing
+import atexit
+from multiprocessing import shared_memory
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse
+
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ts_checks import check_segment, check_shared_segment, looks_like_ts, starts_with_keyframe, timed_check
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Only the GUI needs these; --headless runs without them (e.g. on a box without a display).
+try:
+    import tkinter as tk
+    from tkinter import ttk, messagebox
+except ImportError:
+    tk = None
+
+try:
+    import pyperclip
+except ImportError:
+    pyperclip = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# === CONFIGURATION ===
+CHECK_INTERVAL = 1
+RETRY_TIMEOUT = 30  # seconds
+MAX_RETRIES = 5
+ROOM_STORE_FILE = "rooms.jsonl"  # The room list with each room's settings and when it was last live, one JSON line per change
+ROOM_STORE_FLUSH = 2  # seconds changes to the room list are gathered before they are appended in one write
+ROOM_STORE_COMPACT = 4  # rewrite the room list file once it has this many lines per room
+LIST_FILE = "list.txt"  # Room list of older versions, imported into ROOM_STORE_FILE if that doesn't exist yet
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+POOL_MAXSIZE = 100  # Keep-alive connections kept open per CDN/edge host
+POOL_STATS_INTERVAL = 5  # seconds between HTTP pool stat refreshes in the GUI
+GUI_REFRESH_INTERVAL = 100  # milliseconds between GUI table refreshes; updates are queued until then
+DAEMON_POLL_INTERVAL = 1  # seconds between room list fetches from the daemon; only changed columns are queued
+API_HOST = "127.0.0.1"  # Local control API of the daemon; the GUI is a client of it
+API_PORT = 8765  # or --port; give each copy of the script its own, e.g. when running two (one over VPN)
+METRICS_FILE = "metrics.jsonl"  # Periodic JSON lines with per-room and total metrics, "" = off (/metrics on the API is always there)
+METRICS_INTERVAL = 10  # seconds between lines in METRICS_FILE
+PROXY = ""  # e.g. "http://127.0.0.1:8080" (socks5:// needs: pip install requests[socks]); every request goes through it
+SOURCE_ADDRESS = ""  # local IP to send requests from, e.g. a second NIC or a VPN adapter's address
+SHARD_COUNT = 1  # >1 = split the rooms across this many worker processes (or use --shards N)
+SHARDS = []  # per shard settings, e.g. [{"proxy": "socks5://127.0.0.1:1080"}, {"source_address": "10.8.0.2"}]; shards without an entry connect directly
+SHARD_BASE_PORT = 0  # shard N's control API listens on this port + N (on 127.0.0.1), 0 = the API port + 1
+SHARD_BALANCE_INTERVAL = 30  # seconds between checks whether a shard is overloaded
+SHARD_429_LIMIT = 5  # 429s within one interval that make a shard hand a room to another shard
+SHARD_CPU_LIMIT = 0.9  # ...as does using more than this fraction of its share of the CPU cores (needs psutil)
+ENABLE_RATE_LIMIT = 1  # 1 = all rooms share the request budgets below, 0 = no limit
+RATE_LIMITS = {"page": 5, "playlist": 30, "segment": 60}  # requests per second across all rooms
+RATE_BACKOFF = 0.5  # a 429 multiplies that request kind's rate by this
+RATE_MIN_FRACTION = 0.1  # never throttle below this fraction of the configured rate
+RATE_RECOVERY_DELAY = 30  # seconds without a 429 before the rate starts recovering
+RATE_RECOVERY = 0.02  # fraction of the configured rate regained per second while recovering
+TEMP_SEGMENT_DIR = "F:/TempSegments"  # Editable temp path for segment checking
+ENABLE_CORRUPTION_CHECK = 1  # 1 = enable checking, 0 = disable
+CHECK_WORKERS = os.cpu_count() or 2  # Processes that check segments, off the download threads
+CHECK_QUEUE_SIZE = CHECK_WORKERS * 4  # Segments allowed to wait for a check; past this they are written unchecked
+CHECK_SAMPLE_EVERY = 4  # Once the check queue is half full, only every Nth segment of a stream is checked
+CHECK_PRIORITY_RESERVE = 0.25  # Share of the check queue kept for the highest priority rooms; lower priority ones go unchecked sooner
+CORRUPTION_CHECK_MODE = "fast"  # "fast" = in-memory MPEG-TS checks, "deep" = fast checks then a full ffmpeg decode of segments that pass, "ffmpeg" = ffmpeg decode only (deep/ffmpeg use the temp path above, ideally a RAM disk)
+FETCH_MODE = "probe"  # "probe" = guess the next segment number, "playlist" = only fetch segments the chunklist has announced
+QUALITY = "max"  # Default per room: "max" = highest bitrate variant, a height like 720 = the best one up to that height, "auto" = max unless the bandwidth cap needs it lower
+BANDWIDTH_CAP_MBPS = 0  # Total download rate to stay under across all rooms (or --bandwidth-cap), 0 = no cap; only "auto" rooms are moved down a variant for it
+BANDWIDTH_CHECK_INTERVAL = 10  # seconds between bandwidth measurements, at most one room changes variant per check
+BANDWIDTH_HEADROOM = 0.85  # A lowered room only moves back up if the total then stays under this fraction of the cap
+MAX_ACTIVE_DOWNLOADS = 0  # Rooms allowed to download at once (or --max-active), 0 = no limit; the rest wait as "Queued", highest priority first
+PREEMPT = 1  # 1 = a queued room pauses a downloading room of lower priority to take its place; the paused one catches up from the chunklist when it gets back in
+SCHEDULER_CPU_LIMIT = 0  # Fraction of all cores (this process plus its ffmpeg and checkers) over which lower priority rooms are paused, 0 = no CPU limit
+SCHEDULER_HEADROOM = 0.85  # Queued rooms are only let in while CPU and bandwidth stay under this fraction of SCHEDULER_CPU_LIMIT and BANDWIDTH_CAP_MBPS
+SCHEDULER_CHECK_INTERVAL = 5  # seconds between CPU readings
+SCHEDULER_OVERLOAD_CHECKS = 3  # readings in a row over a limit before a lower priority room is paused for it
+ENGINE = "thread"  # "thread" = one thread per stream, "asyncio" = all streams on one event loop (needs: pip install aiohttp)
+ASYNC_MAX_CONNECTIONS = 200  # Size of the shared connection pool used by the asyncio engine
+ZERO_COPY = 1  # 1 = read segments into reusable shared buffers that the writer and checker use in place, 0 = one bytes copy per step
+SEGMENT_BUFFER_SIZE = 4 * 1024 * 1024  # Bytes per pooled segment buffer; bigger segments get a one-off buffer
+SEGMENT_BUFFERS = 64  # Pooled buffers kept around for reuse
+READ_CHUNK = 256 * 1024  # Bytes read from the socket per call
+PREFETCH_WINDOW = 4  # Segment fetches a stream may have in flight at once while catching up to the live edge
+CATCH_UP = 1  # 1 = on every start/retry also grab the older segments the chunklist still lists, 0 = start at the live edge
+HLS_CACHE_TTL = 60  # seconds a room's hls_source and chunklist URL are reused across retries (dropped early on 403/404)
+PAGE_CHUNK = 16 * 1024  # Room pages are read in pieces of this size, and only until hls_source shows up
+PROBE_OFFLINE_ROOMS = 1  # 1 = offline Infinite rooms are watched by a cheap batched prober instead of re-pulling the room page every 5s
+PROBE_BATCH = 20  # Rooms probed at the same time
+PROBE_MIN_INTERVAL = 10  # seconds between probes of a room that just went offline
+PROBE_BACKOFF = 1.5  # every offline probe stretches the interval by this factor...
+PROBE_MAX_INTERVAL = 300  # ...up to this many seconds
+PROBE_HOT_INTERVAL = 10  # seconds between probes during the hours a room usually goes live
+PROBE_HOT_STARTS = 2  # starts seen in this or the next hour of the day before that hour counts as usual
+PROBE_HISTORY_FILE = "probe_history.json"  # When each room went live before, for the above
+ROTATE_SIZE_MB = 0  # Start a new .mkv part once the current one reaches this size (e.g. 4096), 0 = no size limit
+ROTATE_MINUTES = 0  # Start a new .mkv part after this many minutes, 0 = no time limit
+ROTATE_PRESPAWN = 0.9  # Fraction of the limit at which the next part's ffmpeg is started, so the switch doesn't wait on it
+ROTATE_KEYFRAME_WAIT = 10  # Segments to wait past the limit for one that starts on a keyframe before cutting anyway
+JOURNAL = 1  # 1 = log every segment to a .journal next to the recording as it lands, so a crash or restart can pick the session back up
+RESUME_WINDOW = 900  # seconds; an unfinished session whose journal is older than this is closed off instead of resumed
+MUXER_MIN_SEGMENTS = 3  # Segments that look like video to hold in memory before starting ffmpeg; a session that never gets this many leaves no .mkv behind, 0 = start on the first segment
+MUXER_HOLD_LIMIT = 10  # Most segments held while waiting for those; past this the oldest is let go, so a room serving junk can't fill up the memory
+MUXER_POOL_SIZE = 2  # Idle ffmpeg muxers kept started and waiting, so a new session or part doesn't wait on one to start, 0 = start them on demand
+MUXER_STAGING_DIR = os.path.join("Downloads", ".muxers")  # Where waiting muxers write until a session takes one; keep it on the same drive as Downloads
+
+# === METRICS ===
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+METRIC_TYPES = {
+    "playlist_fetch_seconds": ("histogram", "Chunklist refresh, request to parsed response"),
+    "segment_download_seconds": ("histogram", "Segment request to last byte, rate limiter wait included"),
+    "segment_bytes_total": ("counter", "Segment bytes downloaded"),
+    "segments_total": ("counter", "Segments handed to the writer"),
+    "requests_total": ("counter", "HTTP requests made by the download loops"),
+    "http_errors_total": ("counter", "Non-200 responses by request kind and status code"),
+    "retries_total": ("counter", "Stream re-pulls after an error"),
+    "check_seconds": ("histogram", "Corruption check duration inside the check worker"),
+    "stdin_write_seconds": ("histogram", "Time to hand one segment to ffmpeg's stdin"),
+    "pending_segments": ("gauge", "Prefetched or in-flight segments waiting for their turn"),
+    "check_queue_depth": ("gauge", "Segments waiting for a corruption check"),
+    "live_lag_segments": ("gauge", "Segments behind the newest one the CDN is known to have"),
+    "variant_bandwidth_bps": ("gauge", "BANDWIDTH the master playlist declares for the variant being downloaded"),
+    "muxer_spawn_seconds": ("histogram", "Time to start one ffmpeg muxer process"),
+    "muxers_total": ("counter", "Muxers handed to sessions and parts, by source (warm from the pool or cold)"),
+    "junk_sessions_total": ("counter", "Sessions dropped before ffmpeg started because too few segments looked like video"),
+    "preemptions_total": ("counter", "Times a room was paused for a more important one"),
+}
+
+class Metrics:
+    """Counters, gauges and latency histograms per room, for /metrics and the JSON lines log."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> number, or for histograms [count per bucket..., +Inf count, sum]
+        self.values = {}
+        self.last_bytes = {}
+        self.last_time = time.time()
+        self.removed = set()  # rooms whose series were dropped, see forget()
+
+    @staticmethod
+    def _key(name, room, labels):
+        items = tuple(sorted(labels.items()))
+        if room is not None:
+            items = (("room", room),) + items
+        return name, items
+
+    def inc(self, name, room, amount=1, **labels):
+        key = self._key(name, room, labels)
+        with self.lock:
+            if room not in self.removed:
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, room, value, **labels):
+        key = self._key(name, room, labels)
+        with self.lock:
+            if room not in self.removed:
+                self.values[key] = value
+
+    def observe(self, name, room, seconds, **labels):
+        key = self._key(name, room, labels)
+        with self.lock:
+            if room in self.removed:
+                return
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(METRIC_BUCKETS) + 2)
+            for position, bound in enumerate(METRIC_BUCKETS):
+                if seconds <= bound:
+                    histogram[position] += 1
+                    break
+            else:
+                histogram[len(METRIC_BUCKETS)] += 1
+            histogram[-1] += seconds
+
+    def forget(self, room):
+        """Drop every series of a removed room, and ignore what its downloader reports while it winds down."""
+        with self.lock:
+            self.removed.add(room)
+            self.values = {key: value for key, value in self.values.items() if key[1][:1] != (("room", room),)}
+            self.last_bytes.pop(room, None)
+
+    def remember(self, room):
+        """Record a room again once it is added back."""
+        with self.lock:
+            self.removed.discard(room)
+
+    def render(self):
+        """Prometheus text exposition format."""
+        with self.lock:
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+        lines = []
+        for name, (kind, help_text) in METRIC_TYPES.items():
+            series = [(labels, value) for (metric, labels), value in values.items() if metric == name]
+            if not series:
+                continue
+            lines.append(f"# HELP chaturbate_{name} {help_text}")
+            lines.append(f"# TYPE chaturbate_{name} {kind}")
+            for labels, value in sorted(series):
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                if kind != "histogram":
+                    lines.append(f"chaturbate_{name}{{{label_text}}} {value}")
+                    continue
+                prefix = label_text + "," if label_text else ""
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS + ("+Inf",), value):
+                    cumulative += count
+                    lines.append(f'chaturbate_{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f"chaturbate_{name}_sum{{{label_text}}} {value[-1]:.6f}")
+                lines.append(f"chaturbate_{name}_count{{{label_text}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def total(self, name, **labels):
+        """Sum of a counter over every room and every series matching `labels`."""
+        wanted = set(labels.items())
+        with self.lock:
+            return sum(value for (metric, items), value in self.values.items()
+                       if metric == name and wanted <= set(items))
+
+    def snapshot(self, advance=True):
+        """Per-room and total summary: counters summed over their labels, histograms as count/avg.
+
+        bytes_per_sec covers the time since the last snapshot that advanced; peeks (advance=False)
+        don't reset that window.
+        """
+        with self.lock:
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-9)
+        rooms = {}
+        total = {}
+        for (name, labels), value in values.items():
+            labels = dict(labels)
+            room = labels.pop("room", None)
+            targets = [total] if room is None else [rooms.setdefault(room, {}), total]
+            kind = METRIC_TYPES[name][0]
+            for target in targets:
+                if kind == "histogram":
+                    entry = target.setdefault(name, {"count": 0, "sum": 0.0})
+                    entry["count"] += sum(value[:-1])
+                    entry["sum"] += value[-1]
+                elif name == "http_errors_total":
+                    by_code = target.setdefault(name, {})
+                    by_code[labels["code"]] = by_code.get(labels["code"], 0) + value
+                elif kind == "gauge" and target is total and name == "live_lag_segments":
+                    target[name] = max(target.get(name, 0), value)
+                else:
+                    target[name] = target.get(name, 0) + value
+        for summary in list(rooms.values()) + [total]:
+            for name, entry in summary.items():
+                if isinstance(entry, dict) and "sum" in entry:
+                    entry["avg"] = round(entry.pop("sum") / entry["count"], 4) if entry["count"] else None
+        current_bytes = {room: summary.get("segment_bytes_total", 0) for room, summary in rooms.items()}
+        for room, summary in rooms.items():
+            summary["bytes_per_sec"] = round((current_bytes[room] - self.last_bytes.get(room, 0)) / elapsed)
+        total["bytes_per_sec"] = sum(summary["bytes_per_sec"] for summary in rooms.values())
+        if advance:
+            self.last_bytes = current_bytes
+            self.last_time = now
+        return {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"), "total": total, "rooms": rooms}
+
+METRICS = Metrics()
+
+def write_metrics_log(path=METRICS_FILE, interval=METRICS_INTERVAL):
+    """Append a METRICS snapshot to `path` as one JSON line every `interval` seconds."""
+    while True:
+        time.sleep(interval)
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(METRICS.snapshot()) + "\n")
+        except Exception as e:
+            print(f"[Metrics] Could not write {path}: {e}")
+
+def start_metrics_log():
+    if METRICS_FILE:
+        threading.Thread(target=write_metrics_log, args=(METRICS_FILE, METRICS_INTERVAL), daemon=True, name="MetricsLog").start()
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.throttled_at = 0
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rate < self.base_rate and now - self.throttled_at > RATE_RECOVERY_DELAY:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * RATE_RECOVERY * elapsed)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+class RateLimiter:
+    """Global token buckets per request kind ("page", "playlist", "segment") shared by all rooms.
+
+    Waiters are served lowest priority value first, so a segment that is about to drop out
+    of the live window gets the next token before one that was only just announced.
+    A 429 shrinks that kind's rate and honours Retry-After; the rate creeps back afterwards.
+    Waiters sleep until the next token is due, or until the queue moves if they are not next.
+    """
+
+    def __init__(self, limits):
+        self.buckets = {kind: TokenBucket(rate) for kind, rate in limits.items()}
+        self.waiters = {kind: [] for kind in limits}
+        self.async_waiters = {kind: [] for kind in limits}  # (loop, future) of asyncio waiters to wake when the queue moves
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.throttled = 0
+
+    def _try_take(self, kind, ticket):
+        """Return 0 if ticket got a token, otherwise how long to wait before trying again."""
+        bucket = self.buckets[kind]
+        now = time.monotonic()
+        bucket.refill(now)
+        if now < bucket.blocked_until:
+            return bucket.blocked_until - now
+        if self.waiters[kind][0] != ticket:
+            return 1  # woken by _wake() as soon as the ticket in front gets its token
+        if bucket.tokens < 1:
+            return (1 - bucket.tokens) / bucket.rate
+        bucket.tokens -= 1
+        heapq.heappop(self.waiters[kind])
+        self._wake(kind)
+        return 0
+
+    def _wake(self, kind):
+        self.cond.notify_all()
+        for loop, future in self.async_waiters[kind]:
+            loop.call_soon_threadsafe(_set_done, future)
+        self.async_waiters[kind].clear()
+
+    def _enqueue(self, kind, priority):
+        ticket = (float("inf") if priority is None else priority, next(self.counter))
+        heapq.heappush(self.waiters[kind], ticket)
+        return ticket
+
+    def _abandon(self, kind, ticket):
+        if ticket in self.waiters[kind]:
+            self.waiters[kind].remove(ticket)
+            heapq.heapify(self.waiters[kind])
+            self._wake(kind)
+
+    def acquire(self, kind, priority=0):
+        if not ENABLE_RATE_LIMIT or kind not in self.buckets:
+            return
+        with self.cond:
+            ticket = self._enqueue(kind, priority)
+            try:
+                while True:
+                    wait = self._try_take(kind, ticket)
+                    if not wait:
+                        return
+                    self.cond.wait(min(wait, 1))
+            except BaseException:
+                self._abandon(kind, ticket)
+                raise
+
+    async def async_acquire(self, kind, priority=0):
+        if not ENABLE_RATE_LIMIT or kind not in self.buckets:
+            return
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            ticket = self._enqueue(kind, priority)
+        try:
+            while True:
+                with self.cond:
+                    wait = self._try_take(kind, ticket)
+                    if not wait:
+                        return
+                    waiter = (loop, loop.create_future())
+                    self.async_waiters[kind].append(waiter)
+                try:
+                    await asyncio.wait_for(waiter[1], min(wait, 1))
+                except asyncio.TimeoutError:
+                    with self.cond:
+                        if waiter in self.async_waiters[kind]:
+                            self.async_waiters[kind].remove(waiter)
+        except BaseException:
+            with self.cond:
+                self._abandon(kind, ticket)
+            raise
+
+    def feedback(self, kind, status_code, retry_after=None):
+        if status_code != 429 or kind not in self.buckets:
+            return
+        with self.cond:
+            bucket = self.buckets[kind]
+            now = time.monotonic()
+            bucket.refill(now)
+            bucket.rate = max(bucket.base_rate * RATE_MIN_FRACTION, bucket.rate * RATE_BACKOFF)
+            bucket.tokens = min(bucket.tokens, 0)
+            bucket.throttled_at = now
+            bucket.blocked_until = max(bucket.blocked_until, now + parse_retry_after(retry_after, 1 / bucket.rate))
+            self.throttled += 1
+
+    def stats_text(self):
+        with self.cond:
+            rates = ", ".join(f"{kind} {bucket.rate:.1f}/{bucket.base_rate:g}" for kind, bucket in self.buckets.items())
+        return f"Rate limits (req/s): {rates} | 429s: {self.throttled}"
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+def parse_retry_after(value, default):
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return default
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS)
+
+class SourceAddressAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose connections are made from SOURCE_ADDRESS."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = (SOURCE_ADDRESS, 0)
+        super().init_poolmanager(*args, **kwargs)
+
+class SessionPool:
+    """One keep-alive requests.Session per host, shared by every downloader."""
+
+    def __init__(self, pool_maxsize=POOL_MAXSIZE):
+        self.pool_maxsize = pool_maxsize
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session_for(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(HEADERS)
+                if PROXY:
+                    session.proxies = {"http": PROXY, "https": PROXY}
+                adapter_class = SourceAddressAdapter if SOURCE_ADDRESS else requests.adapters.HTTPAdapter
+                adapter = adapter_class(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+        return session
+
+    def get(self, url, kind="segment", priority=None, **kwargs):
+        """kind picks the rate limit budget; priority is how many segments are left before this one
+        leaves the live window (lower is fetched first), None for requests with no deadline."""
+        RATE_LIMITER.acquire(kind, priority)
+        resp = self.session_for(url).get(url, **kwargs)
+        RATE_LIMITER.feedback(kind, resp.status_code, resp.headers.get("Retry-After"))
+        return resp
+
+    def stats(self):
+        """Requests served, new connections opened (pool misses) and requests on a reused connection (pool hits)."""
+        total_requests = 0
+        new_connections = 0
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            pools = session.get_adapter("https://").poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    total_requests += pool.num_requests
+                    new_connections += pool.num_connections
+        return {
+            "hosts": len(sessions),
+            "requests": total_requests,
+            "new_connections": new_connections,
+            "reused": max(total_requests - new_connections, 0),
+        }
+
+    def stats_text(self):
+        stats = self.stats()
+        reuse = 100 * stats["reused"] / stats["requests"] if stats["requests"] else 0
+        return (f"HTTP pool: {stats['requests']} requests, {stats['new_connections']} new connections, "
+                f"{stats['reused']} reused ({reuse:.0f}%) across {stats['hosts']} hosts")
+
+HTTP_POOL = SessionPool()
+
+class SegmentBuffer:
+    """One downloaded segment in a reusable shared-memory block.
+
+    The writer and the corruption checker both read it in place (the checker from its own
+    process, by name), and it goes back to BUFFER_POOL once the last of them calls release().
+    """
+
+    def __init__(self, pool, size, pooled=True):
+        self.pool = pool
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.size = size
+        self.pooled = pooled
+        self.length = 0
+        self.refs = 0
+        self.lock = threading.Lock()
+
+    def view(self):
+        return self.shm.buf[:self.length]
+
+    def retain(self):
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            done = self.refs == 0
+        if done:
+            self.pool.give_back(self)
+
+    def destroy(self):
+        try:
+            self.shm.close()
+            self.shm.unlink()
+        except (BufferError, FileNotFoundError):
+            pass
+
+class BufferPool:
+    """Pre-allocated segment buffers, reused instead of allocating a fresh bytes object per segment."""
+
+    def __init__(self, buffer_size=SEGMENT_BUFFER_SIZE, max_buffers=SEGMENT_BUFFERS):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.free = []
+        self.created = 0
+        self.lock = threading.Lock()
+        # Instrumentation: segment-sized allocations against segments handled.
+        self.allocated_bytes = 0
+        self.segments = 0
+
+    def acquire(self, size_hint=0):
+        with self.lock:
+            self.segments += 1
+            if size_hint <= self.buffer_size:
+                if self.free:
+                    buffer = self.free.pop()
+                    buffer.length = 0
+                    buffer.refs = 1
+                    return buffer
+                pooled = self.created < self.max_buffers
+                if pooled:
+                    self.created += 1
+            else:
+                pooled = False
+            size = max(size_hint, self.buffer_size)
+            self.allocated_bytes += size
+        buffer = SegmentBuffer(self, size, pooled)
+        buffer.refs = 1
+        return buffer
+
+    def grow(self, buffer):
+        """Move a segment that outgrew its buffer into a one-off buffer twice the size."""
+        bigger = SegmentBuffer(self, buffer.size * 2, pooled=False)
+        bigger.refs = 1
+        bigger.shm.buf[:buffer.length] = buffer.shm.buf[:buffer.length]
+        bigger.length = buffer.length
+        with self.lock:
+            self.allocated_bytes += bigger.size
+            self.segments -= 1
+        buffer.release()
+        with self.lock:
+            self.segments += 1
+        return bigger
+
+    def note_copy(self, size):
+        """Count a segment-sized bytes object made outside the pool (ZERO_COPY off, or pickled for a check)."""
+        with self.lock:
+            self.allocated_bytes += size
+
+    def note_segment(self):
+        with self.lock:
+            self.segments += 1
+
+    def give_back(self, buffer):
+        if buffer.pooled:
+            with self.lock:
+                self.free.append(buffer)
+        else:
+            buffer.destroy()
+
+    def close(self):
+        with self.lock:
+            free, self.free = self.free, []
+        for buffer in free:
+            buffer.destroy()
+
+    def stats_text(self):
+        with self.lock:
+            per_segment = self.allocated_bytes / self.segments if self.segments else 0
+            return (f"Segment buffers: {self.created} pooled ({self.created * self.buffer_size / 1024 / 1024:.0f} MB), "
+                    f"{per_segment / 1024:.0f} KB allocated per segment over {self.segments} segments")
+
+BUFFER_POOL = BufferPool()
+atexit.register(BUFFER_POOL.close)
+
+def peak_rss():
+    """Peak resident memory of this process in bytes, 0 if the platform can't tell."""
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", 0) or info.rss
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+def cpu_seconds(pid=None):
+    """CPU time of a process (this one by default) and its ffmpeg/checker children so far.
+
+    None without psutil, except for this process, where os.times() still covers the children
+    that have exited.
+    """
+    if psutil is None:
+        if pid is not None:
+            return None
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+    try:
+        process = psutil.Process(pid)
+        total = sum(process.cpu_times()[:2])
+        for child in process.children(recursive=True):
+            try:
+                total += sum(child.cpu_times()[:2])
+            except psutil.Error:
+                pass
+        return total
+    except psutil.Error:
+        return None
+
+def memory_stats_text(rooms):
+    peak = peak_rss() / 1024 / 1024
+    per_room = peak / rooms if rooms else peak
+    return f"{BUFFER_POOL.stats_text()}, peak RSS {peak:.0f} MB ({per_room:.1f} MB per room)"
+
+def segment_size(segment):
+    return segment.length if isinstance(segment, SegmentBuffer) else len(segment)
+
+def release_segment(segment):
+    if isinstance(segment, SegmentBuffer):
+        segment.release()
+
+def discard_fetch(future):
+    """Drop a prefetch that is no longer needed, handing its buffer back to the pool."""
+    future.cancel()
+    future.add_done_callback(_release_fetch_result)
+
+def _release_fetch_result(future):
+    if not future.cancelled() and future.exception() is None:
+        release_segment(future.result())
+
+def read_segment(resp):
+    """Read a 200 segment response into a pooled buffer (plain bytes with ZERO_COPY off)."""
+    encoded = resp.headers.get("Content-Encoding", "identity") != "identity"
+    if not ZERO_COPY or encoded:
+        data = resp.content
+        BUFFER_POOL.note_copy(len(data))
+        BUFFER_POOL.note_segment()
+        return data
+    buffer = BUFFER_POOL.acquire(int(resp.headers.get("Content-Length") or 0))
+    try:
+        while True:
+            if buffer.length == buffer.size:
+                # Segments often fill their buffer exactly: make sure there is more before growing it.
+                probe = bytearray(1)
+                if not resp.raw.readinto(probe):
+                    return buffer
+                buffer = BUFFER_POOL.grow(buffer)
+                buffer.shm.buf[buffer.length] = probe[0]
+                buffer.length += 1
+            view = buffer.shm.buf[buffer.length:buffer.length + READ_CHUNK]
+            try:
+                read = resp.raw.readinto(view)
+            finally:
+                view.release()
+            if not read:
+                return buffer
+            buffer.length += read
+    except BaseException:
+        buffer.release()
+        raise
+    finally:
+        resp.close()
+
+async def async_read_segment(resp):
+    """asyncio version of read_segment for aiohttp responses."""
+    if not ZERO_COPY:
+        data = await resp.read()
+        BUFFER_POOL.note_copy(len(data))
+        BUFFER_POOL.note_segment()
+        return data
+    buffer = BUFFER_POOL.acquire(resp.content_length or 0)
+    try:
+        async for chunk in resp.content.iter_chunked(READ_CHUNK):
+            while buffer.length + len(chunk) > buffer.size:
+                buffer = BUFFER_POOL.grow(buffer)
+            buffer.shm.buf[buffer.length:buffer.length + len(chunk)] = chunk
+            buffer.length += len(chunk)
+        return buffer
+    except BaseException:
+        buffer.release()
+        raise
+
+class CheckPool:
+    """Bounded process pool for corruption checks, so a slow check never holds up a download.
+
+    submit() never blocks: when CHECK_QUEUE_SIZE checks are already waiting it returns None
+    and the caller writes the segment unchecked. Rooms outranked by another downloading room
+    already get None once the part of the queue outside CHECK_PRIORITY_RESERVE is full.
+    """
+
+    def __init__(self, workers=CHECK_WORKERS, queue_size=CHECK_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def load(self):
+        return self.pending / self.queue_size
+
+    def submit(self, username, segment_index, segment, outranked=False):
+        limit = self.queue_size * (1 - CHECK_PRIORITY_RESERVE) if outranked else self.queue_size
+        with self.lock:
+            if self.pending >= limit:
+                return None
+            if self.executor is None:
+                # spawn, not fork: forking a process full of downloader threads can deadlock.
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            self.pending += 1
+        try:
+            if isinstance(segment, SegmentBuffer):
+                # Only the shared memory name crosses the process boundary, not the segment.
+                segment.retain()
+                future = self.executor.submit(timed_check, check_shared_segment, username, segment_index,
+                                              segment.shm.name, segment.length, CORRUPTION_CHECK_MODE, TEMP_SEGMENT_DIR)
+            else:
+                BUFFER_POOL.note_copy(len(segment))
+                future = self.executor.submit(timed_check, check_segment, username, segment_index, segment,
+                                              CORRUPTION_CHECK_MODE, TEMP_SEGMENT_DIR)
+        except Exception as e:
+            print(f"[CheckPool] Could not queue segment {segment_index} of {username}: {e}")
+            release_segment(segment)
+            with self.lock:
+                self.pending -= 1
+            return None
+        METRICS.set("check_queue_depth", None, self.pending)
+        future.add_done_callback(lambda f: self._done(segment))
+        return future
+
+    def _done(self, segment):
+        if isinstance(segment, SegmentBuffer):
+            segment.release()
+        with self.lock:
+            self.pending -= 1
+        METRICS.set("check_queue_depth", None, self.pending)
+
+CHECK_POOL = CheckPool()
+
+class MuxerPool:
+    """ffmpeg muxers started ahead of time and waiting on stdin, handed out to new sessions and parts.
+
+    A waiting muxer can't know its output name yet, so it writes to a placeholder in MUXER_STAGING_DIR
+    which is moved into the session folder once ffmpeg is done with it.
+    """
+
+    def __init__(self, size=None):
+        self.size = MUXER_POOL_SIZE if size is None else size
+        self.lock = threading.Lock()
+        self.idle = deque()  # (process, placeholder file)
+        self.refilling = False
+        self.closed = False
+        self.names = itertools.count(1)
+        self.spawned = 0
+        self.spawn_seconds = 0.0
+        self.warm = 0
+        self.cold = 0
+
+    def spawn(self, output_file):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [
+                "ffmpeg", "-y", "-f", "mpegts", "-i", "pipe:0",
+                "-c", "copy", output_file
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        seconds = time.perf_counter() - start
+        METRICS.observe("muxer_spawn_seconds", None, seconds)
+        with self.lock:
+            self.spawned += 1
+            self.spawn_seconds += seconds
+        return process
+
+    def placeholder(self):
+        return os.path.join(MUXER_STAGING_DIR, f"{os.getpid()}-{next(self.names)}.mkv")
+
+    def take(self, username, output_file):
+        """(process, placeholder): a waiting muxer and the file it writes, or (process, None) for one
+        started right now on output_file."""
+        with self.lock:
+            entry = self.idle.popleft() if self.idle else None
+        if entry is not None and entry[0].poll() is not None:
+            self._discard(entry)
+            entry = None
+        if entry is None:
+            process, placeholder = self.spawn(output_file), None
+        else:
+            process, placeholder = entry
+        with self.lock:
+            if placeholder is None:
+                self.cold += 1
+            else:
+                self.warm += 1
+        METRICS.inc("muxers_total", username, source="cold" if placeholder is None else "warm")
+        self._refill_later()
+        return process, placeholder
+
+    def _refill_later(self):
+        with self.lock:
+            if self.refilling or self.closed or len(self.idle) >= self.size:
+                return
+            self.refilling = True
+        threading.Thread(target=self._refill, daemon=True, name="muxer-pool").start()
+
+    def _refill(self):
+        try:
+            os.makedirs(MUXER_STAGING_DIR, exist_ok=True)
+            while True:
+                with self.lock:
+                    if self.closed or len(self.idle) >= self.size:
+                        return
+                placeholder = self.placeholder()
+                entry = (self.spawn(placeholder), placeholder)
+                with self.lock:
+                    closed = self.closed
+                    if not closed:
+                        self.idle.append(entry)
+                if closed:
+                    self._discard(entry)
+                    return
+        except Exception as e:
+            print(f"[MuxerPool] Could not start a spare ffmpeg, starting them on demand: {e}")
+        finally:
+            with self.lock:
+                self.refilling = False
+
+    def _discard(self, entry):
+        process, placeholder = entry
+        try:
+            process.stdin.close()
+            process.wait(timeout=10)
+        except Exception:
+            process.kill()
+        with contextlib.suppress(OSError):
+            os.remove(placeholder)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+        for entry in idle:
+            self._discard(entry)
+
+    def stats_text(self):
+        with self.lock:
+            average = self.spawn_seconds / self.spawned * 1000 if self.spawned else 0
+            return (f"Muxers: {self.spawned} started, {average:.0f} ms on average, "
+                    f"{self.warm} of {self.warm + self.cold} handed out warm, {len(self.idle)} waiting")
+
+MUXER_POOL = MuxerPool()
+atexit.register(MUXER_POOL.close)
+
+ACTIVE_JOURNALS = set()  # journal paths a writer or downloader of this process currently owns
+JOURNAL_LOCK = threading.Lock()
+
+class SegmentRuns:
+    """Set of segment indices stored as runs of consecutive numbers, e.g. 100-2400 and 2402-9000.
+
+    A recording that runs for days stays a handful of runs instead of a list of every index.
+    Adding the next index, len() and the number of missing ones are O(1), lookups a binary search.
+    """
+
+    __slots__ = ("starts", "ends", "count")
+
+    def __init__(self, indices=()):
+        self.starts = array("q")  # first index of each run, ascending
+        self.ends = array("q")  # last index of each run
+        self.count = 0
+        for index in indices:
+            self.add(index)
+
+    def add(self, index):
+        """False if index was in already."""
+        starts, ends = self.starts, self.ends
+        if not ends or index > ends[-1] + 1:
+            starts.append(index)
+            ends.append(index)
+        elif index == ends[-1] + 1:
+            ends[-1] = index
+        else:
+            # Out of order, e.g. a hole filled from the chunklist backlog.
+            i = bisect_right(starts, index) - 1
+            if i >= 0 and index <= ends[i]:
+                return False
+            joins_left = i >= 0 and ends[i] + 1 == index
+            joins_right = starts[i + 1] - 1 == index
+            if joins_left and joins_right:
+                ends[i] = ends[i + 1]
+                del starts[i + 1]
+                del ends[i + 1]
+            elif joins_left:
+                ends[i] = index
+            elif joins_right:
+                starts[i + 1] = index
+            else:
+                starts.insert(i + 1, index)
+                ends.insert(i + 1, index)
+        self.count += 1
+        return True
+
+    def copy(self):
+        runs = SegmentRuns()
+        runs.starts, runs.ends, runs.count = array("q", self.starts), array("q", self.ends), self.count
+        return runs
+
+    def __contains__(self, index):
+        i = bisect_right(self.starts, index) - 1
+        return i >= 0 and index <= self.ends[i]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
+
+    @property
+    def first(self):
+        return self.starts[0] if self.count else None
+
+    @property
+    def last(self):
+        return self.ends[-1] if self.count else None
+
+    @property
+    def missing(self):
+        """Indices between the first and the last one that are not in."""
+        return self.ends[-1] - self.starts[0] + 1 - self.count if self.count else 0
+
+    def gaps(self):
+        """(first, last) of every run of missing indices, in order."""
+        for i in range(1, len(self.starts)):
+            yield self.ends[i - 1] + 1, self.starts[i] - 1
+
+class SessionJournal:
+    """Append-only log of one recording session, written line by line as segments land.
+
+    Lines are "session <start time>", "part <file>", "staged <placeholder> <file>" (a part being
+    written by a pooled muxer, see MuxerPool), "seg <index> <offset> <size> <crc32>" (offset into
+    the session's TS stream), "check <index> ok|corrupt", "recovered <index>", and "closed" once
+    the info file is written. Replaying it restores the FFmpegWriter state.
+    """
+
+    __slots__ = ("path", "start_time", "parts", "segments", "corrupt", "recovered", "bytes", "staged",
+                 "closed", "file", "lock")
+
+    def __init__(self, path):
+        self.path = path
+        self.start_time = None
+        self.parts = []  # same layout as FFmpegWriter.parts
+        self.segments = SegmentRuns()
+        self.corrupt = SegmentRuns()
+        self.recovered = 0
+        self.bytes = 0
+        self.staged = {}  # part file -> placeholder a pooled muxer was writing it to
+        self.closed = False
+        self.file = None
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self._replay()
+
+    def _replay(self):
+        folder = os.path.dirname(self.path)
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # torn last line from a crash
+                kind, _, rest = line.rstrip("\n").partition(" ")
+                fields = rest.split()
+                try:
+                    if kind == "session":
+                        self.start_time = rest
+                    elif kind == "part":
+                        self.parts.append([os.path.join(folder, rest), None, None, 0, 0])
+                    elif kind == "staged":
+                        placeholder, _, name = rest.partition(" ")
+                        self.staged[os.path.join(folder, name)] = os.path.join(MUXER_STAGING_DIR, placeholder)
+                    elif kind == "seg" and self.parts:
+                        index, offset, size = int(fields[0]), int(fields[1]), int(fields[2])
+                        self.segments.add(index)
+                        self.bytes = max(self.bytes, offset + size)
+                        part = self.parts[-1]
+                        if part[1] is None:
+                            part[1] = index
+                        part[2] = index
+                        part[3] += 1
+                        part[4] += size
+                    elif kind == "check":
+                        if fields[1] != "ok":
+                            self.corrupt.add(int(fields[0]))
+                    elif kind == "recovered":
+                        self.recovered += 1
+                    elif kind == "closed":
+                        self.closed = True
+                except (IndexError, ValueError):
+                    continue
+
+    @property
+    def last_index(self):
+        return self.segments.last if self.segments else -1
+
+    def resume_start(self, live_index, oldest_index):
+        """First index to fetch when resuming into this session, or None if the CDN moved on to a new stream."""
+        last = self.last_index
+        if last < 0 or live_index <= last:
+            # Segment numbers restart with every new stream, so this is not the one we were recording.
+            return None
+        if oldest_index < 0:
+            return live_index
+        # Holes the CDN still lists come first, then everything after the last journaled segment.
+        for gap_start, gap_end in self.segments.gaps():
+            if gap_end >= oldest_index:
+                return max(gap_start, oldest_index)
+        return min(max(oldest_index, last + 1), live_index)
+
+    def record(self, *fields):
+        with self.lock:
+            if self.file is None:
+                torn = os.path.exists(self.path) and not journal_ends_with(self.path, b"\n")
+                self.file = open(self.path, "a", encoding="utf-8")
+                if torn:
+                    self.file.write("\n")
+                with JOURNAL_LOCK:
+                    ACTIVE_JOURNALS.add(self.path)
+            self.file.write(" ".join(str(field) for field in fields) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.record("closed")
+        with self.lock:
+            self.file.close()
+            self.file = None
+        with JOURNAL_LOCK:
+            ACTIVE_JOURNALS.discard(self.path)
+
+    def suspend(self):
+        """Close the file but leave the session unfinished and claimed, for its downloader to continue."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def discard(self):
+        """Drop the journal of a session that never wrote anything."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+        with JOURNAL_LOCK:
+            ACTIVE_JOURNALS.discard(self.path)
+
+    def unstage(self):
+        """Move parts a crash left in MUXER_STAGING_DIR to where they belong."""
+        for output_file, placeholder in self.staged.items():
+            if os.path.exists(placeholder) and not os.path.exists(output_file):
+                try:
+                    shutil.move(placeholder, output_file)
+                    print(f"[*] Recovered {os.path.basename(output_file)} from {placeholder}")
+                except OSError as e:
+                    print(f"[!] Could not move {placeholder} to {output_file}: {e}")
+
+def journal_ends_with(path, tail):
+    with open(path, "rb") as f:
+        f.seek(max(os.path.getsize(path) - len(tail), 0))
+        return f.read() == tail
+
+def journal_closed(path):
+    return journal_ends_with(path, b"closed\n")
+
+def find_open_journal(username):
+    """The session a crash or restart left unfinished for this room, if it is recent enough to resume.
+
+    Older unfinished sessions get their info file written and are closed off.
+    """
+    if not JOURNAL:
+        return None
+    with JOURNAL_LOCK:
+        paths = [path for path in glob.glob(os.path.join("Downloads", glob.escape(username), "*", "*.journal"))
+                 if path not in ACTIVE_JOURNALS]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    candidate = None
+    for path in paths:
+        try:
+            if journal_closed(path):
+                continue
+            fresh = time.time() - os.path.getmtime(path) < RESUME_WINDOW
+            journal = SessionJournal(path)
+        except OSError:
+            continue
+        if not journal.start_time:
+            continue
+        with JOURNAL_LOCK:
+            if path in ACTIVE_JOURNALS:
+                continue
+            ACTIVE_JOURNALS.add(path)
+        if candidate is None and fresh:
+            candidate = journal
+        else:
+            finish_journal(journal, username)
+    return candidate
+
+def finish_journal(journal, username):
+    """Write the info file of a session that will not be resumed, from its journal alone."""
+    try:
+        FFmpegWriter(os.path.dirname(journal.path), username, journal).close()
+    except Exception as e:
+        print(f"[!] Could not close off {journal.path}: {e}")
+        with JOURNAL_LOCK:
+            ACTIVE_JOURNALS.discard(journal.path)
+
+def release_journal(journal):
+    """Let another downloader claim a session this one won't continue after all."""
+    with JOURNAL_LOCK:
+        ACTIVE_JOURNALS.discard(journal.path)
+
+class FFmpegWriter:
+    __slots__ = ("output_dir", "username", "rotating", "start_time", "journal", "output_file", "log_file",
+                 "process", "next_process", "min_segments", "held", "held_valid", "placeholders", "parts", "part_started",
+                 "overdue_segments", "cut_pending", "closing", "lock", "segments", "corrupt_segments",
+                 "bytes_written", "check_lock", "pending_checks", "unchecked_segments", "recovered_segments")
+
+    def __init__(self, output_dir, username, journal=None):
+        self.output_dir = output_dir
+        self.username = username
+        self.rotating = bool(ROTATE_SIZE_MB or ROTATE_MINUTES)
+        # A junk session before this one may have removed the folder again.
+        os.makedirs(output_dir, exist_ok=True)
+        if journal is not None and journal.start_time:
+            # Resuming: same session name, info file and journal; ffmpeg can't append to the
+            # old .mkv, so the recording carries on in the next part.
+            self.start_time = journal.start_time
+            self.journal = journal
+            journal.unstage()
+            self.min_segments = 0  # not a new session, nothing to hold back
+        else:
+            self.min_segments = MUXER_MIN_SEGMENTS
+            self.start_time = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+            self.journal = SessionJournal(os.path.join(output_dir, f"{username} [{self.start_time}].journal")) if JOURNAL else None
+            if self.journal is not None:
+                self.journal.record("session", self.start_time)
+        parts = self.journal.parts if self.journal is not None else []
+        self.output_file = self.part_file(len(parts) + 1)
+        self.log_file = os.path.join(output_dir, f"{username} [{self.start_time}].txt")
+
+        # Taken from MUXER_POOL once MUXER_MIN_SEGMENTS segments that look like video came in, so a
+        # session that flaps on and off leaves no file behind. Until then they wait in held (the last
+        # MUXER_HOLD_LIMIT of them). A resumed session already has its file and starts right away.
+        self.process = None
+        self.next_process = None
+        self.held = []  # (index, bytes)
+        self.held_valid = 0
+        self.placeholders = {}  # muxer process -> (placeholder it writes, part file), for pooled muxers
+        # One entry per output file: [file, first segment, last segment, segments, bytes]
+        self.parts = parts + [[self.output_file, None, None, 0, 0]]
+        self.part_started = time.time()
+        self.overdue_segments = 0
+        self.cut_pending = False
+        self.closing = []
+
+        self.lock = threading.Lock()
+        self.segments = SegmentRuns()
+        self.corrupt_segments = SegmentRuns()
+        self.bytes_written = 0
+        self.check_lock = threading.Lock()
+        self.pending_checks = set()
+        self.unchecked_segments = 0
+        self.recovered_segments = 0
+        if self.journal is not None:
+            self.segments = self.journal.segments.copy()
+            self.corrupt_segments = self.journal.corrupt.copy()
+            self.bytes_written = self.journal.bytes
+            self.recovered_segments = self.journal.recovered
+
+    def part_file(self, number):
+        if not self.rotating and number == 1:
+            return os.path.join(self.output_dir, f"{self.username} [{self.start_time}].mkv")
+        return os.path.join(self.output_dir, f"{self.username} [{self.start_time}] part{number:03d}.mkv")
+
+    def _spawn_muxer(self, output_file):
+        process, placeholder = MUXER_POOL.take(self.username, output_file)
+        if placeholder is not None:
+            self.placeholders[process] = (placeholder, output_file)
+            if self.journal is not None:
+                self.journal.record("staged", os.path.basename(placeholder), os.path.basename(output_file))
+        return process
+
+    def write_segment(self, segment_index, segment):
+        """segment is bytes or a SegmentBuffer; the caller keeps (and later releases) its own reference."""
+        if ENABLE_CORRUPTION_CHECK:
+            self.queue_check(segment_index, segment)
+
+        with self.lock:
+            try:
+                if self.process is None:
+                    if isinstance(segment, SegmentBuffer):
+                        with segment.view() as view:
+                            data = bytes(view)
+                    else:
+                        data = bytes(segment)
+                    self.held.append((segment_index, data))
+                    if looks_like_ts(data):
+                        self.held_valid += 1
+                    if len(self.held) > max(MUXER_HOLD_LIMIT, self.min_segments):
+                        _, dropped = self.held.pop(0)
+                        if looks_like_ts(dropped):
+                            self.held_valid -= 1
+                    if self.held_valid < self.min_segments:
+                        return
+                    self.process = self._spawn_muxer(self.output_file)
+                    held, self.held = self.held, []
+                    for index, data in held:
+                        self._write(index, data)
+                elif isinstance(segment, SegmentBuffer):
+                    with segment.view() as view:
+                        self._write(segment_index, view)
+                else:
+                    self._write(segment_index, segment)
+            except Exception as e:
+                print(f"[FFmpegWriter] Failed to write segment {segment_index}: {e}")
+
+    def _write(self, segment_index, ts_bytes):
+        self._rotate_if_due(ts_bytes)
+        start = time.perf_counter()
+        self.process.stdin.write(ts_bytes)
+        size = len(ts_bytes)
+        crc = zlib.crc32(ts_bytes) if self.journal is not None else 0
+        METRICS.observe("stdin_write_seconds", self.username, time.perf_counter() - start)
+        self.segments.add(segment_index)
+        part = self.parts[-1]
+        if part[1] is None:
+            part[1] = segment_index
+            if self.journal is not None:
+                self.journal.record("part", os.path.basename(part[0]))
+        part[2] = segment_index
+        part[3] += 1
+        part[4] += size
+        if self.journal is not None:
+            self.journal.record("seg", segment_index, self.bytes_written, size, f"{crc:08x}")
+        self.bytes_written += size
+
+    def _part_progress(self):
+        """How far the current part is towards its size or time limit, 1.0 = due."""
+        progress = 0.0
+        if ROTATE_SIZE_MB:
+            progress = self.parts[-1][4] / (ROTATE_SIZE_MB * 1024 * 1024)
+        if ROTATE_MINUTES:
+            progress = max(progress, (time.time() - self.part_started) / (ROTATE_MINUTES * 60))
+        return progress
+
+    def new_part(self):
+        """Start the next part with the next segment, e.g. because the stream switched to another variant."""
+        with self.lock:
+            self.cut_pending = True
+
+    def _rotate_if_due(self, ts_bytes):
+        if not self.parts[-1][3]:
+            return
+        if self.cut_pending:
+            # Cut right away: a new variant starts with a keyframe, and one .mkv keeps one resolution.
+            self.cut_pending = False
+            if self.next_process is None:
+                self.next_process = self._spawn_muxer(self.part_file(len(self.parts) + 1))
+        else:
+            if not self.rotating:
+                return
+            progress = self._part_progress()
+            if progress >= ROTATE_PRESPAWN and self.next_process is None:
+                # Start the next ffmpeg early; by the time the cut comes it is up and reading.
+                self.next_process = self._spawn_muxer(self.part_file(len(self.parts) + 1))
+            if progress < 1.0:
+                return
+            if not starts_with_keyframe(ts_bytes) and self.overdue_segments < ROTATE_KEYFRAME_WAIT:
+                self.overdue_segments += 1
+                return
+        old_process = self.process
+        self.process, self.next_process = self.next_process, None
+        self.output_file = self.part_file(len(self.parts) + 1)
+        self.parts.append([self.output_file, None, None, 0, 0])
+        self.part_started = time.time()
+        self.overdue_segments = 0
+        # ffmpeg finishing the old file can take a moment; don't hold up the next segment for it.
+        closer = threading.Thread(target=self._finish_muxer, args=(old_process,), daemon=True)
+        closer.start()
+        self.closing.append(closer)
+        print(f"[FFmpegWriter] {self.username}: continuing in {os.path.basename(self.output_file)}")
+
+    def _finish_muxer(self, process):
+        try:
+            process.stdin.close()
+            process.wait()
+        except:
+            pass
+        placeholder, output_file = self.placeholders.pop(process, (None, None))
+        if placeholder is not None and os.path.exists(placeholder):
+            try:
+                shutil.move(placeholder, output_file)
+            except OSError as e:
+                print(f"[FFmpegWriter] Could not move {placeholder} to {output_file}: {e}")
+
+    def queue_check(self, segment_index, segment):
+        # Under load only sample every Nth segment; with a full queue skip the check entirely.
+        load = CHECK_POOL.load()
+        future = None
+        if load < 0.5 or len(self.segments) % CHECK_SAMPLE_EVERY == 0:
+            future = CHECK_POOL.submit(self.username, segment_index, segment, SCHEDULER.outranked(self.username))
+        if future is None:
+            self.unchecked_segments += 1
+            return
+        with self.check_lock:
+            self.pending_checks.add(future)
+        future.add_done_callback(lambda f: self._check_done(segment_index, f))
+
+    def _check_done(self, segment_index, future):
+        try:
+            clean, seconds = future.result()
+            METRICS.observe("check_seconds", self.username, seconds)
+        except Exception:
+            clean = False
+        with self.check_lock:
+            self.pending_checks.discard(future)
+            if not clean:
+                self.corrupt_segments.add(segment_index)
+        if self.journal is not None:
+            self.journal.record("check", segment_index, "ok" if clean else "corrupt")
+
+    def note_recovered(self, segment_index):
+        self.recovered_segments += 1
+        if self.journal is not None:
+            self.journal.record("recovered", segment_index)
+
+    def gap_counts(self):
+        """(missing, corrupt) segments so far, cheap enough to ask while recording."""
+        with self.check_lock:
+            corrupt = len(self.corrupt_segments)
+        return self.segments.missing, corrupt
+
+    def check_ts(self, segment_index, ts_bytes):
+        return check_segment(self.username, segment_index, ts_bytes, CORRUPTION_CHECK_MODE, TEMP_SEGMENT_DIR)
+
+    def close(self, requests_made=None, keep_journal=False):
+        """Finish the session; with keep_journal (a pause) return its journal, re-read, to continue it later."""
+        if self.process is not None:
+            self._finish_muxer(self.process)
+        if self.next_process is not None:
+            # Spawned for a part that never started.
+            self._finish_muxer(self.next_process)
+            unused = self.part_file(len(self.parts) + 1)
+            if os.path.exists(unused) and not os.path.getsize(unused):
+                os.remove(unused)
+        for closer in self.closing:
+            closer.join()
+        with self.check_lock:
+            pending = list(self.pending_checks)
+        concurrent.futures.wait(pending, timeout=RETRY_TIMEOUT)
+        if not self.segments:
+            self._discard()
+            return
+        self._write_log(requests_made)
+        if self.journal is not None:
+            if keep_journal:
+                self.journal.suspend()
+                return SessionJournal(self.journal.path)
+            self.journal.close()
+
+    def _discard(self):
+        """Nothing reached ffmpeg: leave no info file, journal or empty folder behind."""
+        if self.held:
+            METRICS.inc("junk_sessions_total", self.username)
+            print(f"[FFmpegWriter] {self.username}: dropped a session of {len(self.held)} segments, "
+                  f"{self.held_valid} of them looking like video")
+            self.held = []
+        if self.journal is not None:
+            self.journal.discard()
+        with contextlib.suppress(OSError):
+            os.rmdir(self.output_dir)
+
+    def _write_log(self, requests_made=None):
+        with open(self.log_file, "w", encoding="utf-8") as f:
+            if self.segments:
+                f.write(f"Start segment: {self.segments.first:06d}.ts\n")
+                f.write(f"End segment:   {self.segments.last:06d}.ts\n")
+            f.write(f"Total segments used: {len(self.segments)}\n")
+            if CATCH_UP:
+                f.write(f"Recovered from the chunklist backlog: {self.recovered_segments}\n")
+            if requests_made is not None and self.segments:
+                f.write(f"Requests per segment: {requests_made / len(self.segments):.2f} ({requests_made} requests, {FETCH_MODE} mode)\n")
+            if self.rotating or sum(1 for part in self.parts if part[3]) > 1:
+                f.write("\nParts:\n")
+                for output_file, first, last, count, size in self.parts:
+                    if count:
+                        f.write(f"  {os.path.basename(output_file)}: {first:06d}.ts - {last:06d}.ts ({count} segments, {size / 1024 / 1024:.0f} MB)\n")
+
+            if self.segments.missing:
+                f.write(f"\nMissing segments ({self.segments.missing}):\n")
+                for gap_start, gap_end in self.segments.gaps():
+                    for m in range(gap_start, gap_end + 1):
+                        f.write(f"  {m:06d}.ts\n")
+            else:
+                f.write("\nNo segments missing.\n")
+
+            if ENABLE_CORRUPTION_CHECK:
+                with self.check_lock:
+                    corrupt = list(self.corrupt_segments)
+                if corrupt:
+                    f.write("\nCorrupt segments:\n")
+                    for s in corrupt:
+                        f.write(f"  {s:06d}.ts\n")
+                else:
+                    f.write("\nNo corrupt segments detected.\n")
+                if self.unchecked_segments:
+                    f.write(f"{self.unchecked_segments} segments were not checked because the checker was overloaded.\n")
+            else:
+                f.write("\nCorrupt segments checking disabled.\n")
+
+class DownloaderBase:
+    """What StreamDownloader and AsyncStreamDownloader share: the session, variant and scheduler
+    bookkeeping of run() and its loops. The engines only add fetching and waiting; the asyncio one
+    runs the methods that touch the disk or ffmpeg (start_session, open_writer, close_writer,
+    finish_run) on its loop's executor.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, url, gui, infinite=False, hls_url=None, quality=QUALITY, priority=0):
+        self.url = url
+        self.hls_url = hls_url
+        self.username = extract_username_from_url(url)
+        self.gui = gui
+        self.running = False
+        self.retries = 0
+        self.last_index = -1
+        self.last_written = -1
+        self.current_index = -1
+        self.folder = None
+        self.journal = None  # unfinished session found on start, until run() decides whether to resume it
+        self.resume_journal = None  # ...and once it has, for the next writer to pick up
+        self.skip = SegmentRuns()  # segments the resumed session already has
+        self.writer = None  # of the current or last session, for its live gap counts
+        self.writer_requests = 0  # self.requests when that writer started
+        self.infinite = infinite
+        self.quality = normalize_quality(quality)
+        self.priority = priority  # higher = more important, e.g. kept at a better variant by the bandwidth governor
+        self.variants = []  # of the current stream, lowest bitrate first
+        self.variant = None  # the one being downloaded
+        self.variant_stale = False  # set when the quality or the governor's step changed, picked up by the loops
+        self.preempted = False  # set by the scheduler to pause this room for a more important one
+        self.requests = 0
+        self.segments_fetched = 0
+
+    def watch_first(self):
+        """Hand an Infinite room to the prober before doing anything heavy; True if it was."""
+        if self.infinite and PROBE_OFFLINE_ROOMS and self.hls_url is None:
+            self.watch_offline()
+            return True
+        return False
+
+    def keep_trying(self):
+        return self.running and (self.infinite or self.retries < MAX_RETRIES)
+
+    def start_session(self, ts_urls):
+        """Decide where a (re)start begins from the chunklist's segment URLs: a journal left unfinished,
+        the gap since an error on the same stream, or a new session folder.
+
+        Returns (base_url, start_index, live_index).
+        """
+        latest_ts_url = ts_urls[-1]
+        print(f"[DEBUG] Latest TS URL: {latest_ts_url}")
+        base_url, index = parse_base_and_index(latest_ts_url)
+
+        new_folder = index <= self.last_index or self.folder is None
+        oldest_index = segment_index(-1, ts_urls[0])
+        resume_index = self.take_journal(index, oldest_index) if new_folder or self.journal is not None else None
+        if resume_index is not None:
+            start_index = resume_index
+        else:
+            if new_folder:
+                self.folder = get_output_folder(self.username)
+                self.skip = SegmentRuns()
+            start_index = self.catch_up_start(index, oldest_index, new_folder)
+
+        self.current_index = start_index
+        self.last_index = max(self.last_index, index)
+        return base_url, start_index, index
+
+    def attempt_failed(self, error):
+        """Book an exception out of one attempt of run(); returns "requeue", "offline" or "retry"."""
+        SCHEDULER.release(self)
+        if isinstance(error, Preempted):
+            return "requeue"
+        if isinstance(error, RoomOffline) and self.infinite and PROBE_OFFLINE_ROOMS:
+            # Whoever the prober hands the room to picks the session up again.
+            self.drop_journals(finish=False)
+            self.watch_offline()
+            return "offline"
+        print(f"[!] Error during stream fetch for {self.username}: {error}")
+        self.retries += 1
+        METRICS.inc("retries_total", self.username)
+        self.gui.update_status(self.username, f"Retrying ({self.retries})")
+        return "retry"
+
+    def finish_run(self):
+        SCHEDULER.release(self)
+        self.drop_journals()
+
+    def show_end_status(self):
+        if not self.running:
+            self.gui.update_status(self.username, "Stopped")
+        elif not self.infinite and self.retries >= MAX_RETRIES:
+            self.gui.update_status(self.username, "Stream ended")
+
+    def drop_journals(self, finish=True):
+        """Close off the session claimed on start if no writer took it over, or just let go of it."""
+        for journal in (self.journal, self.resume_journal):
+            if journal is not None:
+                if finish:
+                    finish_journal(journal, self.username)
+                else:
+                    release_journal(journal)
+        self.journal = self.resume_journal = None
+
+    def take_journal(self, live_index, oldest_index):
+        """Continue the session a crash left unfinished if the CDN is still on that stream; returns the start index or None."""
+        journal, self.journal = self.journal, None
+        if journal is None:
+            return None
+        start_index = journal.resume_start(live_index, oldest_index)
+        if start_index is None:
+            finish_journal(journal, self.username)
+            return None
+        print(f"[*] {self.username}: resuming {os.path.basename(journal.path)} at segment {start_index}")
+        self.folder = os.path.dirname(journal.path)
+        self.last_written = journal.last_index
+        self.skip = journal.segments
+        self.resume_journal = journal
+        return start_index
+
+    def catch_up_start(self, live_index, oldest_index, new_folder):
+        """Where to start downloading: the live edge, or with CATCH_UP as far back as the chunklist still goes."""
+        if not CATCH_UP or oldest_index < 0:
+            return live_index
+        if not new_folder and self.last_written >= 0:
+            # Same stream as before the error: fill the gap from where we left off.
+            return min(max(oldest_index, self.last_written + 1), live_index)
+        return oldest_index
+
+    def pick_variant(self, variants):
+        """Chunklist URL of the variant QUALITY and the bandwidth governor want, None for a bare media playlist."""
+        self.variants = variants
+        self.variant_stale = False
+        if not variants:
+            self.variant = None
+            return None
+        self.variant = choose_variant(variants, self.quality, BANDWIDTH_GOVERNOR.step(self.username))
+        METRICS.set("variant_bandwidth_bps", self.username, self.variant.bandwidth)
+        return self.variant.url
+
+    def switch_variant(self, writer, pending):
+        """Follow a quality or governor change mid-stream; returns the new chunklist URL, or None if the variant stays."""
+        old = self.variant
+        chunklist_url = self.pick_variant(self.variants)
+        if self.variant == old:
+            return None
+        print(f"[*] {self.username}: switching from {describe_variant(old)} to {describe_variant(self.variant)}")
+        # Prefetched segments are of the old variant; the new one continues with the same numbers.
+        for fetch in pending.values():
+            discard_fetch(fetch)
+        pending.clear()
+        writer.new_part()
+        return chunklist_url
+
+    def open_writer(self):
+        """Start a loop's writer on the session take_journal picked up, if any, and count its requests from here."""
+        journal, self.resume_journal = self.resume_journal, None
+        writer = self.writer = FFmpegWriter(self.folder, self.username, journal)
+        self.writer_requests = self.requests
+        return writer
+
+    def check_flags(self, writer, pending):
+        """Raise Preempted if the scheduler paused the room; the new chunklist URL if the variant changed, else None."""
+        if self.preempted:
+            raise Preempted("paused for a more important room")
+        if self.variant_stale:
+            return self.switch_variant(writer, pending)
+        return None
+
+    def count_request(self, kind):
+        self.requests += 1
+        METRICS.inc("requests_total", self.username, kind=kind)
+
+    def note_http_error(self, kind, status, url):
+        METRICS.inc("http_errors_total", self.username, kind=kind, code=str(status))
+        if kind == "playlist" and status in (403, 404):
+            HLS_CACHE.invalidate(url)
+
+    def note_fetched(self, start, segment):
+        METRICS.observe("segment_download_seconds", self.username, time.perf_counter() - start)
+        METRICS.inc("segment_bytes_total", self.username, segment_size(segment))
+        return segment
+
+    def note_pending(self, pending):
+        self.gui.update_prefetch(self.username, len(pending))
+        METRICS.set("pending_segments", self.username, len(pending))
+
+    def note_written(self, writer, index, live_index, lag):
+        self.last_written = index
+        if index < live_index:
+            # Older than the live edge we (re)started at, so only the catch-up could have saved it.
+            writer.note_recovered(index)
+        self.segments_fetched += 1
+        METRICS.inc("segments_total", self.username)
+        METRICS.set("live_lag_segments", self.username, lag)
+        self.gui.update_segment(self.username, index)
+
+    def done_before(self, entries, start_index):
+        """Sequence numbers on the first chunklist to skip: those before start_index (the live edge, or
+        where catch-up or a resumed journal begins) and those the resumed session already has."""
+        return {seq for seq, ts_url in entries
+                if segment_index(seq, ts_url) < start_index or segment_index(seq, ts_url) in self.skip}
+
+    def forget_unlisted(self, entries, seen, pending):
+        """Forget sequence numbers that have dropped out of the chunklist's window."""
+        listed = {seq for seq, ts_url in entries}
+        seen.intersection_update(listed)
+        for seq in [seq for seq in pending if seq not in listed]:
+            discard_fetch(pending.pop(seq))
+
+    def stop_fetches(self, pending):
+        """First half of a loop's cleanup: stop counting its bandwidth and drop its prefetches."""
+        BANDWIDTH_GOVERNOR.untrack(self)
+        for fetch in pending.values():
+            discard_fetch(fetch)
+        self.gui.update_prefetch(self.username, 0)
+
+    def close_writer(self, writer):
+        """Second half: finish the writer; a paused room keeps its journal for take_journal once it gets back in."""
+        paused = writer.close(self.requests - self.writer_requests, self.preempted)
+        if paused is not None:
+            self.journal = paused
+
+    def watch_offline(self):
+        self.gui.update_status(self.username, "Offline (watching)")
+        ONLINE_PROBER.watch(self)
+
+    def resume(self, hls_url):
+        """Called by the prober once the room is live again."""
+        self.hand_over(hls_url)
+
+    def stop(self):
+        self.running = False
+        if ONLINE_PROBER.unwatch(self):
+            self.gui.update_status(self.username, "Stopped")
+
+    def restart(self):
+        self.stop()
+        self.hand_over(None)
+
+    def hand_over(self, hls_url):
+        """Replace this downloader with a fresh one of the same engine and settings, and start it unless the room is gone."""
+        new_downloader = type(self)(self.url, self.gui, self.infinite, hls_url, self.quality, self.priority)
+        if self.gui.replace_downloader(self.username, new_downloader):
+            new_downloader.start()
+
+    def toggle_infinite(self):
+        self.infinite = not self.infinite
+        self.gui.update_infinite(self.username, self.infinite)
+
+class StreamDownloader(DownloaderBase, threading.Thread):
+    def __init__(self, url, gui, infinite=False, hls_url=None, quality=QUALITY, priority=0):
+        threading.Thread.__init__(self, daemon=True)
+        DownloaderBase.__init__(self, url, gui, infinite, hls_url, quality, priority)
+        self.stats_lock = threading.Lock()
+
+    def run(self):
+        self.running = True
+        if self.watch_first():
+            return
+        self.journal = find_open_journal(self.username)
+        try:
+            while self.keep_trying():
+                if not self.wait_for_slot():
+                    break
+                try:
+                    self.gui.update_status(self.username, "Fetching")
+                    m3u8_url = self.hls_url or resolve_hls_source(self.url)
+                    self.hls_url = None
+                    chunklist_url = self.pick_variant(get_variants(m3u8_url)) or m3u8_url
+                    base_url, start_index, live_index = self.start_session(get_ts_urls(chunklist_url))
+                    if FETCH_MODE == "playlist":
+                        self.playlist_loop(chunklist_url, start_index, live_index)
+                    else:
+                        self.download_loop(base_url, start_index, live_index)
+                    break
+                except Exception as e:
+                    outcome = self.attempt_failed(e)
+                    if outcome == "offline":
+                        return
+                    if outcome == "retry":
+                        time.sleep(5)
+        finally:
+            self.finish_run()
+        self.show_end_status()
+
+    def wait_for_slot(self):
+        """Wait until the scheduler lets this room download; False if it was stopped meanwhile."""
+        while not SCHEDULER.admit(self):
+            if not self.running:
+                SCHEDULER.release(self)
+                return False
+            self.gui.update_status(self.username, f"Queued (priority {self.priority})")
+            time.sleep(CHECK_INTERVAL)
+        return self.running
+
+    def count_request(self, kind):
+        with self.stats_lock:
+            super().count_request(kind)
+
+    def fetch_segment(self, ts_url, priority=None):
+        """Fetch one segment; returns a SegmentBuffer (bytes with ZERO_COPY off), or None if the CDN doesn't have it (yet)."""
+        self.count_request("segment")
+        start = time.perf_counter()
+        resp = HTTP_POOL.get(ts_url, priority=priority, timeout=10, stream=True)
+        if resp.status_code != 200:
+            resp.close()
+            self.note_http_error("segment", resp.status_code, ts_url)
+            return None
+        return self.note_fetched(start, read_segment(resp))
+
+    def download_loop(self, base_url, start_index, live_index):
+        self.gui.update_status(self.username, "Downloading")
+        start_time = time.time()
+        current_index = start_index
+        writer = self.open_writer()
+        pool = ThreadPoolExecutor(max_workers=PREFETCH_WINDOW, thread_name_prefix=f"prefetch-{self.username}")
+        pending = {}
+        window = 1
+        missed = False
+        BANDWIDTH_GOVERNOR.track(self)
+
+        try:
+            while self.running:
+                chunklist_url = self.check_flags(writer, pending)
+                if chunklist_url:
+                    base_url = parse_base_and_index(get_ts_urls(chunklist_url)[-1])[0]
+                if current_index in self.skip:
+                    current_index += 1
+                    continue
+                self.current_index = current_index
+                # Keep `window` fetches in flight; finished ones wait in `pending` until it is their turn.
+                for index in range(current_index, current_index + window):
+                    if index not in pending and index not in self.skip:
+                        pending[index] = pool.submit(self.fetch_segment, f"{base_url}{index}.ts")
+                self.note_pending(pending)
+                try:
+                    ts_bytes = pending.pop(current_index).result()
+                except Exception:
+                    ts_bytes = None
+                if ts_bytes is not None:
+                    try:
+                        writer.write_segment(current_index, ts_bytes)
+                    finally:
+                        release_segment(ts_bytes)
+                    # Probe mode only knows the live edge from the last (re)start; a miss means we're at it.
+                    self.note_written(writer, current_index, live_index, max(live_index - current_index, 0))
+                    current_index += 1
+                    start_time = time.time()
+                    # Only widen the window while segments are there on the first try, i.e. while
+                    # we are behind the live edge. At the edge it stays a single probe.
+                    window = 1 if missed else min(window * 2, PREFETCH_WINDOW)
+                    missed = False
+                else:
+                    missed = True
+                    METRICS.set("live_lag_segments", self.username, 0)
+                    window = 1
+                    for index, future in list(pending.items()):
+                        if future.done() and (future.exception() or future.result() is None):
+                            del pending[index]
+                    time.sleep(CHECK_INTERVAL)
+
+                if time.time() - start_time > RETRY_TIMEOUT:
+                    raise Exception("Retry timeout")
+        finally:
+            self.stop_fetches(pending)
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.close_writer(writer)
+
+    def playlist_loop(self, chunklist_url, start_index, live_index):
+        """Refresh the chunklist every target duration and fetch only segments it has announced."""
+        self.gui.update_status(self.username, "Downloading")
+        start_time = time.time()
+        writer = self.open_writer()
+        pool = ThreadPoolExecutor(max_workers=PREFETCH_WINDOW, thread_name_prefix=f"prefetch-{self.username}")
+        pending = {}
+        seen = set()
+        first_refresh = True
+        BANDWIDTH_GOVERNOR.track(self)
+
+        try:
+            while self.running:
+                wait = CHECK_INTERVAL
+                chunklist_url = self.check_flags(writer, pending) or chunklist_url
+                try:
+                    self.count_request("playlist")
+                    refresh_start = time.perf_counter()
+                    res = HTTP_POOL.get(chunklist_url, kind="playlist", timeout=10)
+                    if res.status_code != 200:
+                        self.note_http_error("playlist", res.status_code, chunklist_url)
+                    else:
+                        target_duration, entries = parse_media_playlist(chunklist_url, res.text)
+                        METRICS.observe("playlist_fetch_seconds", self.username, time.perf_counter() - refresh_start)
+                        newest_index = segment_index(entries[-1][0], entries[-1][1]) if entries else live_index
+                        if first_refresh:
+                            seen.update(self.done_before(entries, start_index))
+                            first_refresh = False
+                        fetched = False
+                        unseen = [(seq, ts_url) for seq, ts_url in entries if seq not in seen]
+                        for position, (seq, ts_url) in enumerate(unseen):
+                            if not self.running:
+                                break
+                            for ahead_seq, ahead_url in unseen[position:position + PREFETCH_WINDOW]:
+                                if ahead_seq not in pending:
+                                    # Segments near the start of the list are the next to drop out of the window.
+                                    pending[ahead_seq] = pool.submit(self.fetch_segment, ahead_url, ahead_seq - entries[0][0])
+                            self.note_pending(pending)
+                            try:
+                                ts_bytes = pending.pop(seq).result()
+                            except Exception:
+                                ts_bytes = None
+                            if ts_bytes is None:
+                                # Leave it unseen so the next refresh retries it while it is still listed.
+                                break
+                            index = segment_index(seq, ts_url)
+                            self.current_index = index
+                            try:
+                                writer.write_segment(index, ts_bytes)
+                            finally:
+                                release_segment(ts_bytes)
+                            self.note_written(writer, index, live_index, max(newest_index - index, 0))
+                            seen.add(seq)
+                            fetched = True
+                            start_time = time.time()
+                        self.forget_unlisted(entries, seen, pending)
+                        wait = target_duration if fetched else target_duration / 2
+                except:
+                    pass
+
+                if time.time() - start_time > RETRY_TIMEOUT:
+                    raise Exception("Retry timeout")
+                time.sleep(wait)
+        finally:
+            self.stop_fetches(pending)
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.close_writer(writer)
+
+class AsyncEngine:
+    """Runs one asyncio event loop on a background thread with a single shared aiohttp session."""
+
+    def __init__(self):
+        if aiohttp is None:
+            raise RuntimeError("The asyncio engine needs aiohttp (pip install aiohttp)")
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True, name="AsyncEngine")
+        self.thread.start()
+        self.ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._open_session())
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def _open_session(self):
+        local_addr = (SOURCE_ADDRESS, 0) if SOURCE_ADDRESS else None
+        connector = aiohttp.TCPConnector(limit=ASYNC_MAX_CONNECTIONS, ttl_dns_cache=300, local_addr=local_addr)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=HEADERS,
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+
+    @contextlib.asynccontextmanager
+    async def request(self, url, kind="segment", priority=None, **kwargs):
+        """session.get() behind the shared RateLimiter, see SessionPool.get for kind/priority."""
+        await RATE_LIMITER.async_acquire(kind, priority)
+        if PROXY:
+            # aiohttp only speaks http:// proxies.
+            kwargs.setdefault("proxy", PROXY)
+        async with self.session.get(url, **kwargs) as resp:
+            RATE_LIMITER.feedback(kind, resp.status, resp.headers.get("Retry-After"))
+            yield resp
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def shutdown(self):
+        if self.session is not None:
+            self.submit(self.session.close()).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+_async_engine = None
+_async_engine_lock = threading.Lock()
+
+def get_async_engine():
+    global _async_engine
+    with _async_engine_lock:
+        if _async_engine is None:
+            _async_engine = AsyncEngine()
+        return _async_engine
+
+class AsyncStreamDownloader(DownloaderBase):
+    """Coroutine version of StreamDownloader, driven by the shared AsyncEngine instead of its own thread."""
+
+    __slots__ = ("url", "hls_url", "username", "gui", "running", "retries", "last_index", "last_written",
+                 "current_index", "folder", "journal", "resume_journal", "skip", "writer", "writer_requests", "infinite",
+                 "quality", "priority", "variants", "variant", "variant_stale", "preempted", "requests", "segments_fetched",
+                 "engine", "future")
+
+    def __init__(self, url, gui, infinite=False, hls_url=None, quality=QUALITY, priority=0):
+        super().__init__(url, gui, infinite, hls_url, quality, priority)
+        self.engine = get_async_engine()
+        self.future = None
+
+    def start(self):
+        self.future = self.engine.submit(self.run())
+
+    async def run(self):
+        self.running = True
+        if self.watch_first():
+            return
+        # Journals and the ffmpeg writer do blocking file and pipe I/O, so those steps run on the loop's executor.
+        loop = asyncio.get_running_loop()
+        self.journal = await loop.run_in_executor(None, find_open_journal, self.username)
+        try:
+            while self.keep_trying():
+                if not await self.wait_for_slot():
+                    break
+                try:
+                    self.gui.update_status(self.username, "Fetching")
+                    m3u8_url = self.hls_url or await async_resolve_hls_source(self.engine, self.url)
+                    self.hls_url = None
+                    chunklist_url = self.pick_variant(await async_get_variants(self.engine, m3u8_url)) or m3u8_url
+                    ts_urls = await async_get_ts_urls(self.engine, chunklist_url)
+                    base_url, start_index, live_index = await loop.run_in_executor(None, self.start_session, ts_urls)
+                    if FETCH_MODE == "playlist":
+                        await self.playlist_loop(chunklist_url, start_index, live_index)
+                    else:
+                        await self.download_loop(base_url, start_index, live_index)
+                    break
+                except Exception as e:
+                    outcome = self.attempt_failed(e)
+                    if outcome == "offline":
+                        return
+                    if outcome == "retry":
+                        await asyncio.sleep(5)
+        finally:
+            await loop.run_in_executor(None, self.finish_run)
+        self.show_end_status()
+
+    async def wait_for_slot(self):
+        """Wait until the scheduler lets this room download; False if it was stopped meanwhile."""
+        while not SCHEDULER.admit(self):
+            if not self.running:
+                SCHEDULER.release(self)
+                return False
+            self.gui.update_status(self.username, f"Queued (priority {self.priority})")
+            await asyncio.sleep(CHECK_INTERVAL)
+        return self.running
+
+    async def fetch_segment(self, ts_url, priority=None):
+        """Fetch one segment; returns a SegmentBuffer (bytes with ZERO_COPY off), or None if the CDN doesn't have it (yet)."""
+        self.count_request("segment")
+        start = time.perf_counter()
+        async with self.engine.request(ts_url, priority=priority, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            if resp.status != 200:
+                self.note_http_error("segment", resp.status, ts_url)
+                return None
+            segment = await async_read_segment(resp)
+        return self.note_fetched(start, segment)
+
+    async def download_loop(self, base_url, start_index, live_index):
+        self.gui.update_status(self.username, "Downloading")
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        current_index = start_index
+        writer = await loop.run_in_executor(None, self.open_writer)
+        pending = {}
+        window = 1
+        missed = False
+        BANDWIDTH_GOVERNOR.track(self)
+
+        try:
+            while self.running:
+                chunklist_url = self.check_flags(writer, pending)
+                if chunklist_url:
+                    base_url = parse_base_and_index((await async_get_ts_urls(self.engine, chunklist_url))[-1])[0]
+                if current_index in self.skip:
+                    current_index += 1
+                    continue
+                self.current_index = current_index
+                # Keep `window` fetches in flight; finished ones wait in `pending` until it is their turn.
+                for index in range(current_index, current_index + window):
+                    if index not in pending and index not in self.skip:
+                        pending[index] = asyncio.ensure_future(self.fetch_segment(f"{base_url}{index}.ts"))
+                self.note_pending(pending)
+                try:
+                    ts_bytes = await pending.pop(current_index)
+                except Exception:
+                    ts_bytes = None
+                if ts_bytes is not None:
+                    try:
+                        await loop.run_in_executor(None, writer.write_segment, current_index, ts_bytes)
+                    finally:
+                        release_segment(ts_bytes)
+                    # Probe mode only knows the live edge from the last (re)start; a miss means we're at it.
+                    self.note_written(writer, current_index, live_index, max(live_index - current_index, 0))
+                    current_index += 1
+                    start_time = time.time()
+                    # Only widen the window while segments are there on the first try, i.e. while
+                    # we are behind the live edge. At the edge it stays a single probe.
+                    window = 1 if missed else min(window * 2, PREFETCH_WINDOW)
+                    missed = False
+                else:
+                    missed = True
+                    METRICS.set("live_lag_segments", self.username, 0)
+                    window = 1
+                    for index, task in list(pending.items()):
+                        if task.done() and (task.cancelled() or task.exception() or task.result() is None):
+                            del pending[index]
+                    await asyncio.sleep(CHECK_INTERVAL)
+
+                if time.time() - start_time > RETRY_TIMEOUT:
+                    raise Exception("Retry timeout")
+        finally:
+            self.stop_fetches(pending)
+            await loop.run_in_executor(None, self.close_writer, writer)
+
+    async def playlist_loop(self, chunklist_url, start_index, live_index):
+        """Refresh the chunklist every target duration and fetch only segments it has announced."""
+        self.gui.update_status(self.username, "Downloading")
+        loop = asyncio.get_running_loop()
+        engine = self.engine
+        segment_timeout = aiohttp.ClientTimeout(total=10)
+        start_time = time.time()
+        writer = await loop.run_in_executor(None, self.open_writer)
+        pending = {}
+        seen = set()
+        first_refresh = True
+        BANDWIDTH_GOVERNOR.track(self)
+
+        try:
+            while self.running:
+                wait = CHECK_INTERVAL
+                chunklist_url = self.check_flags(writer, pending) or chunklist_url
+                try:
+                    self.count_request("playlist")
+                    refresh_start = time.perf_counter()
+                    async with engine.request(chunklist_url, kind="playlist", timeout=segment_timeout) as res:
+                        text = await res.text() if res.status == 200 else None
+                        if text is None:
+                            self.note_http_error("playlist", res.status, chunklist_url)
+                    if text is not None:
+                        target_duration, entries = parse_media_playlist(chunklist_url, text)
+                        METRICS.observe("playlist_fetch_seconds", self.username, time.perf_counter() - refresh_start)
+                        newest_index = segment_index(entries[-1][0], entries[-1][1]) if entries else live_index
+                        if first_refresh:
+                            seen.update(self.done_before(entries, start_index))
+                            first_refresh = False
+                        fetched = False
+                        unseen = [(seq, ts_url) for seq, ts_url in entries if seq not in seen]
+                        for position, (seq, ts_url) in enumerate(unseen):
+                            if not self.running:
+                                break
+                            for ahead_seq, ahead_url in unseen[position:position + PREFETCH_WINDOW]:
+                                if ahead_seq not in pending:
+                                    # Segments near the start of the list are the next to drop out of the window.
+                                    pending[ahead_seq] = asyncio.ensure_future(self.fetch_segment(ahead_url, ahead_seq - entries[0][0]))
+                            self.note_pending(pending)
+                            try:
+                                ts_bytes = await pending.pop(seq)
+                            except Exception:
+                                ts_bytes = None
+                            if ts_bytes is None:
+                                # Leave it unseen so the next refresh retries it while it is still listed.
+                                break
+                            index = segment_index(seq, ts_url)
+                            self.current_index = index
+                            try:
+                                await loop.run_in_executor(None, writer.write_segment, index, ts_bytes)
+                            finally:
+                                release_segment(ts_bytes)
+                            self.note_written(writer, index, live_index, max(newest_index - index, 0))
+                            seen.add(seq)
+                            fetched = True
+                            start_time = time.time()
+                        self.forget_unlisted(entries, seen, pending)
+                        wait = target_duration if fetched else target_duration / 2
+                except Exception:
+                    pass
+
+                if time.time() - start_time > RETRY_TIMEOUT:
+                    raise Exception("Retry timeout")
+                await asyncio.sleep(wait)
+        finally:
+            self.stop_fetches(pending)
+            await loop.run_in_executor(None, self.close_writer, writer)
+
+class RoomOffline(Exception):
+    """The room page or API answered fine, but the room is not broadcasting."""
+
+class Preempted(Exception):
+    """The scheduler paused this room's download for a more important one."""
+
+class ProbeState:
+    __slots__ = ("downloader", "offline_probes", "next_probe")
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.offline_probes = 0
+        self.next_probe = 0
+
+class OnlineProber:
+    """Watches offline Infinite rooms with one cheap request each and hands live ones back to a downloader.
+
+    A probe first tries the room's last known hls_source (a tiny playlist, 200 while that
+    broadcast is still going), then the JSON room context, and only falls back to the full
+    room page if that API is unavailable. Rooms are probed in batches of PROBE_BATCH; a room
+    that stays offline is probed less and less often, except around the hours it usually
+    goes live.
+    """
+
+    def __init__(self):
+        self.rooms = {}  # username -> ProbeState
+        self.history = None  # username -> starts seen per hour of the day
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, downloader):
+        with self.lock:
+            self.rooms[downloader.username] = ProbeState(downloader)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name="OnlineProber")
+                self.thread.start()
+
+    def unwatch(self, downloader):
+        """Stop watching; True if the prober was watching this downloader."""
+        with self.lock:
+            state = self.rooms.get(downloader.username)
+            if state is None or state.downloader is not downloader:
+                return False
+            del self.rooms[downloader.username]
+            return True
+
+    def _run(self):
+        pool = ThreadPoolExecutor(max_workers=PROBE_BATCH, thread_name_prefix="probe")
+        while True:
+            now = time.time()
+            with self.lock:
+                due = [state for state in self.rooms.values() if state.next_probe <= now]
+            for start in range(0, len(due), PROBE_BATCH):
+                list(pool.map(self._probe, due[start:start + PROBE_BATCH]))
+            time.sleep(1)
+
+    def _probe(self, state):
+        downloader = state.downloader
+        if not downloader.running or not downloader.infinite:
+            # Stopped, or Infinite was switched off while it was offline.
+            if self.unwatch(downloader):
+                downloader.gui.update_status(downloader.username, "Stream ended" if downloader.running else "Stopped")
+                downloader.running = False
+            return
+        try:
+            hls_url = self.probe_room(downloader.username, downloader.url)
+        except Exception as e:
+            print(f"[Prober] {downloader.username}: {e}")
+            hls_url = None
+        if hls_url is None:
+            state.offline_probes += 1
+            state.next_probe = time.time() + self.next_interval(downloader.username, state.offline_probes)
+            return
+        if self.unwatch(downloader):
+            if state.offline_probes:
+                # Seen offline first, so this is (about) when the broadcast started.
+                self.record_start(downloader.username)
+            downloader.resume(hls_url)
+
+    def probe_room(self, username, page_url):
+        """hls_source if the room is live right now, else None."""
+        # However old, the last hls_source is still the cheapest thing to ask.
+        cached = HLS_CACHE.hls_source(username, max_age=None)
+        if cached:
+            res = HTTP_POOL.get(cached, kind="playlist", timeout=10)
+            res.close()
+            if res.status_code == 200:
+                return cached
+            if res.status_code in (403, 404):
+                HLS_CACHE.invalidate(cached)
+
+        parsed = urlparse(page_url)
+        res = HTTP_POOL.get(f"{parsed.scheme}://{parsed.netloc}/api/chatvideocontext/{username}/", kind="page", timeout=10)
+        if res.status_code == 200:
+            data = res.json()
+            hls_url = data.get("hls_source") if data.get("room_status") == "public" else None
+        else:
+            # No JSON API (or it's blocked): the room page still works, it's just heavier.
+            try:
+                hls_url = extract_hls_url(page_url)
+            except RoomOffline:
+                hls_url = None
+        if hls_url:
+            HLS_CACHE.put_source(username, hls_url)
+        return hls_url
+
+    def next_interval(self, username, offline_probes):
+        interval = min(PROBE_MIN_INTERVAL * PROBE_BACKOFF ** offline_probes, PROBE_MAX_INTERVAL)
+        if self.usually_live_soon(username):
+            interval = min(interval, PROBE_HOT_INTERVAL)
+        return interval
+
+    def _load_history(self):
+        if self.history is None:
+            try:
+                with open(PROBE_HISTORY_FILE, "r", encoding="utf-8") as f:
+                    self.history = json.load(f)
+            except (OSError, ValueError):
+                self.history = {}
+        return self.history
+
+    def usually_live_soon(self, username):
+        with self.lock:
+            starts = self._load_history().get(username)
+        if not starts:
+            return False
+        hour = datetime.now().hour
+        return starts[hour] + starts[(hour + 1) % 24] >= PROBE_HOT_STARTS
+
+    def record_start(self, username):
+        with self.lock:
+            history = self._load_history()
+            starts = history.setdefault(username, [0] * 24)
+            starts[datetime.now().hour] += 1
+            try:
+                with open(PROBE_HISTORY_FILE, "w", encoding="utf-8") as f:
+                    json.dump(history, f)
+            except OSError as e:
+                print(f"[Prober] Could not save {PROBE_HISTORY_FILE}: {e}")
+
+ONLINE_PROBER = OnlineProber()
+
+def make_downloader(url, gui, infinite=False, quality=QUALITY, priority=0):
+    if ENGINE == "asyncio":
+        return AsyncStreamDownloader(url, gui, infinite, None, quality, priority)
+    return StreamDownloader(url, gui, infinite, None, quality, priority)
+
+class HlsCache:
+    """Per-room hls_source and the variants listed in it, so a retry doesn't refetch the room page and master playlist.
+
+    Entries expire after HLS_CACHE_TTL seconds, and right away when the CDN answers 403/404
+    for either URL (the broadcast is over or the token expired).
+    """
+
+    def __init__(self):
+        self.sources = {}  # username -> (hls_source, time)
+        self.variant_lists = {}  # hls_source -> ([Variant], time)
+        self.lock = threading.Lock()
+
+    def hls_source(self, username, max_age=HLS_CACHE_TTL):
+        entry = self.sources.get(username)
+        if entry and (max_age is None or time.time() - entry[1] <= max_age):
+            return entry[0]
+        return None
+
+    def variants(self, hls_source):
+        entry = self.variant_lists.get(hls_source)
+        if entry and time.time() - entry[1] <= HLS_CACHE_TTL:
+            return entry[0]
+        return None
+
+    def put_source(self, username, hls_source):
+        with self.lock:
+            self.sources[username] = (hls_source, time.time())
+
+    def put_variants(self, hls_source, variants):
+        with self.lock:
+            self.variant_lists[hls_source] = (variants, time.time())
+
+    def invalidate(self, url):
+        """Forget everything derived from `url`, which may be an hls_source or a chunklist URL."""
+        with self.lock:
+            dead = {url}
+            for hls_source, (variants, _) in list(self.variant_lists.items()):
+                if url == hls_source or any(variant.url == url for variant in variants):
+                    dead.add(hls_source)
+                    del self.variant_lists[hls_source]
+            for username, (hls_source, _) in list(self.sources.items()):
+                if hls_source in dead:
+                    del self.sources[username]
+
+    def check(self, res, url):
+        """raise_for_status() that also drops cached URLs the CDN no longer serves."""
+        status = getattr(res, "status_code", None) or res.status
+        if status in (403, 404):
+            self.invalidate(url)
+        res.raise_for_status()
+
+HLS_CACHE = HlsCache()
+
+class BandwidthGovernor:
+    """Keeps the download rate of all rooms under BANDWIDTH_CAP_MBPS by moving "auto" rooms between variants.
+
+    Every BANDWIDTH_CHECK_INTERVAL the rate is measured from segment_bytes_total. Over the cap,
+    the lowest priority "auto" room that still has a lower variant steps down one; with room to
+    spare, the highest priority lowered room steps back up one if the variant's declared extra
+    bandwidth fits under BANDWIDTH_HEADROOM. One change per check, so the next measurement sees it.
+    """
+
+    def __init__(self):
+        self.steps = {}  # username -> variants below what the room's QUALITY picks
+        self.rooms = {}  # username -> downloader currently in a download loop
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_bytes = None
+        self.mbps = 0.0
+
+    def step(self, username):
+        return self.steps.get(username, 0)
+
+    def forget(self, username):
+        """Drop a room's step, e.g. once it is no longer "auto"."""
+        self.steps.pop(username, None)
+
+    def track(self, downloader):
+        with self.lock:
+            self.rooms[downloader.username] = downloader
+            if BANDWIDTH_CAP_MBPS and self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name="BandwidthGovernor")
+                self.thread.start()
+
+    def untrack(self, downloader):
+        with self.lock:
+            if self.rooms.get(downloader.username) is downloader:
+                del self.rooms[downloader.username]
+
+    def _run(self):
+        while True:
+            time.sleep(BANDWIDTH_CHECK_INTERVAL)
+            try:
+                self.adjust(BANDWIDTH_CHECK_INTERVAL)
+            except Exception as e:
+                print(f"[!] Bandwidth governor: {e}")
+
+    def measure(self, elapsed):
+        total = METRICS.total("segment_bytes_total")
+        if self.last_bytes is not None:
+            self.mbps = max(total - self.last_bytes, 0) * 8 / elapsed / 1e6
+        self.last_bytes = total
+        return self.mbps
+
+    def adjust(self, elapsed):
+        mbps = self.measure(elapsed)
+        with self.lock:
+            rooms = [d for d in self.rooms.values() if d.quality == "auto" and d.variant is not None and d.running]
+        if mbps > BANDWIDTH_CAP_MBPS:
+            lowerable = [d for d in rooms if variant_position(d.variants, d.quality, self.step(d.username) + 1) < d.variants.index(d.variant)]
+            if lowerable:
+                # Least important first; among equals the one that saves the most.
+                room = min(lowerable, key=lambda d: (d.priority, -d.variant.bandwidth))
+                self.steps[room.username] = self.step(room.username) + 1
+                room.variant_stale = True
+                print(f"[*] {mbps:.1f} Mbps is over the {BANDWIDTH_CAP_MBPS} Mbps cap, lowering {room.username}")
+            return
+        lowered = [d for d in rooms if self.step(d.username) > 0]
+        if not lowered:
+            return
+        room = max(lowered, key=lambda d: (d.priority, -d.variant.bandwidth))
+        better = choose_variant(room.variants, room.quality, self.step(room.username) - 1)
+        extra = (better.bandwidth - room.variant.bandwidth) / 1e6
+        if mbps + extra <= BANDWIDTH_CAP_MBPS * BANDWIDTH_HEADROOM:
+            self.steps[room.username] = self.step(room.username) - 1
+            room.variant_stale = True
+            print(f"[*] {mbps:.1f} Mbps leaves room under the {BANDWIDTH_CAP_MBPS} Mbps cap, raising {room.username}")
+
+    def stats_text(self):
+        with self.lock:
+            lowered = sum(1 for username in self.rooms if self.step(username) > 0)
+        cap = f"{BANDWIDTH_CAP_MBPS} Mbps cap, {lowered} rooms lowered" if BANDWIDTH_CAP_MBPS else "no cap"
+        return f"Bandwidth: {self.mbps:.1f} Mbps ({cap})"
+
+BANDWIDTH_GOVERNOR = BandwidthGovernor()
+
+class DownloadScheduler:
+    """Decides which rooms get to download when MAX_ACTIVE_DOWNLOADS, the CPU or the bandwidth cap run short.
+
+    Downloaders call admit() before every (re)start of a stream and wait as "Queued" until it
+    says yes: the highest priority room first, among equals the one that waited longest, and
+    only while there is a free slot and the CPU and bandwidth readings are under their limits
+    times SCHEDULER_HEADROOM. With PREEMPT, the first queued room pauses the lowest priority
+    downloading room below it when MAX_ACTIVE_DOWNLOADS is all that keeps it out, one at a time.
+    A paused room's loop stops at the next segment, finishes its part but keeps the session's
+    journal, and queues again; once back in it continues that session from the chunklist. Every SCHEDULER_CHECK_INTERVAL the CPU of this process
+    and its children is read; after SCHEDULER_OVERLOAD_CHECKS readings in a row over
+    SCHEDULER_CPU_LIMIT or BANDWIDTH_CAP_MBPS, the lowest priority downloading room is paused too
+    if some other room outranks it.
+    """
+
+    def __init__(self):
+        self.active = {}  # username -> downloader allowed to download
+        self.waiting = {}  # username -> (downloader, since)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.top_priority = 0  # of the downloading rooms, for outranked()
+        self.cpu = 0.0  # fraction of all cores in use
+        self.last_cpu = None
+        self.overloaded_checks = 0
+        self.preemptions = 0
+
+    def admit(self, downloader):
+        username = downloader.username
+        with self.lock:
+            if self.active.get(username) is downloader:
+                return True
+            since = self.waiting[username][1] if username in self.waiting else time.monotonic()
+            self.waiting[username] = (downloader, since)
+            self._start()
+            first = max(self.waiting.values(), key=lambda entry: (entry[0].priority, -entry[1]))[0]
+            if first is not downloader:
+                return False
+            under_cap = not MAX_ACTIVE_DOWNLOADS or len(self.active) < MAX_ACTIVE_DOWNLOADS
+            if under_cap and self._load_ok():
+                del self.waiting[username]
+                self.active[username] = downloader
+                downloader.preempted = False
+                self._update_top()
+                return True
+            if PREEMPT and not under_cap and self._load_ok():
+                # Only the count is in the way, so a paused room frees the slot right away. Under
+                # CPU or bandwidth load that is the monitor's call, after SCHEDULER_OVERLOAD_CHECKS.
+                self._preempt_for(downloader)
+            return False
+
+    def release(self, downloader):
+        username = downloader.username
+        with self.lock:
+            if self.active.get(username) is downloader:
+                del self.active[username]
+                self._update_top()
+            if username in self.waiting and self.waiting[username][0] is downloader:
+                del self.waiting[username]
+
+    def outranked(self, username):
+        """True if another downloading room has a higher priority, e.g. to skip this room's checks first."""
+        downloader = self.active.get(username)
+        return downloader is not None and downloader.priority < self.top_priority
+
+    def _update_top(self):
+        self.top_priority = max((d.priority for d in self.active.values()), default=0)
+
+    def _load_ok(self):
+        if not self.active:
+            return True
+        if SCHEDULER_CPU_LIMIT and self.cpu > SCHEDULER_CPU_LIMIT * SCHEDULER_HEADROOM:
+            return False
+        return not (BANDWIDTH_CAP_MBPS and BANDWIDTH_GOVERNOR.mbps > BANDWIDTH_CAP_MBPS * SCHEDULER_HEADROOM)
+
+    def _preempt_for(self, downloader):
+        if any(d.preempted for d in self.active.values()):
+            return  # one room is already making way
+        self._pause_lowest(downloader.priority, f"for {downloader.username}")
+
+    def _pause_lowest(self, below, reason):
+        candidates = [d for d in self.active.values() if d.priority < below and d.running]
+        if not candidates:
+            return
+        room = min(candidates, key=lambda d: d.priority)
+        room.preempted = True
+        self.preemptions += 1
+        METRICS.inc("preemptions_total", room.username)
+        print(f"[*] Pausing {room.username} (priority {room.priority}) {reason}")
+
+    def _start(self):
+        if self.thread is None and (SCHEDULER_CPU_LIMIT or BANDWIDTH_CAP_MBPS):
+            self.thread = threading.Thread(target=self._run, daemon=True, name="DownloadScheduler")
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(SCHEDULER_CHECK_INTERVAL)
+            try:
+                self.check(SCHEDULER_CHECK_INTERVAL)
+            except Exception as e:
+                print(f"[!] Download scheduler: {e}")
+
+    def check(self, elapsed):
+        total = cpu_seconds()
+        if total is not None and self.last_cpu is not None:
+            self.cpu = max(total - self.last_cpu, 0) / elapsed / (os.cpu_count() or 1)
+        self.last_cpu = total
+        overloaded = ((SCHEDULER_CPU_LIMIT and self.cpu > SCHEDULER_CPU_LIMIT)
+                      or (BANDWIDTH_CAP_MBPS and BANDWIDTH_GOVERNOR.mbps > BANDWIDTH_CAP_MBPS))
+        self.overloaded_checks = self.overloaded_checks + 1 if overloaded else 0
+        with self.lock:
+            self._update_top()
+            if PREEMPT and self.overloaded_checks >= SCHEDULER_OVERLOAD_CHECKS:
+                self.overloaded_checks = 0
+                if not any(d.preempted for d in self.active.values()):
+                    self._pause_lowest(self.top_priority, f"to take load off ({self.cpu:.0%} CPU, {BANDWIDTH_GOVERNOR.mbps:.1f} Mbps)")
+
+    def stats_text(self):
+        with self.lock:
+            active, waiting = len(self.active), len(self.waiting)
+        cap = f" of {MAX_ACTIVE_DOWNLOADS}" if MAX_ACTIVE_DOWNLOADS else ""
+        cpu = f", CPU {self.cpu:.0%}" if SCHEDULER_CPU_LIMIT else ""
+        return f"Scheduler: {active}{cap} downloading, {waiting} queued, {self.preemptions} paused so far{cpu}"
+
+SCHEDULER = DownloadScheduler()
+
+HLS_SOURCE_PATTERN = re.compile(rb'hls_source(?:\\u0022|")\s*:\s*(?:\\u0022|")(.*?)(?:\\u0022|")')
+
+class DossierScanner:
+    """Finds hls_source in a room page while it downloads, so the rest of the page is never read.
+
+    Looks for the hls_source key directly instead of regexing out, unescaping and parsing the
+    whole initialRoomDossier. If the page ends without it, result() falls back to
+    parse_hls_source on what was read, for the usual errors.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = -1
+        self.hls_source = None
+
+    def feed(self, chunk):
+        """Add the next piece of the page; True once hls_source has been found."""
+        self.buffer += chunk
+        if self.start < 0:
+            self.start = self.buffer.find(b"hls_source", max(0, len(self.buffer) - len(chunk) - 10))
+        while self.start >= 0:
+            match = HLS_SOURCE_PATTERN.match(self.buffer, self.start)
+            if match:
+                self.hls_source = match.group(1).decode("unicode_escape")
+                return True
+            if len(self.buffer) - self.start < 4096:
+                return False  # the value may still be on its way
+            # Some other mention of hls_source; try the next one.
+            self.start = self.buffer.find(b"hls_source", self.start + 1)
+        return False
+
+    def result(self):
+        if self.hls_source is None:
+            return parse_hls_source(self.buffer.decode("utf-8", "replace"))
+        if not self.hls_source:
+            raise RoomOffline("No hls_source found in JSON")
+        return self.hls_source
+
+def resolve_hls_source(page_url):
+    """The room's hls_source, from HLS_CACHE if it's fresh, else from the room page."""
+    username = extract_username_from_url(page_url)
+    hls_url = HLS_CACHE.hls_source(username)
+    if hls_url is None:
+        hls_url = extract_hls_url(page_url)
+        HLS_CACHE.put_source(username, hls_url)
+    return hls_url
+
+async def async_resolve_hls_source(engine, page_url):
+    username = extract_username_from_url(page_url)
+    hls_url = HLS_CACHE.hls_source(username)
+    if hls_url is None:
+        hls_url = await async_extract_hls_url(engine, page_url)
+        HLS_CACHE.put_source(username, hls_url)
+    return hls_url
+
+def extract_hls_url(page_url):
+    res = HTTP_POOL.get(page_url, kind="page", stream=True)
+    try:
+        res.raise_for_status()
+        scanner = DossierScanner()
+        for chunk in res.iter_content(PAGE_CHUNK):
+            if scanner.feed(chunk):
+                break
+        return scanner.result()
+    finally:
+        res.close()
+
+def parse_hls_source(html):
+    match = re.search(r'window\.initialRoomDossier\s*=\s*"({.+?})";', html)
+    if not match:
+        raise Exception("Could not find stream JSON")
+    json_str = bytes(match.group(1), "utf-8").decode("unicode_escape")
+    data = json.loads(json_str)
+    hls_url = data.get("hls_source")
+    if not hls_url:
+        raise RoomOffline("No hls_source found in JSON")
+    return hls_url
+
+def get_variants(m3u8_url):
+    """The variants a master playlist lists (cached per HLS_CACHE_TTL), [] if m3u8_url is a media playlist."""
+    variants = HLS_CACHE.variants(m3u8_url)
+    if variants is None:
+        res = HTTP_POOL.get(m3u8_url, kind="playlist")
+        HLS_CACHE.check(res, m3u8_url)
+        variants = parse_master_playlist(m3u8_url, res.text)
+        HLS_CACHE.put_variants(m3u8_url, variants)
+    return variants
+
+def get_ts_urls(chunklist_url):
+    """Every segment URL the chunklist currently lists, oldest first."""
+    res = HTTP_POOL.get(chunklist_url, kind="playlist")
+    HLS_CACHE.check(res, chunklist_url)
+    return pick_ts_urls(chunklist_url, res.text)
+
+async def async_extract_hls_url(engine, page_url):
+    async with engine.request(page_url, kind="page") as res:
+        res.raise_for_status()
+        scanner = DossierScanner()
+        async for chunk in res.content.iter_chunked(PAGE_CHUNK):
+            if scanner.feed(chunk):
+                break
+    return scanner.result()
+
+async def async_get_variants(engine, m3u8_url):
+    variants = HLS_CACHE.variants(m3u8_url)
+    if variants is None:
+        async with engine.request(m3u8_url, kind="playlist") as res:
+            HLS_CACHE.check(res, m3u8_url)
+            text = await res.text()
+        variants = parse_master_playlist(m3u8_url, text)
+        HLS_CACHE.put_variants(m3u8_url, variants)
+    return variants
+
+async def async_get_ts_urls(engine, chunklist_url):
+    async with engine.request(chunklist_url, kind="playlist") as res:
+        HLS_CACHE.check(res, chunklist_url)
+        text = await res.text()
+    return pick_ts_urls(chunklist_url, text)
+
+Variant = namedtuple("Variant", "bandwidth height url")
+
+def parse_master_playlist(m3u8_url, text):
+    """[Variant] from the #EXT-X-STREAM-INF entries of a master playlist, lowest bitrate first."""
+    variants = []
+    info = None
+    for line in text.strip().splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            info = line
+        elif line and not line.startswith("#") and (info is not None or line.startswith("chunklist_")):
+            bandwidth = re.search(r"[:,]BANDWIDTH=(\d+)", info or "")
+            resolution = re.search(r"RESOLUTION=\d+x(\d+)", info or "")
+            variants.append(Variant(
+                int(bandwidth.group(1)) if bandwidth else 0,
+                int(resolution.group(1)) if resolution else 0,
+                urljoin(m3u8_url.rsplit("/", 1)[0] + "/", line),
+            ))
+            info = None
+    variants.sort(key=lambda variant: (variant.bandwidth, variant.height))
+    return variants
+
+def normalize_quality(quality):
+    """"max", "auto" or a height (720, "720", "720p"); raises ValueError for anything else."""
+    value = str(quality).strip().lower()
+    if value in ("max", "auto"):
+        return value
+    if value.endswith("p"):
+        value = value[:-1]
+    if not value.isdigit():
+        raise ValueError(f"Quality must be max, auto or a height like 720, not {quality!r}")
+    return int(value)
+
+def variant_position(variants, quality, step=0):
+    """Index into `variants` for a quality policy, `step` variants lower for the bandwidth governor."""
+    best = len(variants) - 1
+    if isinstance(quality, int):
+        fitting = [i for i, variant in enumerate(variants) if variant.height and variant.height <= quality]
+        # Nothing that small: the smallest there is.
+        best = fitting[-1] if fitting else 0
+    return max(best - step, 0)
+
+def choose_variant(variants, quality, step=0):
+    return variants[variant_position(variants, quality, step)]
+
+def describe_variant(variant):
+    if variant is None:
+        return "-"
+    height = f"{variant.height}p " if variant.height else ""
+    return f"{height}{variant.bandwidth / 1e6:.1f} Mbps"
+
+def pick_ts_urls(playlist_url, text):
+    lines = text.strip().splitlines()
+    ts_files = [line for line in lines if line and not line.startswith("#")]
+    if not ts_files:
+        raise Exception("No .ts files found in playlist")
+    return [urljoin(playlist_url.rsplit("/", 1)[0] + "/", ts_file) for ts_file in ts_files]
+
+
+def parse_media_playlist(playlist_url, text):
+    """Return (target_duration, [(media_sequence, ts_url), ...]) for a media playlist."""
+    target_duration = CHECK_INTERVAL
+    media_sequence = 0
+    ts_files = []
+    for line in text.strip().splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-TARGETDURATION:"):
+            target_duration = float(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            media_sequence = int(line.split(":", 1)[1])
+        elif line and not line.startswith("#"):
+            ts_files.append(urljoin(playlist_url.rsplit("/", 1)[0] + "/", line))
+    return target_duration, [(media_sequence + i, ts_url) for i, ts_url in enumerate(ts_files)]
+
+def segment_index(media_sequence, ts_url):
+    """Segment number used for logs and file names; falls back to the media sequence."""
+    try:
+        return parse_base_and_index(ts_url)[1]
+    except Exception:
+        return media_sequence
+
+def parse_base_and_index(ts_url):
+    match = re.search(r"(.+?_)(\d+)\.ts", ts_url)
+    if not match:
+        raise Exception("Could not parse .ts base and index")
+    return match.group(1), int(match.group(2))
+
+def extract_username_from_url(url):
+    parsed = urlparse(url)
+    parts = parsed.path.strip("/").split("/")
+    return parts[0] if parts else "unknown"
+
+def get_output_folder(username):
+    date_str = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+    folder = os.path.join("Downloads", username, date_str)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def load_list():
+    """[(url, infinite, quality, priority)] from an older version's list.txt; the oldest only have url|infinite."""
+    if not LIST_FILE or not os.path.exists(LIST_FILE):
+        return []
+    rooms = []
+    with open(LIST_FILE, "r") as f:
+        for line in f:
+            fields = line.strip().split("|")
+            if not fields[0]:
+                continue
+            fields += [""] * (4 - len(fields))
+            try:
+                rooms.append((fields[0], fields[1] == "1", fields[2] or QUALITY, int(fields[3] or 0)))
+            except (ValueError, IndexError):
+                # A truncated or hand-edited line; skip it like one without a url.
+                print(f"[!] Skipping a malformed line in {LIST_FILE}: {line.strip()}")
+    return rooms
+
+class RoomStore:
+    """The room list: url, Infinite, quality, priority and when each room was last seen live.
+
+    ROOM_STORE_FILE gets one JSON line per changed room, {"room": <user>, "url": ..., ...}, the
+    last line of a room winning and {"room": <user>, "removed": true} dropping it. Changes only
+    touch the in-memory copy; a background timer appends them in one write every ROOM_STORE_FLUSH
+    seconds, and a setting that didn't actually change isn't written at all. Once the file holds
+    ROOM_STORE_COMPACT lines per room it is rewritten with one line each. A shard worker has no
+    ROOM_STORE_FILE, its supervisor keeps the list. Rooms only get in through put(); update() on
+    a room that isn't there (e.g. a status report racing a removal) does nothing.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = None  # username -> {"url": ..., "infinite": ..., ...}, read on first use
+        self.dirty = set()
+        self.lines = 0
+        self.timer = None
+
+    def _load(self):
+        if self.rooms is not None:
+            return
+        self.rooms = {}
+        if not ROOM_STORE_FILE:
+            return
+        if os.path.exists(ROOM_STORE_FILE):
+            with open(ROOM_STORE_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # torn last line from a crash
+                    self.lines += 1
+                    try:
+                        entry = json.loads(line)
+                        username = entry.pop("room")
+                    except (ValueError, KeyError, AttributeError):
+                        continue
+                    if entry.get("removed"):
+                        self.rooms.pop(username, None)
+                    elif "url" in entry:
+                        self.rooms[username] = entry
+        else:
+            for url, infinite, quality, priority in load_list():
+                username = extract_username_from_url(url)
+                self.rooms[username] = {"url": url, "infinite": infinite, "quality": normalize_quality(quality),
+                                        "priority": priority}
+                self.dirty.add(username)
+            if self.rooms:
+                print(f"[*] Importing {len(self.rooms)} rooms from {LIST_FILE} into {ROOM_STORE_FILE}")
+                self._schedule()
+
+    def entries(self):
+        """[(username, settings)] in the order the rooms were added."""
+        with self.lock:
+            self._load()
+            return [(username, dict(entry)) for username, entry in self.rooms.items()]
+
+    def get(self, username):
+        with self.lock:
+            self._load()
+            entry = self.rooms.get(username)
+            return dict(entry) if entry is not None else None
+
+    def put(self, username, url, **fields):
+        """Add a room, or change the settings of one already in the list."""
+        with self.lock:
+            self._load()
+            self._change(username, self.rooms.get(username, {}), {"url": url, **fields})
+
+    def update(self, username, **fields):
+        with self.lock:
+            self._load()
+            entry = self.rooms.get(username)
+            if entry is not None:
+                self._change(username, entry, fields)
+
+    def _change(self, username, entry, fields):
+        changed = dict(entry, **fields)
+        if changed == entry:
+            return
+        self.rooms[username] = changed
+        self.dirty.add(username)
+        self._schedule()
+
+    def remove(self, username):
+        with self.lock:
+            self._load()
+            if self.rooms.pop(username, None) is not None:
+                self.dirty.add(username)
+                self._schedule()
+
+    def _schedule(self):
+        if not ROOM_STORE_FILE:
+            self.dirty.clear()
+            return
+        if self.timer is None:
+            self.timer = threading.Timer(ROOM_STORE_FLUSH, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if not self.dirty or not ROOM_STORE_FILE:
+                return
+            dirty, self.dirty = self.dirty, set()
+            try:
+                if self.lines + len(dirty) > ROOM_STORE_COMPACT * (len(self.rooms) + 10):
+                    self._compact()
+                else:
+                    self._append(dirty)
+            except OSError as e:
+                print(f"[!] Could not save the room list: {e}")
+                self.dirty |= dirty
+
+    def _line(self, username):
+        entry = self.rooms.get(username)
+        return json.dumps({"room": username, **entry} if entry is not None else {"room": username, "removed": True}) + "\n"
+
+    def _append(self, dirty):
+        torn = os.path.exists(ROOM_STORE_FILE) and os.path.getsize(ROOM_STORE_FILE) and not journal_ends_with(ROOM_STORE_FILE, b"\n")
+        with open(ROOM_STORE_FILE, "a", encoding="utf-8") as f:
+            f.write(("\n" if torn else "") + "".join(self._line(username) for username in dirty))
+        self.lines += len(dirty)
+
+    def _compact(self):
+        temp_path = ROOM_STORE_FILE + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("".join(self._line(username) for username in self.rooms))
+        os.replace(temp_path, ROOM_STORE_FILE)
+        self.lines = len(self.rooms)
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.flush()
+
+ROOM_STORE = RoomStore()
+atexit.register(ROOM_STORE.close)
+
+def store_room(downloader, add=False):
+    """Save a room's settings. Only add puts a room in the list; otherwise one removed meanwhile stays out."""
+    settings = {"infinite": downloader.infinite, "quality": downloader.quality, "priority": downloader.priority}
+    if add:
+        ROOM_STORE.put(downloader.username, downloader.url, **settings)
+    else:
+        ROOM_STORE.update(downloader.username, **settings)
+
+class StreamManager:
+    """Owns every room's downloader and its last known state, with or without a GUI.
+
+    Downloaders report to it the way they used to report to the GUI (update_status,
+    update_segment, ...); those just overwrite a field in the room's dict, so they are cheap
+    and safe from any thread. The control API and the GUI read and act through it.
+    """
+
+    def __init__(self):
+        self.downloaders = {}
+        self.rooms = {}  # username -> {"status": ..., "segment": ..., "prefetch": ...}
+        self.lock = threading.Lock()
+
+    def load(self):
+        for username, room in ROOM_STORE.entries():
+            self.rooms[username] = {"status": "Stopped", "segment": "-", "prefetch": "-"}
+            self.downloaders[username] = make_downloader(room["url"], self, room.get("infinite", False),
+                                                         room.get("quality", QUALITY), room.get("priority", 0))
+
+    # Called by the downloaders.
+    def update_status(self, username, status):
+        room = self.rooms.get(username)
+        if room is not None:
+            room["status"] = status
+            if status == "Downloading":
+                ROOM_STORE.update(username, last_seen=int(time.time()))
+
+    def update_segment(self, username, segment):
+        room = self.rooms.get(username)
+        if room is not None:
+            room["segment"] = str(segment)
+
+    def update_prefetch(self, username, in_flight):
+        room = self.rooms.get(username)
+        if room is not None:
+            room["prefetch"] = f"{in_flight}/{PREFETCH_WINDOW}"
+
+    def update_infinite(self, username, state):
+        with self.lock:
+            if username in self.downloaders:
+                ROOM_STORE.update(username, infinite=state)
+
+    def replace_downloader(self, username, new_downloader):
+        """Swap in a room's new downloader; False if the room was removed meanwhile, so it must not start."""
+        with self.lock:
+            if username not in self.downloaders:
+                return False
+            self.downloaders[username] = new_downloader
+        store_room(new_downloader)
+        return True
+
+    # Called by the control API.
+    def add(self, url, infinite=False, start=True, quality=QUALITY, priority=0):
+        if not url.startswith("http"):
+            raise ValueError("Please enter a valid stream URL.")
+        username = extract_username_from_url(url)
+        with self.lock:
+            if username in self.downloaders:
+                raise ValueError(f"Stream for '{username}' is already in the list.")
+            downloader = make_downloader(url, self, infinite, quality, int(priority))
+            METRICS.remember(username)
+            self.rooms[username] = {"status": "Initializing" if start else "Stopped", "segment": "-", "prefetch": "-"}
+            self.downloaders[username] = downloader
+        store_room(downloader, add=True)
+        if start:
+            downloader.start()
+        return username
+
+    def remove(self, username):
+        with self.lock:
+            downloader = self.downloaders.pop(username)
+            self.rooms.pop(username, None)
+        ROOM_STORE.remove(username)
+        downloader.stop()
+        METRICS.forget(username)
+
+    def start(self, username):
+        downloader = self.downloaders[username]
+        if not downloader.running:
+            new_downloader = make_downloader(downloader.url, self, downloader.infinite, downloader.quality, downloader.priority)
+            if self.replace_downloader(username, new_downloader):
+                new_downloader.start()
+
+    def stop(self, username):
+        self.downloaders[username].stop()
+
+    def restart(self, username):
+        self.downloaders[username].restart()
+
+    def toggle_infinite(self, username):
+        self.downloaders[username].toggle_infinite()
+
+    def configure(self, username, quality=None, priority=None):
+        """Change a room's quality policy and/or priority; a running room switches variant on its next segment."""
+        downloader = self.downloaders[username]
+        if quality is not None:
+            downloader.quality = normalize_quality(quality)
+            BANDWIDTH_GOVERNOR.forget(username)
+            downloader.variant_stale = True
+        if priority is not None:
+            downloader.priority = int(priority)
+        store_room(downloader)
+
+    def start_all(self):
+        for username in list(self.downloaders):
+            self.start(username)
+
+    def stop_all(self):
+        for downloader in list(self.downloaders.values()):
+            downloader.stop()
+
+    def clear_finished(self):
+        for username in list(self.downloaders):
+            if self.rooms.get(username, {}).get("status") in ("Stream ended", "Stopped"):
+                self.remove(username)
+
+    def room_stats(self, username):
+        downloader = self.downloaders[username]
+        room = self.rooms.get(username, {})
+        writer = downloader.writer
+        missing, corrupt = writer.gap_counts() if writer is not None else (0, 0)
+        return {
+            "username": username,
+            "url": downloader.url,
+            "status": room.get("status", "-"),
+            "segment": room.get("segment", "-"),
+            "prefetch": room.get("prefetch", "-"),
+            "infinite": downloader.infinite,
+            "quality": str(downloader.quality),
+            "variant": describe_variant(downloader.variant),
+            "priority": downloader.priority,
+            "running": downloader.running,
+            "retries": downloader.retries,
+            "requests": downloader.requests,
+            "segments_fetched": downloader.segments_fetched,
+            "requests_per_segment": round(downloader.requests / downloader.segments_fetched, 2) if downloader.segments_fetched else None,
+            "missing_segments": missing,
+            "corrupt_segments": corrupt,
+            "last_seen": (ROOM_STORE.get(username) or {}).get("last_seen"),
+        }
+
+    def all_stats(self):
+        return [self.room_stats(username) for username in list(self.downloaders)]
+
+    def global_stats(self):
+        running = sum(1 for downloader in list(self.downloaders.values()) if downloader.running)
+        return {
+            "rooms": len(self.downloaders),
+            "running": running,
+            "pool": HTTP_POOL.stats_text(),
+            "rate_limit": RATE_LIMITER.stats_text(),
+            "memory": memory_stats_text(running),
+            "bandwidth": BANDWIDTH_GOVERNOR.stats_text(),
+            "muxers": MUXER_POOL.stats_text(),
+            "scheduler": SCHEDULER.stats_text(),
+            "http_429": METRICS.total("http_errors_total", code="429"),
+        }
+
+    def metrics_text(self):
+        return METRICS.render()
+
+    def metrics_snapshot(self):
+        return METRICS.snapshot(advance=False)
+
+    def shutdown(self):
+        self.stop_all()
+
+class Shard:
+    """One worker process of a ShardSupervisor: a headless instance with its own port, proxy and HTTP pool."""
+
+    def __init__(self, number, options):
+        self.number = number
+        self.port = (SHARD_BASE_PORT or API_PORT + 1) + number
+        self.proxy = options.get("proxy", "")
+        self.source_address = options.get("source_address", "")
+        self.client = ApiClient("127.0.0.1", self.port)
+        self.bandwidth_cap = 0  # this shard's part of BANDWIDTH_CAP_MBPS
+        self.max_active = 0  # ...and of MAX_ACTIVE_DOWNLOADS
+        self.process = None
+        self.rooms = set()
+        self.last_429 = 0
+        self.last_cpu = None
+        self.hot = False
+
+    def spawn(self):
+        script = [] if getattr(sys, "frozen", False) else [os.path.abspath(__file__)]
+        args = [sys.executable] + script + ["--headless", "--port", str(self.port), "--shard", str(self.number),
+                                            "--bandwidth-cap", str(self.bandwidth_cap), "--max-active", str(self.max_active)]
+        if self.proxy:
+            args += ["--proxy", self.proxy]
+        if self.source_address:
+            args += ["--source-address", self.source_address]
+        self.process = subprocess.Popen(args)
+        self.last_429 = 0
+        self.last_cpu = None
+        deadline = time.time() + 30
+        while not self.client.alive():
+            if self.process.poll() is not None or time.time() > deadline:
+                raise RuntimeError(f"Shard {self.number} did not come up")
+            time.sleep(0.2)
+
+    def cpu_seconds(self):
+        """CPU time of the shard and its ffmpeg/checker children so far, None without psutil."""
+        return cpu_seconds(self.process.pid) if self.process is not None else None
+
+    def describe(self):
+        via = self.proxy or self.source_address or "direct"
+        return f"shard {self.number} ({via})"
+
+class ShardSupervisor:
+    """Spreads the rooms over SHARD_COUNT headless worker processes and looks like one StreamManager.
+
+    Each shard has its own control API port, HTTP pool, rate limiter and SHARDS entry (proxy or
+    source address), so both the request load and the ffmpeg/checking work are split up. The
+    supervisor keeps the room list and serves the combined view on the usual API, so the GUI works
+    unchanged. New rooms go to the shard with the fewest rooms; every SHARD_BALANCE_INTERVAL a
+    shard that drew SHARD_429_LIMIT 429s or used up its CPU share hands one room to the calmest other shard.
+    """
+
+    def __init__(self, count):
+        self.shards = [Shard(number, SHARDS[number] if number < len(SHARDS) else {}) for number in range(count)]
+        for shard in self.shards:
+            shard.bandwidth_cap = BANDWIDTH_CAP_MBPS / count
+            shard.max_active = -(-MAX_ACTIVE_DOWNLOADS // count)
+        self.urls = {}  # username -> [url, infinite, quality, priority], what the room list holds
+        self.assignment = {}  # username -> Shard
+        self.lock = threading.Lock()
+        self.running = True
+        self.last_balance = time.time()
+
+    def load(self):
+        for shard in self.shards:
+            shard.spawn()
+            print(f"[*] Started {shard.describe()} on port {shard.port}")
+        atexit.register(self.terminate)
+        for username, room in ROOM_STORE.entries():
+            self._place(room["url"], room.get("infinite", False), False,
+                        quality=room.get("quality", QUALITY), priority=room.get("priority", 0))
+        threading.Thread(target=self._supervise, daemon=True, name="ShardSupervisor").start()
+
+    def _pick_shard(self, exclude=None):
+        candidates = [shard for shard in self.shards if shard is not exclude and shard.process.poll() is None]
+        if not candidates:
+            raise ValueError("No shard is running")
+        return min(candidates, key=lambda shard: (shard.hot, len(shard.rooms)))
+
+    def _place(self, url, infinite, start, shard=None, quality=QUALITY, priority=0):
+        username = extract_username_from_url(url)
+        shard = shard or self._pick_shard()
+        room = shard.client.add(url, infinite, start, quality, priority)
+        with self.lock:
+            self.urls[username] = [url, infinite, room["quality"], room["priority"]]
+            self.assignment[username] = shard
+            shard.rooms.add(username)
+        return username
+
+    def _save(self, username):
+        with self.lock:
+            entry = self.urls.get(username)
+        if entry is None:
+            ROOM_STORE.remove(username)
+        else:
+            url, infinite, quality, priority = entry
+            ROOM_STORE.put(username, url, infinite=infinite, quality=normalize_quality(quality), priority=priority)
+
+    def _shard_of(self, username):
+        with self.lock:
+            return self.assignment[username]
+
+    # Same interface as StreamManager, used by the control API.
+    def add(self, url, infinite=False, start=True, quality=QUALITY, priority=0):
+        if not url.startswith("http"):
+            raise ValueError("Please enter a valid stream URL.")
+        username = extract_username_from_url(url)
+        if username in self.urls:
+            raise ValueError(f"Stream for '{username}' is already in the list.")
+        self._place(url, infinite, start, quality=quality, priority=priority)
+        self._save(username)
+        return username
+
+    def remove(self, username):
+        shard = self._shard_of(username)
+        shard.client.remove(username)
+        with self.lock:
+            del self.assignment[username]
+            del self.urls[username]
+            shard.rooms.discard(username)
+        self._save(username)
+
+    def start(self, username):
+        self._shard_of(username).client.action(username, "start")
+
+    def stop(self, username):
+        self._shard_of(username).client.action(username, "stop")
+
+    def restart(self, username):
+        self._shard_of(username).client.action(username, "restart")
+
+    def toggle_infinite(self, username):
+        room = self._shard_of(username).client.action(username, "infinite")
+        with self.lock:
+            self.urls[username][1] = room["infinite"]
+        self._save(username)
+
+    def configure(self, username, quality=None, priority=None):
+        room = self._shard_of(username).client.configure(username, quality, priority)
+        with self.lock:
+            self.urls[username][2:] = [room["quality"], room["priority"]]
+        self._save(username)
+
+    def start_all(self):
+        for shard in self.shards:
+            shard.client.fleet_action("start_all")
+
+    def stop_all(self):
+        for shard in self.shards:
+            try:
+                shard.client.fleet_action("stop_all")
+            except (requests.RequestException, ValueError):
+                pass
+
+    def clear_finished(self):
+        for username in [room["username"] for room in self.all_stats() if room["status"] in ("Stream ended", "Stopped")]:
+            self.remove(username)
+
+    def room_stats(self, username):
+        shard = self._shard_of(username)
+        room = shard.client.room(username)
+        room["shard"] = shard.number
+        return room
+
+    def all_stats(self):
+        rooms = []
+        for shard in self.shards:
+            try:
+                shard_rooms = shard.client.rooms()
+            except (requests.RequestException, ValueError):
+                continue
+            for room in shard_rooms:
+                room["shard"] = shard.number
+                rooms.append(room)
+        return rooms
+
+    def global_stats(self):
+        total = {"rooms": 0, "running": 0, "http_429": 0}
+        lines = {"pool": [], "rate_limit": [], "memory": [], "bandwidth": [], "muxers": [], "scheduler": []}
+        shards = []
+        for shard in self.shards:
+            try:
+                stats = shard.client.stats()
+            except (requests.RequestException, ValueError) as e:
+                shards.append({"shard": shard.number, "error": str(e)})
+                continue
+            for key in total:
+                total[key] += stats.get(key, 0)
+            for key in lines:
+                lines[key].append(f"[{shard.number}] {stats[key]}")
+            shards.append({"shard": shard.number, "via": shard.describe(), "rooms": stats["rooms"],
+                           "running": stats["running"], "http_429": stats["http_429"], "hot": shard.hot})
+        total.update({key: "\n".join(value) for key, value in lines.items()})
+        total["shards"] = shards
+        return total
+
+    def metrics_text(self):
+        """Every shard's /metrics with a shard label added to each series."""
+        lines = []
+        seen_meta = set()
+        for shard in self.shards:
+            try:
+                text = shard.client.session.get(f"http://127.0.0.1:{shard.port}/metrics", timeout=5).text
+            except requests.RequestException:
+                continue
+            for line in text.splitlines():
+                if line.startswith("#"):
+                    if line not in seen_meta:
+                        seen_meta.add(line)
+                        lines.append(line)
+                elif "{" in line:
+                    name, rest = line.split("{", 1)
+                    lines.append(f'{name}{{shard="{shard.number}"{"," if not rest.startswith("}") else ""}{rest}')
+                elif line:
+                    name, value = line.split(" ", 1)
+                    lines.append(f'{name}{{shard="{shard.number}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def metrics_snapshot(self):
+        snapshots = {}
+        for shard in self.shards:
+            try:
+                snapshots[str(shard.number)] = shard.client._call("GET", "metrics")
+            except (requests.RequestException, ValueError):
+                pass
+        return {"shards": snapshots}
+
+    def shutdown(self):
+        self.running = False
+        self.stop_all()
+        self.terminate()
+
+    def terminate(self):
+        for shard in self.shards:
+            if shard.process is not None and shard.process.poll() is None:
+                shard.process.terminate()
+
+    # Health checks and rebalancing.
+    def _supervise(self):
+        while self.running:
+            time.sleep(1)
+            for shard in self.shards:
+                if self.running and shard.process.poll() is not None:
+                    try:
+                        self._respawn(shard)
+                    except Exception as e:
+                        print(f"[!] Could not restart {shard.describe()}: {e}")
+            if time.time() - self.last_balance >= SHARD_BALANCE_INTERVAL:
+                try:
+                    self.rebalance(time.time() - self.last_balance)
+                except Exception as e:
+                    print(f"[!] Shard rebalancing failed: {e}")
+                self.last_balance = time.time()
+
+    def _respawn(self, shard):
+        print(f"[!] {shard.describe()} exited, restarting it")
+        try:
+            shard.spawn()
+        except RuntimeError as e:
+            print(f"[!] {e}")
+            return
+        with self.lock:
+            rooms = [self.urls[username] for username in shard.rooms]
+        for url, infinite, quality, priority in rooms:
+            # The journal lets rooms that were recording pick their session back up.
+            try:
+                shard.client.add(url, infinite, True, quality, priority)
+            except (requests.RequestException, ValueError) as e:
+                print(f"[!] Could not add {url} back to {shard.describe()}: {e}")
+
+    def rebalance(self, elapsed):
+        """Mark shards that are rate limited or CPU bound and move one room off each of them."""
+        fair_share = (os.cpu_count() or 1) / len(self.shards)
+        for shard in self.shards:
+            try:
+                throttled = shard.client.stats()["http_429"]
+            except (requests.RequestException, ValueError, KeyError):
+                continue
+            cpu = shard.cpu_seconds()
+            cores = (cpu - shard.last_cpu) / elapsed if cpu is not None and shard.last_cpu is not None else 0
+            shard.hot = throttled - shard.last_429 >= SHARD_429_LIMIT or cores > fair_share * SHARD_CPU_LIMIT
+            shard.last_429 = throttled
+            shard.last_cpu = cpu
+        for shard in self.shards:
+            if not shard.hot or len(shard.rooms) < 2:
+                continue
+            try:
+                target = self._pick_shard(exclude=shard)
+            except ValueError:
+                continue
+            if target.hot:
+                continue
+            self.move(shard, target)
+
+    def move(self, source, target):
+        """Move the room that loses least: an idle one if there is one, else the one with the fewest segments."""
+        try:
+            rooms = source.client.rooms()
+        except (requests.RequestException, ValueError):
+            return
+        if not rooms:
+            return
+        room = min(rooms, key=lambda room: (room["running"] and room["status"] != "Offline (watching)", room["segments_fetched"]))
+        username = room["username"]
+        print(f"[*] Moving {username} from {source.describe()} to {target.describe()}")
+        try:
+            source.client.remove(username)
+        except (requests.RequestException, ValueError) as e:
+            print(f"[!] Could not take {username} off {source.describe()}: {e}")
+            return
+        settings = (room["url"], room["infinite"], room["running"])
+        try:
+            self._place(*settings, target, room["quality"], room["priority"])
+        except (requests.RequestException, ValueError) as e:
+            print(f"[!] {target.describe()} did not take {username} ({e}), putting it back")
+            try:
+                self._place(*settings, source, room["quality"], room["priority"])
+            except (requests.RequestException, ValueError) as e:
+                # Still listed under the source, so it is added again when that shard restarts.
+                print(f"[!] Could not put {username} back on {source.describe()}: {e}")
+            return
+        with self.lock:
+            source.rooms.discard(username)
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """Local JSON control API.
+
+    GET    /api/rooms                       all rooms with their stats
+    GET    /api/rooms/<user>                one room
+    GET    /api/stats                       pool, rate limiter and memory stats
+    GET    /api/metrics                     METRICS summary, same as a line of METRICS_FILE
+    GET    /metrics                         METRICS in Prometheus text format
+    POST   /api/rooms                       {"url": ..., "infinite": false, "start": true, "quality": "max", "priority": 0} adds (and starts) a room
+    POST   /api/rooms/<username>/settings   {"quality": "auto" | "max" | 720, "priority": 5}, either or both
+    DELETE /api/rooms/<user>                stops and removes a room
+    POST   /api/rooms/<user>/<action>       action: start, stop, restart, infinite
+    POST   /api/<action>                    action: start_all, stop_all, clear_finished
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _parts(self):
+        return self.path.split("?", 1)[0].strip("/").split("/")
+
+    def _handle(self, action):
+        manager = self.server.manager
+        try:
+            status, body = action(manager, self._parts())
+        except KeyError as e:
+            status, body = 404, {"error": f"No such room: {e.args[0]}"}
+        except ValueError as e:
+            status, body = 400, {"error": str(e)}
+        except Exception as e:
+            status, body = 500, {"error": str(e)}
+        self._send(status, body)
+
+    def do_GET(self):
+        if self._parts() == ["metrics"]:
+            data = self.server.manager.metrics_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        def action(manager, parts):
+            if parts == ["api", "rooms"]:
+                return 200, manager.all_stats()
+            if parts == ["api", "stats"]:
+                return 200, dict(manager.global_stats(), instance=instance_id())
+            if parts == ["api", "metrics"]:
+                return 200, manager.metrics_snapshot()
+            if len(parts) == 3 and parts[:2] == ["api", "rooms"]:
+                return 200, manager.room_stats(parts[2])
+            return 404, {"error": "Not found"}
+        self._handle(action)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+
+        def action(manager, parts):
+            if parts == ["api", "rooms"]:
+                body = json.loads(raw or b"{}")
+                username = manager.add(body.get("url", "").strip(), bool(body.get("infinite")), body.get("start", True),
+                                       body.get("quality", QUALITY), body.get("priority", 0))
+                return 201, manager.room_stats(username)
+            if len(parts) == 4 and parts[:2] == ["api", "rooms"] and parts[3] == "settings":
+                body = json.loads(raw or b"{}")
+                manager.configure(parts[2], body.get("quality"), body.get("priority"))
+                return 200, manager.room_stats(parts[2])
+            if len(parts) == 4 and parts[:2] == ["api", "rooms"]:
+                username, verb = parts[2], parts[3]
+                actions = {"start": manager.start, "stop": manager.stop, "restart": manager.restart, "infinite": manager.toggle_infinite}
+                if verb not in actions:
+                    return 404, {"error": f"Unknown action: {verb}"}
+                actions[verb](username)
+                return 200, manager.room_stats(username)
+            if len(parts) == 2 and parts[0] == "api" and parts[1] in ("start_all", "stop_all", "clear_finished"):
+                getattr(manager, parts[1])()
+                return 200, {"ok": True}
+            return 404, {"error": "Not found"}
+        self._handle(action)
+
+    def do_DELETE(self):
+        def action(manager, parts):
+            if len(parts) == 3 and parts[:2] == ["api", "rooms"]:
+                manager.remove(parts[2])
+                return 200, {"ok": True}
+            return 404, {"error": "Not found"}
+        self._handle(action)
+
+def instance_id():
+    """Which copy of the script this is, so a GUI only attaches to a daemon of its own copy."""
+    return os.path.abspath(sys.executable if getattr(sys, "frozen", False) else __file__)
+
+def free_port(host):
+    with socket.socket() as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+def start_api(manager, host=API_HOST, port=API_PORT):
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    server.manager = manager
+    threading.Thread(target=server.serve_forever, daemon=True, name="ControlAPI").start()
+    return server
+
+class ApiClient:
+    """Talks to a running daemon's control API; what the GUI uses for everything."""
+
+    def __init__(self, host=API_HOST, port=API_PORT):
+        self.base_url = f"http://{host}:{port}/api"
+        self.session = requests.Session()
+
+    def _call(self, method, path, **kwargs):
+        resp = self.session.request(method, f"{self.base_url}/{path}", timeout=5, **kwargs)
+        body = resp.json()
+        if resp.status_code >= 400:
+            raise ValueError(body.get("error", f"HTTP {resp.status_code}"))
+        return body
+
+    def alive(self):
+        return self.instance() is not None
+
+    def instance(self):
+        """instance_id() of the daemon on this port ("" for one too old to say), None if nothing answers."""
+        try:
+            return self._call("GET", "stats").get("instance", "")
+        except (requests.RequestException, ValueError):
+            return None
+
+    def rooms(self):
+        return self._call("GET", "rooms")
+
+    def room(self, username):
+        return self._call("GET", f"rooms/{username}")
+
+    def stats(self):
+        return self._call("GET", "stats")
+
+    def add(self, url, infinite=False, start=True, quality=QUALITY, priority=0):
+        return self._call("POST", "rooms", json={"url": url, "infinite": infinite, "start": start, "quality": quality, "priority": priority})
+
+    def configure(self, username, quality=None, priority=None):
+        return self._call("POST", f"rooms/{username}/settings", json={"quality": quality, "priority": priority})
+
+    def remove(self, username):
+        return self._call("DELETE", f"rooms/{username}")
+
+    def action(self, username, verb):
+        return self._call("POST", f"rooms/{username}/{verb}")
+
+    def fleet_action(self, verb):
+        return self._call("POST", verb)
+
+GUI_COLUMNS = ("username", "status", "segment", "prefetch", "quality", "infinite")
+QUALITY_CHOICES = ("max", "auto", 1080, 720, 480, 360)  # offered in the right-click menu
+
+class GUIEvents:
+    """Table updates for the Tk thread, applied in batches.
+
+    deque append/popleft are atomic, so producers never wait on a lock or on Tk, and Tk is
+    only ever touched from its own thread.
+    """
+
+    def __init__(self):
+        self.queue = deque()
+
+    def push(self, username, column, value):
+        self.queue.append((username, column, value))
+
+    def drain(self):
+        """Take everything queued so far, merged to the latest value per room and column."""
+        changes = {}
+        for _ in range(len(self.queue)):
+            username, column, value = self.queue.popleft()
+            changes.setdefault(username, {})[column] = value
+        return changes
+
+class DownloaderGUI:
+    """Tk front end; a client of the daemon's control API."""
+
+    def __init__(self, client):
+        self.client = client
+        self.window = tk.Tk()
+        self.window.title("Stream Downloader")
+        self.pool_text = ""
+
+        frame = tk.Frame(self.window)
+        frame.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+
+        tree_frame = tk.Frame(frame)
+        tree_frame.pack(fill=tk.BOTH, expand=True)
+
+        self.events = GUIEvents()
+        self.rows = {}  # username (the tree iid) -> current row values
+        self.tree = ttk.Treeview(tree_frame, columns=GUI_COLUMNS, show="headings")
+        self.tree.heading("username", text="Username")
+        self.tree.heading("status", text="Status")
+        self.tree.heading("segment", text="Current Segment")
+        self.tree.heading("prefetch", text="Prefetch")
+        self.tree.heading("quality", text="Quality")
+        self.tree.heading("infinite", text="Infinite")
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+
+        self.tree.bind("<Button-3>", self.show_context_menu)
+
+        input_frame = tk.Frame(self.window)
+        input_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        self.entry = tk.Entry(input_frame)
+        self.entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.add_button = tk.Button(input_frame, text="Add Stream", command=self.add_stream)
+        self.add_button.pack(side=tk.LEFT, padx=5)
+
+        self.clear_button = tk.Button(self.window, text="Clear Finished Tasks", command=self.clear_finished)
+        self.clear_button.pack()
+
+        control_frame = tk.Frame(self.window)
+        control_frame.pack(pady=(5, 10))
+        tk.Button(control_frame, text="Start All", command=self.start_all).pack(side=tk.LEFT, padx=5)
+        tk.Button(control_frame, text="Stop All", command=self.stop_all).pack(side=tk.LEFT, padx=5)
+
+        self.pool_label = tk.Label(self.window, anchor="w")
+        self.pool_label.pack(fill=tk.X, padx=10, pady=(0, 5))
+
+        self.context_menu = tk.Menu(self.window, tearoff=0)
+        self.context_menu.add_command(label="Stop Task", command=self.stop_task)
+        self.context_menu.add_command(label="Restart Task", command=self.restart_task)
+        self.context_menu.add_command(label="Toggle Infinite", command=self.toggle_infinite)
+        quality_menu = tk.Menu(self.context_menu, tearoff=0)
+        for quality in QUALITY_CHOICES:
+            label = f"{quality}p" if isinstance(quality, int) else quality.capitalize()
+            quality_menu.add_command(label=label, command=lambda quality=quality: self.set_quality(quality))
+        self.context_menu.add_cascade(label="Quality", menu=quality_menu)
+        self.context_menu.add_command(label="Remove Task", command=self.remove_task)
+
+        threading.Thread(target=self.poll_daemon, daemon=True, name="GUIPoll").start()
+        self.drain_events()
+        self.refresh_pool_stats()
+
+    def poll_daemon(self):
+        """Fetch the room list from the daemon and queue what changed since the last fetch for the Tk thread."""
+        last_stats = 0
+        shown = {}  # username -> column values last queued
+        while True:
+            try:
+                listed = set()
+                for room in self.client.rooms():
+                    username = room["username"]
+                    listed.add(username)
+                    segment = room["segment"]
+                    if room["missing_segments"] or room["corrupt_segments"]:
+                        segment += f" ({room['missing_segments']} missing, {room['corrupt_segments']} corrupt)"
+                    columns = {
+                        "status": room["status"],
+                        "segment": segment,
+                        "prefetch": room["prefetch"],
+                        "quality": f"{room['quality']}: {room['variant']}",
+                        "infinite": "On" if room["infinite"] else "Off",
+                    }
+                    # A row the table doesn't have yet gets all its columns.
+                    previous = shown.get(username, {}) if username in self.rows else {}
+                    for column, value in columns.items():
+                        if previous.get(column) != value:
+                            self.events.push(username, column, value)
+                    shown[username] = columns
+                for username in list(self.rows):
+                    if username not in listed:
+                        self.events.push(username, "removed", True)
+                for username in list(shown):
+                    if username not in listed:
+                        del shown[username]
+                if time.time() - last_stats >= POOL_STATS_INTERVAL:
+                    stats = self.client.stats()
+                    self.pool_text = (f"{stats['pool']}\n{stats['rate_limit']}\n{stats['memory']}\n"
+                                      f"{stats['bandwidth']}\n{stats['muxers']}\n{stats['scheduler']}")
+                    last_stats = time.time()
+            except Exception as e:
+                self.pool_text = f"Daemon not reachable: {e}"
+            time.sleep(DAEMON_POLL_INTERVAL)
+
+    def drain_events(self):
+        self.apply_events()
+        self.window.after(GUI_REFRESH_INTERVAL, self.drain_events)
+
+    def apply_events(self):
+        """Apply queued updates with one Tk call per room that actually changed."""
+        for username, columns in self.events.drain().items():
+            row = self.rows.get(username)
+            if columns.get("removed"):
+                if row is not None:
+                    self.tree.delete(username)
+                    del self.rows[username]
+                continue
+            if row is None:
+                row = [username, "-", "-", "-", "-", "Off"]
+                self.tree.insert("", "end", iid=username, values=row)
+                self.rows[username] = row
+            changed = False
+            for column, value in columns.items():
+                index = GUI_COLUMNS.index(column)
+                if row[index] != value:
+                    row[index] = value
+                    changed = True
+            if changed:
+                self.tree.item(username, values=row)
+
+    def refresh_pool_stats(self):
+        self.pool_label.config(text=self.pool_text)
+        self.window.after(POOL_STATS_INTERVAL * 1000, self.refresh_pool_stats)
+
+    def call(self, action, *args):
+        try:
+            return action(*args)
+        except ValueError as e:
+            messagebox.showerror("Stream Downloader", str(e))
+        except requests.RequestException as e:
+            messagebox.showerror("Daemon not reachable", str(e))
+
+    def add_stream(self):
+        url = self.entry.get().strip()
+        if not url and pyperclip is not None:
+            url = pyperclip.paste().strip()
+        self.call(self.client.add, url)
+
+    def clear_finished(self):
+        self.call(self.client.fleet_action, "clear_finished")
+
+    def start_all(self):
+        self.call(self.client.fleet_action, "start_all")
+
+    def stop_all(self):
+        self.call(self.client.fleet_action, "stop_all")
+
+    def show_context_menu(self, event):
+        item = self.tree.identify_row(event.y)
+        if item:
+            self.tree.selection_set(item)
+            self.context_menu.post(event.x_root, event.y_root)
+
+    def stop_task(self):
+        for item in self.tree.selection():
+            self.call(self.client.action, item, "stop")
+
+    def restart_task(self):
+        for item in self.tree.selection():
+            self.call(self.client.action, item, "restart")
+
+    def toggle_infinite(self):
+        for item in self.tree.selection():
+            self.call(self.client.action, item, "infinite")
+
+    def set_quality(self, quality):
+        for item in self.tree.selection():
+            self.call(self.client.configure, item, quality)
+
+    def remove_task(self):
+        for item in self.tree.selection():
+            self.call(self.client.remove, item)
+
+    def run(self):
+        self.window.mainloop()
+
+def make_manager(shards):
+    return ShardSupervisor(shards) if shards > 1 else StreamManager()
+
+def run_daemon(host, port, start_all=False, shards=1):
+    manager = make_manager(shards)
+    manager.load()
+    server = start_api(manager, host, port)
+    if shards <= 1:
+        # Shards write their own metrics.shardN.jsonl.
+        start_metrics_log()
+    print(f"[*] {manager.global_stats()['rooms']} rooms loaded, control API on http://{host}:{port}/api")
+    if start_all:
+        manager.start_all()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("[*] Stopping all rooms")
+        manager.shutdown()
+        server.shutdown()
+
+def main():
+    global PROXY, SOURCE_ADDRESS, ROOM_STORE_FILE, METRICS_FILE, PROBE_HISTORY_FILE, BANDWIDTH_CAP_MBPS, MAX_ACTIVE_DOWNLOADS, API_PORT
+    parser = argparse.ArgumentParser(description="Chaturbate stream downloader")
+    parser.add_argument("--headless", action="store_true", help="run without the GUI, controlled through the local API")
+    parser.add_argument("--start-all", action="store_true", help="with --headless, start every room from the list right away")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT, help="split the rooms across this many worker processes")
+    parser.add_argument("--shard", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--proxy", default=PROXY)
+    parser.add_argument("--source-address", default=SOURCE_ADDRESS)
+    parser.add_argument("--bandwidth-cap", type=float, default=BANDWIDTH_CAP_MBPS, metavar="MBPS")
+    parser.add_argument("--max-active", type=int, default=MAX_ACTIVE_DOWNLOADS, help="rooms allowed to download at once, 0 = no limit")
+    args = parser.parse_args()
+
+    PROXY, SOURCE_ADDRESS, BANDWIDTH_CAP_MBPS = args.proxy, args.source_address, args.bandwidth_cap
+    API_PORT = args.port  # shards take the ports after it
+    MAX_ACTIVE_DOWNLOADS = args.max_active
+    if args.shard is not None:
+        # A worker of a ShardSupervisor: the supervisor owns the room list, the rest gets a per-shard file.
+        ROOM_STORE_FILE = ""
+        METRICS_FILE = METRICS_FILE and f"{os.path.splitext(METRICS_FILE)[0]}.shard{args.shard}.jsonl"
+        PROBE_HISTORY_FILE = f"{os.path.splitext(PROBE_HISTORY_FILE)[0]}.shard{args.shard}.json"
+        args.shards = 1
+
+    if args.headless:
+        run_daemon(args.host, args.port, args.start_all, args.shards)
+        return
+
+    if tk is None:
+        sys.exit("tkinter is not available, run with --headless instead")
+    client = ApiClient(args.host, args.port)
+    running = client.instance()
+    if running == instance_id():
+        print(f"[*] Attaching the GUI to the daemon of this copy already running on http://{args.host}:{args.port}/api")
+    else:
+        if running is not None:
+            # Another copy (e.g. the one going through the VPN) has the port: don't take over its rooms.
+            API_PORT = free_port(args.host)
+            print(f"[!] Port {args.port} is in use by another copy ({running or 'an older version'}); "
+                  f"this one's API is on port {API_PORT} instead. Set API_PORT or --port to give each copy its own.")
+            client = ApiClient(args.host, API_PORT)
+        # No daemon of this copy running yet: host one in this process, the GUI still goes through its API.
+        manager = make_manager(args.shards)
+        manager.load()
+        start_api(manager, args.host, API_PORT)
+        if args.shards <= 1:
+            start_metrics_log()
+    DownloaderGUI(client).run()
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
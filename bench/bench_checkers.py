@@ -0,0 +1,79 @@
+"""Compare the in-memory MPEG-TS checker against the ffmpeg decode check on the same corpus.
+
+The corpus is either a folder of .ts segments (--corpus Downloads/someone/2025-01-01 00-00)
+or synthetic segments from the fake HLS server, a share of which get deliberately damaged.
+Throughput is reported per core: segments divided by the CPU time the checker used,
+including the ffmpeg child processes.
+
+Usage: python bench/bench_checkers.py [--corpus DIR] [--segments 50] [--size 2000000]
+"""
+import argparse
+import glob
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ChaturbateScrapeRAM as app
+import ts_checks
+from fake_hls_server import make_segment, TS_PACKET
+
+def synthetic_corpus(count, size):
+    corpus = []
+    for index in range(count):
+        data = bytearray(make_segment(index, size))
+        damage = index % 5
+        if damage == 1:
+            # Drop a packet from the middle, breaking the continuity counters.
+            del data[TS_PACKET * 40:TS_PACKET * 41]
+        elif damage == 2:
+            # Strip the PPS so slices reference a parameter set that never arrived.
+            data = bytearray(bytes(data).replace(b"\x00\x00\x00\x01\x68", b"\x00\x00\x00\x01\x0c", 1))
+        corpus.append((f"synthetic_{index:04d}.ts", bytes(data)))
+    return corpus
+
+def folder_corpus(folder):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(folder, "*.ts"))):
+        with open(path, "rb") as f:
+            corpus.append((os.path.basename(path), f.read()))
+    return corpus
+
+def cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def run_checker(name, check, corpus):
+    wall = time.perf_counter()
+    cpu = cpu_time()
+    failed = sum(1 for index, (_, data) in enumerate(corpus) if not check(index, data))
+    wall = time.perf_counter() - wall
+    cpu = cpu_time() - cpu
+    per_core = len(corpus) / cpu if cpu > 0 else float("inf")
+    print(f"{name:<8} {len(corpus):>8} {failed:>8} {len(corpus) / wall:>10.1f} {per_core:>12.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="folder of .ts segments to check instead of synthetic ones")
+    parser.add_argument("--segments", type=int, default=50)
+    parser.add_argument("--size", type=int, default=2000000, help="bytes per synthetic segment")
+    args = parser.parse_args()
+
+    corpus = folder_corpus(args.corpus) if args.corpus else synthetic_corpus(args.segments, args.size)
+    if not corpus:
+        sys.exit("No segments found")
+    megabytes = sum(len(data) for _, data in corpus) / 1024 / 1024
+    print(f"[*] {len(corpus)} segments, {megabytes:.1f} MB\n")
+    print(f"{'checker':<8} {'segments':>8} {'failed':>8} {'seg/s':>10} {'seg/s/core':>12}")
+
+    run_checker("fast", lambda index, data: not ts_checks.inspect_ts(data), corpus)
+
+    if shutil.which("ffmpeg"):
+        run_checker("ffmpeg", lambda index, data: ts_checks.check_ts_ffmpeg("bench", index, data, app.TEMP_SEGMENT_DIR), corpus)
+    else:
+        print("ffmpeg   skipped, ffmpeg not found on PATH")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Compare the old room page parse (whole page + regex + unicode_escape + json.loads) with DossierScanner.
+
+Runs on saved room pages (--pages folder of .html files, e.g. saved with your browser or curl)
+or on synthetic pages shaped like a real one: a few hundred KB of markup and scripts with the
+escaped initialRoomDossier somewhere in the middle. The scanner is fed PAGE_CHUNK pieces like
+it is from the network, so "KB read" is how much of the page it needed before it could stop.
+
+Usage: python bench/bench_dossier.py [--pages DIR] [--repeat 200]
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ChaturbateScrapeRAM as app
+
+def synthetic_page(index, size=350000, dossier_at=0.4):
+    rng = random.Random(index)
+    dossier = {f"field_{n}": "x" * rng.randint(5, 80) for n in range(60)}
+    dossier.update({
+        "room_status": "public",
+        "broadcaster_username": f"room{index}",
+        "hls_source": f"https://edge{index % 20}-fra.live.mmcdn.com/live-hls/amlst:room{index}-sd-{rng.getrandbits(64):x}/playlist.m3u8",
+        "num_viewers": rng.randint(0, 5000),
+    })
+    for n in range(60, 120):
+        dossier[f"field_{n}"] = "y" * rng.randint(5, 80)
+    # The page escapes quotes and slashes inside the JS string.
+    escaped = json.dumps(dossier).replace('"', "\\u0022").replace("/", "\\u002F")
+    script = f'<script>window.initialRoomDossier = "{escaped}";</script>'
+    filler = "".join(f'<div class="c{n}"><a href="/tag/{n}/">tag {n}</a></div>\n' for n in range(size // 40))
+    cut = int(len(filler) * dossier_at)
+    return (f"<html><head><title>room{index}</title></head><body>" + filler[:cut] + script + filler[cut:] + "</body></html>").encode("utf-8")
+
+def saved_pages(folder):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(folder, "*.htm*"))):
+        with open(path, "rb") as f:
+            pages.append(f.read())
+    return pages
+
+def old_parse(page):
+    return app.parse_hls_source(page.decode("utf-8", "replace"))
+
+def new_parse(page):
+    scanner = app.DossierScanner()
+    read = 0
+    for offset in range(0, len(page), app.PAGE_CHUNK):
+        chunk = page[offset:offset + app.PAGE_CHUNK]
+        read += len(chunk)
+        if scanner.feed(chunk):
+            break
+    return scanner.result(), read
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", help="folder of saved room pages (.html)")
+    parser.add_argument("--count", type=int, default=20, help="synthetic pages to generate")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    pages = saved_pages(args.pages) if args.pages else [synthetic_page(i) for i in range(args.count)]
+    if not pages:
+        sys.exit("No pages found")
+
+    for page in pages:
+        expected = old_parse(page)
+        found, _ = new_parse(page)
+        if found != expected:
+            sys.exit(f"Mismatch: {found!r} != {expected!r}")
+
+    total = sum(len(page) for page in pages)
+    runs = len(pages) * args.repeat
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for page in pages:
+            old_parse(page)
+    old_time = (time.perf_counter() - start) / runs
+
+    start = time.perf_counter()
+    read = 0
+    for _ in range(args.repeat):
+        for page in pages:
+            read += new_parse(page)[1]
+    new_time = (time.perf_counter() - start) / runs
+
+    print(f"[*] {len(pages)} pages, {total / len(pages) / 1024:.0f} KB on average\n")
+    print(f"{'path':<8} {'us/page':>10} {'KB read/page':>14}")
+    print(f"{'old':<8} {old_time * 1e6:>10.0f} {total / len(pages) / 1024:>14.0f}")
+    print(f"{'new':<8} {new_time * 1e6:>10.0f} {read / runs / 1024:>14.0f}")
+
+if __name__ == "__main__":
+    main()
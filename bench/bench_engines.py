@@ -0,0 +1,186 @@
+"""Compare the thread-per-stream engine against the asyncio engine on the fake HLS server.
+
+Each (engine, rooms) run happens in its own subprocess so thread count and RSS are not
+polluted by the server or by the previous run. The ffmpeg writer is swapped for a null
+writer, so this measures the download engine only.
+
+Usage: python bench/bench_engines.py [--rooms 10 100 500] [--duration 30]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def current_rss():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+class NullWriter:
+    def __init__(self, output_dir, username, journal=None):
+        self.bytes = 0
+        self.recovered_segments = 0
+
+    def write_segment(self, segment_index, segment):
+        # bytes, or a SegmentBuffer with ZERO_COPY on
+        self.bytes += getattr(segment, "length", None) or len(segment)
+
+    def note_recovered(self, segment_index):
+        self.recovered_segments += 1
+
+    def new_part(self):
+        pass
+
+    def gap_counts(self):
+        return 0, 0
+
+    def close(self, requests_made=None, keep_journal=False):
+        # Like FFmpegWriter.close: no journal, so nothing for a paused room to continue.
+        return None
+
+class BenchGUI:
+    """Stands in for DownloaderGUI, counts segment callbacks and follows downloaders being swapped."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segments = 0
+        self.downloaders = {}
+        self.retired = []
+
+    def add(self, downloader):
+        with self.lock:
+            self.downloaders[downloader.username] = downloader
+        downloader.start()
+
+    def all_downloaders(self):
+        """Current and replaced downloaders, e.g. to add up their requests."""
+        with self.lock:
+            return list(self.downloaders.values()) + self.retired
+
+    def stop_all(self):
+        with self.lock:
+            downloaders = list(self.downloaders.values())
+        for downloader in downloaders:
+            downloader.stop()
+
+    def update_status(self, username, status):
+        pass
+
+    def update_segment(self, username, segment):
+        with self.lock:
+            self.segments += 1
+
+    def update_prefetch(self, username, in_flight):
+        pass
+
+    def update_infinite(self, username, state):
+        pass
+
+    def replace_downloader(self, username, new_downloader):
+        # The prober hands a room that came online to a fresh downloader.
+        with self.lock:
+            old = self.downloaders.get(username)
+            if old is not None:
+                self.retired.append(old)
+            self.downloaders[username] = new_downloader
+        return True
+
+def run_worker(engine, rooms, duration, base_url, fetch_mode):
+    import ChaturbateScrapeRAM as app
+
+    app.ENGINE = engine
+    app.FETCH_MODE = fetch_mode
+    app.FFmpegWriter = NullWriter
+    app.get_output_folder = lambda username: os.devnull
+    app.print = lambda *args, **kwargs: None
+
+    gui = BenchGUI()
+    for i in range(rooms):
+        gui.add(app.make_downloader(f"{base_url}/room{i}/", gui, True))
+
+    # Let every room reach the live edge before measuring.
+    time.sleep(min(10, duration / 3))
+    base_segments = gui.segments
+    base_requests = sum(d.requests for d in gui.all_downloaders())
+    start = time.time()
+    peak_threads = 0
+    peak_rss = 0
+    while time.time() - start < duration:
+        peak_threads = max(peak_threads, threading.active_count())
+        peak_rss = max(peak_rss, current_rss())
+        time.sleep(0.5)
+    elapsed = time.time() - start
+    segments = gui.segments - base_segments
+    requests_made = sum(d.requests for d in gui.all_downloaders()) - base_requests
+
+    gui.stop_all()
+
+    print(json.dumps({
+        "engine": engine,
+        "fetch_mode": fetch_mode,
+        "rooms": rooms,
+        "threads": peak_threads,
+        "rss_mb": round(peak_rss / 1024 / 1024, 1),
+        "segments_per_sec": round(segments / elapsed, 2),
+        "requests_per_segment": round(requests_made / segments, 2) if segments else None,
+    }), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--engines", nargs="+", default=["thread", "asyncio"])
+    parser.add_argument("--fetch-modes", nargs="+", default=["probe"], help="probe and/or playlist")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--segment-duration", type=float, default=2.0)
+    parser.add_argument("--worker", nargs=4, metavar=("ENGINE", "FETCH_MODE", "ROOMS", "BASE_URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        engine, fetch_mode, rooms, base_url = args.worker
+        run_worker(engine, int(rooms), args.duration, base_url, fetch_mode)
+        return
+
+    from fake_hls_server import start_server
+
+    server = start_server(segment_duration=args.segment_duration)
+    expected = 1 / args.segment_duration
+    print(f"[*] Fake server on {server.base_url}, ideal rate {expected:.2f} segments/sec per room\n")
+    print(f"{'engine':<8} {'fetch':<9} {'rooms':>6} {'threads':>8} {'rss MB':>8} {'seg/s':>8} {'ideal':>8} {'req/seg':>8}")
+    try:
+        for rooms in args.rooms:
+            for engine in args.engines:
+                for fetch_mode in args.fetch_modes:
+                    result = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), "--duration", str(args.duration),
+                         "--worker", engine, fetch_mode, str(rooms), server.base_url],
+                        capture_output=True, text=True,
+                    )
+                    lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+                    if not lines:
+                        print(f"{engine:<8} {fetch_mode:<9} {rooms:>6}  failed: {result.stderr.strip().splitlines()[-1:]}")
+                        continue
+                    r = json.loads(lines[-1])
+                    print(f"{r['engine']:<8} {r['fetch_mode']:<9} {r['rooms']:>6} {r['threads']:>8} {r['rss_mb']:>8} "
+                          f"{r['segments_per_sec']:>8} {rooms * expected:>8.1f} {r['requests_per_segment']!s:>8}")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Measure how many downloader updates per second the GUI can take at a given room count.
+
+Worker threads push status/segment/prefetch updates the way downloaders do. Two paths are compared:
+    direct   the old way, every update looks the row up in tree.get_children() and calls tree.set
+    queued   updates go through GUIEvents and are applied in batches every GUI_REFRESH_INTERVAL ms
+
+Both run on the Tk thread, so the direct numbers are a best case for it (the real one called Tk
+from the worker threads). Without a display only the queue side (push + merge) is measured.
+
+Usage: python bench/bench_gui.py [--rooms 10 100 500] [--events 100000] [--threads 8]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ChaturbateScrapeRAM as app
+
+def make_event(i, rooms):
+    username = f"room{i % rooms}"
+    kind = i % 3
+    if kind == 0:
+        return username, "segment", str(i)
+    if kind == 1:
+        return username, "prefetch", f"{i % 4}/4"
+    return username, "status", "Downloading"
+
+def push_from_threads(events, rooms, total, threads):
+    """Push `total` events from `threads` threads, returns the seconds it took."""
+    per_thread = total // threads
+
+    def worker(offset):
+        for i in range(offset, offset + per_thread):
+            events.push(*make_event(i, rooms))
+
+    workers = [threading.Thread(target=worker, args=(n * per_thread,)) for n in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - start
+
+def bench_queue_only(rooms, total, threads):
+    events = app.GUIEvents()
+    push_time = push_from_threads(events, rooms, total, threads)
+    start = time.perf_counter()
+    changes = events.drain()
+    merge_time = time.perf_counter() - start
+    print(f"{rooms:>6} {'push':<8} {total / push_time:>14,.0f}")
+    print(f"{rooms:>6} {'merge':<8} {total / merge_time:>14,.0f}   ({len(changes)} rows touched)")
+
+class IdleClient:
+    """Stands in for ApiClient so the GUI's poll thread stays out of the measurement."""
+
+    def rooms(self):
+        threading.Event().wait()
+
+def bench_tk(rooms, total, threads):
+    gui = app.DownloaderGUI(IdleClient())
+    gui.window.withdraw()
+    for i in range(rooms):
+        gui.events.push(f"room{i}", "status", "Stopped")
+    gui.apply_events()
+    gui.window.update()
+
+    # direct: what update_segment and friends used to do, per event
+    start = time.perf_counter()
+    count = min(total, 20000)
+    for i in range(count):
+        username, column, value = make_event(i, rooms)
+        if username in gui.tree.get_children():
+            gui.tree.set(username, column, value)
+    gui.window.update()
+    direct = count / (time.perf_counter() - start)
+
+    # queued: threads push while the Tk loop keeps draining on its timer
+    done = threading.Event()
+    start = time.perf_counter()
+    threading.Thread(target=lambda: (push_from_threads(gui.events, rooms, total, threads), done.set()), daemon=True).start()
+    while not done.is_set() or gui.events.queue:
+        gui.window.update()
+        time.sleep(0.001)
+    gui.apply_events()
+    gui.window.update()
+    queued = total / (time.perf_counter() - start)
+    gui.window.destroy()
+    print(f"{rooms:>6} {'direct':<8} {direct:>14,.0f}")
+    print(f"{rooms:>6} {'queued':<8} {queued:>14,.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    try:
+        app.tk.Tk().destroy()
+        has_display = True
+    except app.tk.TclError:
+        has_display = False
+        print("[*] No display, measuring the event queue only\n")
+
+    print(f"{'rooms':>6} {'path':<8} {'events/sec':>14}")
+    for rooms in args.rooms:
+        if has_display:
+            bench_tk(rooms, args.events, args.threads)
+        else:
+            bench_queue_only(rooms, args.events, args.threads)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""End-to-end load test of either scraper against the fake HLS server, with faults injected.
+
+Each run starts N rooms in a fresh subprocess. "ts" is ChaturbateScrape.py, writing segment files
+into a temp folder. "thread" and "asyncio" are the two engines of ChaturbateScrapeRAM.py, with
+the muxer swapped for a null writer. The server notes when every segment was first listed and
+first served, which gives:
+    lost      segments the chunklist listed but nobody downloaded
+    lag       seconds from a segment being listed to it being downloaded (mean / p95)
+CPU time and peak memory come from the worker process.
+
+Usage: python bench/bench_load.py --rooms 50 --duration 60 --targets ts thread asyncio \\
+           --fail-429 0.02 --fail-404 0.02 --stall 0.01 --corrupt 0.01 --jump-every 90 --restart-every 120
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_engines import BenchGUI, NullWriter, current_rss
+
+def cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def run_worker(target, fetch_mode, rooms, duration, base_url):
+    # Both scripts write below the working directory (Downloads/, list files, journals).
+    os.chdir(tempfile.mkdtemp(prefix="bench_load_"))
+    if target == "ts":
+        import ChaturbateScrape as app
+        make = lambda url, gui: app.StreamDownloader(url, gui)
+    else:
+        import ChaturbateScrapeRAM as app
+        app.ENGINE = target
+        app.FFmpegWriter = NullWriter
+        make = lambda url, gui: app.make_downloader(url, gui, True)
+    app.FETCH_MODE = fetch_mode
+    app.print = lambda *args, **kwargs: None
+
+    gui = BenchGUI()
+    start_cpu = cpu_seconds()
+    start = time.time()
+    for i in range(rooms):
+        gui.add(make(f"{base_url}/room{i}/", gui))
+    peak_rss = 0
+    peak_threads = 0
+    while time.time() - start < duration:
+        peak_rss = max(peak_rss, current_rss())
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.5)
+    stopped = time.time()
+    elapsed = stopped - start
+    cpu = cpu_seconds() - start_cpu
+    downloaders = gui.all_downloaders()
+    for downloader in downloaders:
+        # ChaturbateScrape.py downloaders have no stop(), they just check the flag.
+        downloader.running = False
+    if target != "ts":
+        gui.stop_all()
+
+    print(json.dumps({
+        "stopped": stopped,
+        "segments": gui.segments,
+        "cpu_percent": round(100 * cpu / elapsed, 1),
+        "rss_mb": round(peak_rss / 1024 / 1024, 1),
+        "threads": peak_threads,
+        "requests": sum(d.requests for d in downloaders),
+    }), flush=True)
+    if target == "ts":
+        app.DISK_WRITER.close()
+    elif app.CHECK_POOL.executor is not None:
+        app.CHECK_POOL.executor.shutdown(wait=True, cancel_futures=True)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def main():
+    from fake_hls_server import add_fault_arguments, fault_options, start_server
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--targets", nargs="+", default=["ts", "thread", "asyncio"], help="ts, thread and/or asyncio")
+    parser.add_argument("--fetch-modes", nargs="+", default=["probe"], help="probe and/or playlist")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--segment-duration", type=float, default=2.0)
+    parser.add_argument("--segment-size", type=int, default=188 * 1000)
+    parser.add_argument("--worker", nargs=4, metavar=("TARGET", "FETCH_MODE", "ROOMS", "BASE_URL"), help=argparse.SUPPRESS)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    if args.worker:
+        target, fetch_mode, rooms, base_url = args.worker
+        run_worker(target, fetch_mode, int(rooms), args.duration, base_url)
+        return
+
+    server = start_server(segment_duration=args.segment_duration, segment_size=args.segment_size, **fault_options(args))
+    faults = {name: value for name, value in fault_options(args).items() if value and name != "seed"}
+    print(f"[*] Fake server on {server.base_url}, {args.rooms} rooms, faults: {faults or 'none'}\n")
+    print(f"{'target':<8} {'fetch':<9} {'listed':>7} {'lost':>6} {'lost %':>7} {'lag s':>6} {'p95 s':>6} "
+          f"{'CPU %':>6} {'RSS MB':>7} {'threads':>8} {'req/seg':>8}  injected")
+    try:
+        for target in args.targets:
+            for fetch_mode in args.fetch_modes:
+                server.start_tracking()
+                result = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--duration", str(args.duration),
+                     "--worker", target, fetch_mode, str(args.rooms), server.base_url],
+                    capture_output=True, text=True,
+                )
+                lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+                if not lines:
+                    print(f"{target:<8} {fetch_mode:<9} failed: {result.stderr.strip().splitlines()[-1:]}")
+                    continue
+                r = json.loads(lines[-1])
+                listed = lost = 0
+                lags = []
+                for i in range(args.rooms):
+                    report = server.room_report(f"room{i}", until=r["stopped"])
+                    listed += report["published"]
+                    lost += report["lost"]
+                    lags.extend(report["lags"])
+                lags.sort()
+                mean_lag = f"{sum(lags) / len(lags):.1f}" if lags else "-"
+                p95 = percentile(lags, 0.95)
+                injected = ", ".join(f"{name} {count}" for name, count in server.faults.items() if count)
+                print(f"{target:<8} {fetch_mode:<9} {listed:>7} {lost:>6} {100 * lost / listed if listed else 0:>7.1f} "
+                      f"{mean_lag:>6} {p95 if p95 is None else round(p95, 1)!s:>6} {r['cpu_percent']:>6} {r['rss_mb']:>7} "
+                      f"{r['threads']:>8} {r['requests'] / r['segments'] if r['segments'] else 0:>8.2f}  {injected or '-'}")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Compare memory use per segment with ZERO_COPY off (before) and on (after) against the fake HLS server.
+
+Each run happens in its own subprocess. Segments go through the real FFmpegWriter path,
+corruption check included, but ffmpeg is replaced by a child process that just drains stdin,
+so the numbers don't depend on ffmpeg being installed. Reported per run:
+    alloc/seg   segment-sized allocations divided by segments handled (BUFFER_POOL counters)
+    peak RSS    peak resident memory of the scraper process (check workers not included)
+    RSS/room    peak RSS divided by the number of rooms
+
+Usage: python bench/bench_memory.py [--rooms 20] [--duration 20] [--segment-size 2000000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_engines import BenchGUI
+
+SINK = "import sys\nwhile sys.stdin.buffer.read(1 << 20): pass"
+
+def run_worker(zero_copy, engine, rooms, duration, base_url):
+    import ChaturbateScrapeRAM as app
+
+    class SinkWriter(app.FFmpegWriter):
+        """FFmpegWriter with ffmpeg swapped for a process that discards its input."""
+
+        def _spawn_muxer(self, output_file):
+            return subprocess.Popen([sys.executable, "-c", SINK], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+    output_dir = tempfile.mkdtemp(prefix="bench_memory_")
+    app.ZERO_COPY = zero_copy
+    app.ENGINE = engine
+    app.FFmpegWriter = SinkWriter
+    app.get_output_folder = lambda username: output_dir
+    app.print = lambda *args, **kwargs: None
+
+    gui = BenchGUI()
+    for i in range(rooms):
+        gui.add(app.make_downloader(f"{base_url}/room{i}/", gui, True))
+    time.sleep(duration)
+    gui.stop_all()
+    time.sleep(2)
+
+    pool = app.BUFFER_POOL
+    segments = pool.segments
+    print(json.dumps({
+        "zero_copy": zero_copy,
+        "engine": engine,
+        "rooms": rooms,
+        "segments": segments,
+        "alloc_per_segment_kb": round(pool.allocated_bytes / segments / 1024, 1) if segments else None,
+        "peak_rss_mb": round(app.peak_rss() / 1024 / 1024, 1),
+        "rss_per_room_mb": round(app.peak_rss() / 1024 / 1024 / rooms, 2),
+    }), flush=True)
+    if app.CHECK_POOL.executor is not None:
+        app.CHECK_POOL.executor.shutdown(wait=True, cancel_futures=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--engines", nargs="+", default=["thread", "asyncio"])
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--segment-duration", type=float, default=2.0)
+    parser.add_argument("--segment-size", type=int, default=2000000)
+    parser.add_argument("--worker", nargs=4, metavar=("ZERO_COPY", "ENGINE", "ROOMS", "BASE_URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        zero_copy, engine, rooms, base_url = args.worker
+        run_worker(int(zero_copy), engine, int(rooms), args.duration, base_url)
+        return
+
+    from fake_hls_server import start_server
+
+    server = start_server(segment_duration=args.segment_duration, segment_size=args.segment_size)
+    print(f"[*] Fake server on {server.base_url}, {args.rooms} rooms, {args.segment_size / 1024 / 1024:.1f} MB segments\n")
+    print(f"{'engine':<8} {'run':<7} {'segments':>9} {'alloc/seg KB':>13} {'peak RSS MB':>12} {'RSS/room MB':>12}")
+    try:
+        for engine in args.engines:
+            for zero_copy in (0, 1):
+                result = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--duration", str(args.duration),
+                     "--worker", str(zero_copy), engine, str(args.rooms), server.base_url],
+                    capture_output=True, text=True,
+                )
+                label = "after" if zero_copy else "before"
+                lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+                if not lines:
+                    print(f"{engine:<8} {label:<7} failed: {result.stderr.strip().splitlines()[-1:]}")
+                    continue
+                r = json.loads(lines[-1])
+                print(f"{engine:<8} {label:<7} {r['segments']:>9} {r['alloc_per_segment_kb']!s:>13} "
+                      f"{r['peak_rss_mb']:>12} {r['rss_per_room_mb']:>12}")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Local stand-in for a Chaturbate room page + HLS CDN, used by the benchmarks.
+
+Every room is live from the moment the server starts, except the ones in `server.offline`. It serves:
+    /<room>/                              room page with window.initialRoomDossier
+    /api/chatvideocontext/<room>/         room status and hls_source as JSON
+    /hls/<room>/playlist.m3u8             master playlist listing one chunklist per VARIANTS entry
+    /hls/<room>/chunklist_w<id>_b<bw>.m3u8  rolling live window of segments
+    /hls/<room>/media_w<id>_b<bw>_<n>.ts    synthetic MPEG-TS segment, sized in proportion to <bw>
+
+Faults can be injected to see how the scrapers cope (all off by default):
+    fail_429 / fail_404     share of playlist and segment requests answered 429 / 404
+    stall / stall_seconds   share of segment responses held back before they are sent
+    corrupt                 share of segments served with a TS packet cut out
+    jump_every / jump_size  every N seconds a room's segment numbers skip ahead
+    restart_every           every N seconds a room's stream restarts at segment 0
+
+With track=True the server also notes when each segment was first listed and first served,
+which bench/bench_load.py turns into segments lost and lag behind the live edge.
+
+Run standalone with: python bench/fake_hls_server.py --port 8089 [--fail-429 0.05 --restart-every 120 ...]
+"""
+import argparse
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEGMENT_DURATION = 2.0  # seconds per segment
+LIVE_WINDOW = 5  # segments listed in the chunklist
+SEGMENT_SIZE = 188 * 1000  # ~188KB per segment
+BANDWIDTH = 2500000
+VARIANTS = [(500000, 360), (1200000, 480), (BANDWIDTH, 720)]  # (bandwidth, height), listed lowest first like the real CDN
+
+TS_PACKET = 188
+PMT_PID = 0x1000
+VIDEO_PID = 0x100
+
+def mpeg_crc32(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+            crc &= 0xFFFFFFFF
+    return crc
+
+def _psi_packet(pid, section):
+    section += struct.pack(">I", mpeg_crc32(section))
+    header = bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF, 0x10])
+    payload = b"\x00" + section
+    return header + payload + b"\xff" * (TS_PACKET - 4 - len(payload))
+
+def _pat():
+    body = struct.pack(">HBBB", 1, 0xC1, 0, 0) + struct.pack(">HH", 1, 0xE000 | PMT_PID)
+    return _psi_packet(0, bytes([0x00]) + struct.pack(">H", 0xB000 | (len(body) + 4)) + body)
+
+def _pmt():
+    streams = bytes([0x1B]) + struct.pack(">HH", 0xE000 | VIDEO_PID, 0xF000)
+    body = struct.pack(">HBBB", 1, 0xC1, 0, 0) + struct.pack(">HH", 0xE000 | VIDEO_PID, 0xF000) + streams
+    return _psi_packet(PMT_PID, bytes([0x02]) + struct.pack(">H", 0xB000 | (len(body) + 4)) + body)
+
+def _pes_packets(es, pts):
+    pts_bytes = bytes([
+        0x21 | ((pts >> 29) & 0x0E),
+        (pts >> 22) & 0xFF,
+        0x01 | ((pts >> 14) & 0xFE),
+        (pts >> 7) & 0xFF,
+        0x01 | ((pts << 1) & 0xFE),
+    ])
+    data = b"\x00\x00\x01\xe0\x00\x00\x80\x80\x05" + pts_bytes + es
+    packets = []
+    cc = 0
+    for offset in range(0, len(data), TS_PACKET - 4):
+        chunk = data[offset:offset + TS_PACKET - 4]
+        start = 0x40 if offset == 0 else 0x00
+        if len(chunk) < TS_PACKET - 4:
+            # Pad the last packet with an adaptation field so the payload stays intact.
+            stuffing = TS_PACKET - 4 - len(chunk)
+            if stuffing == 1:
+                adaptation = b"\x00"
+            else:
+                adaptation = bytes([stuffing - 1, 0x00]) + b"\xff" * (stuffing - 2)
+            header = bytes([0x47, start | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0x30 | cc])
+            packets.append(header + adaptation + chunk)
+        else:
+            header = bytes([0x47, start | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0x10 | cc])
+            packets.append(header + chunk)
+        cc = (cc + 1) & 0x0F
+    return packets
+
+def make_segment(index, size=SEGMENT_SIZE):
+    """Build a small but structurally valid H.264-in-MPEG-TS segment of roughly `size` bytes."""
+    sps = b"\x00\x00\x00\x01\x67\x64\x00\x1f\xac\xd9\x40\x50\x05\xbb\x01\x10"
+    pps = b"\x00\x00\x00\x01\x68\xeb\xe3\xcb\x22\xc0"
+    idr = b"\x00\x00\x00\x01\x65\x88\x84"
+    aud = b"\x00\x00\x00\x01\x09\xf0"
+    es_size = max(size - 3 * TS_PACKET, 256)
+    filler = (zlib.crc32(struct.pack(">I", index)).to_bytes(4, "big") * (es_size // 4 + 1))
+    es = aud + sps + pps + idr + filler[:es_size - len(aud + sps + pps + idr)].replace(b"\x00\x00", b"\x00\x01")
+    pts = int(index * SEGMENT_DURATION * 90000) & ((1 << 33) - 1)
+    return b"".join([_pat(), _pmt()] + _pes_packets(es, pts))
+
+def corrupt_segment(data):
+    """Cut one packet out of the middle, which breaks the continuity counters."""
+    middle = (len(data) // TS_PACKET // 2) * TS_PACKET
+    return data[:middle] + data[middle + TS_PACKET:]
+
+class RoomState:
+    """Where one room's stream is: segment numbering restarts and jumps happen per room."""
+
+    def __init__(self, now, started):
+        self.epoch = 0  # bumped by every restart
+        self.started = started
+        self.offset = 0  # added to segment numbers by jumps
+        self.last_restart = now
+        self.last_jump = now
+        self.first_seen = now
+        self.last_published = None
+        self.published = {}  # (epoch, index) -> time it first showed up in the chunklist
+        self.served = {}  # (epoch, index) -> time it was first served
+
+class FakeStreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, segment_duration=SEGMENT_DURATION, live_window=LIVE_WINDOW, segment_size=SEGMENT_SIZE,
+                 fail_429=0.0, fail_404=0.0, stall=0.0, stall_seconds=5.0, corrupt=0.0,
+                 jump_every=0, jump_size=5, restart_every=0, track=False, seed=None):
+        super().__init__(address, FakeStreamHandler)
+        self.segment_duration = segment_duration
+        self.live_window = live_window
+        self.segment_size = segment_size
+        self.started = time.time()
+        self.segment_cache = {}
+        self.cache_lock = threading.Lock()
+        self.requests = 0
+        self.offline = set()  # rooms that are not broadcasting
+        self.fail_429 = fail_429
+        self.fail_404 = fail_404
+        self.stall = stall
+        self.stall_seconds = stall_seconds
+        self.corrupt = corrupt
+        self.jump_every = jump_every
+        self.jump_size = jump_size
+        self.restart_every = restart_every
+        self.track = track
+        self.random = random.Random(seed)
+        self.rooms = {}
+        self.rooms_lock = threading.Lock()
+        self.faults = {"429": 0, "404": 0, "stall": 0, "corrupt": 0, "jump": 0, "restart": 0}
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections on stop is expected, not worth a traceback.
+        pass
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def room(self, name):
+        with self.rooms_lock:
+            state = self.rooms.get(name)
+            if state is None:
+                now = time.time()
+                state = self.rooms[name] = RoomState(now, self.started)
+                if self.restart_every:
+                    # Spread the restarts out instead of every room restarting at once.
+                    state.last_restart -= self.random.uniform(0, self.restart_every)
+                if self.jump_every:
+                    state.last_jump -= self.random.uniform(0, self.jump_every)
+            return state
+
+    def live_index(self, name=None):
+        """Newest segment number of a room right now, applying any restart or jump that is due."""
+        if name is None:
+            return int((time.time() - self.started) / self.segment_duration) + self.live_window
+        state = self.room(name)
+        with self.rooms_lock:
+            now = time.time()
+            live = int((now - state.started) / self.segment_duration) + self.live_window + state.offset
+            self._publish(state, live, now)
+            if self.restart_every and now - state.last_restart >= self.restart_every:
+                state.epoch += 1
+                state.started = state.last_restart = now
+                state.offset = 0
+                state.last_published = None
+                self.faults["restart"] += 1
+                live = self.live_window
+                self._publish(state, live, now)
+            elif self.jump_every and now - state.last_jump >= self.jump_every:
+                state.offset += self.jump_size
+                state.last_jump = now
+                state.last_published = live + self.jump_size - 1  # the skipped numbers never existed
+                self.faults["jump"] += 1
+                live += self.jump_size
+                self._publish(state, live, now)
+            return state.epoch, live
+
+    def _publish(self, state, live, now):
+        if state.last_published is None:
+            # A new stream lists its first window all at once.
+            state.last_published = live - self.live_window
+        if self.track:
+            for index in range(state.last_published + 1, live + 1):
+                state.published[(state.epoch, index)] = now
+        state.last_published = max(state.last_published, live)
+
+    def note_served(self, name, epoch, index):
+        if self.track:
+            state = self.room(name)
+            with self.rooms_lock:
+                state.served.setdefault((epoch, index), time.time())
+
+    def inject(self, fault, chance):
+        if chance and self.random.random() < chance:
+            self.faults[fault] += 1
+            return True
+        return False
+
+    def start_tracking(self):
+        """Forget everything tracked so far and keep the chunklists of all known rooms moving."""
+        with self.rooms_lock:
+            self.rooms.clear()
+            for fault in self.faults:
+                self.faults[fault] = 0
+        self.track = True
+        if not getattr(self, "ticker", None):
+            self.ticker = threading.Thread(target=self._tick, daemon=True)
+            self.ticker.start()
+
+    def _tick(self):
+        # Publishing happens lazily on requests; this keeps publish times accurate for idle rooms too.
+        while True:
+            with self.rooms_lock:
+                names = list(self.rooms)
+            for name in names:
+                self.live_index(name)
+            time.sleep(min(self.segment_duration / 4, 0.25))
+
+    def room_report(self, name, until=None):
+        """Segments listed and served for one room since it was first seen, ignoring the last live window."""
+        state = self.room(name)
+        until = (until or time.time()) - self.live_window * self.segment_duration
+        with self.rooms_lock:
+            published = {key: t for key, t in state.published.items() if t <= until}
+            served = dict(state.served)
+        lags = sorted(served[key] - t for key, t in published.items() if key in served)
+        return {
+            "published": len(published),
+            "served": sum(1 for key in published if key in served),
+            "lost": sum(1 for key in published if key not in served),
+            "lags": lags,
+        }
+
+    def segment_bytes(self, index, bandwidth=BANDWIDTH):
+        # Payload only depends on the index and variant, so cache a handful and reuse them across rooms.
+        key = (index % 8, bandwidth)
+        with self.cache_lock:
+            data = self.segment_cache.get(key)
+            if data is None:
+                data = make_segment(index % 8, self.segment_size * bandwidth // BANDWIDTH)
+                self.segment_cache[key] = data
+        return data
+
+def variant_bandwidth(name):
+    """The _b<bandwidth> part of a chunklist or segment name, BANDWIDTH if it is not a known variant."""
+    match = re.search(r"_b(\d+)", name)
+    bandwidth = int(match.group(1)) if match else BANDWIDTH
+    return bandwidth if any(bandwidth == variant[0] for variant in VARIANTS) else BANDWIDTH
+
+class FakeStreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests += 1
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if len(parts) == 1 and parts[0]:
+            return self._room_page(parts[0])
+        if len(parts) == 3 and parts[:2] == ["api", "chatvideocontext"]:
+            return self._room_context(parts[2])
+        if len(parts) == 3 and parts[0] == "hls":
+            room, name = parts[1], parts[2]
+            if room in self.server.offline:
+                return self._send(404)
+            if self.server.inject("429", self.server.fail_429):
+                return self._send(429, headers={"Retry-After": "1"})
+            if name == "playlist.m3u8":
+                return self._master(room)
+            if name.startswith("chunklist_") and name.endswith(".m3u8"):
+                return self._chunklist(room, variant_bandwidth(name))
+            if name.startswith("media_") and name.endswith(".ts"):
+                return self._segment(room, name)
+        self._send(404)
+
+    def _room_context(self, room):
+        self._send(200, json.dumps(self._dossier(room)).encode(), "application/json")
+
+    def _dossier(self, room):
+        if room in self.server.offline:
+            return {"room_status": "offline", "hls_source": ""}
+        return {"room_status": "public", "hls_source": f"{self.server.base_url}/hls/{room}/playlist.m3u8"}
+
+    def _room_page(self, room):
+        dossier = json.dumps(self._dossier(room))
+        escaped = dossier.replace('"', "\\u0022")
+        html = f'<html><head><script>window.initialRoomDossier = "{escaped}";</script></head><body>{room}</body></html>'
+        self._send(200, html.encode("utf-8"), "text/html")
+
+    def _master(self, room):
+        body = (
+            "#EXTM3U\n"
+            "#EXT-X-VERSION:3\n"
+            + "".join(
+                f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={height * 16 // 9}x{height}\n"
+                f"chunklist_w{abs(hash(room)) % 100000}_b{bandwidth}.m3u8\n"
+                for bandwidth, height in VARIANTS
+            )
+        )
+        self._send(200, body.encode(), "application/vnd.apple.mpegurl")
+
+    def _chunklist(self, room, bandwidth):
+        epoch, live = self.server.live_index(room)
+        first = max(live - self.server.live_window + 1, 0)
+        duration = self.server.segment_duration
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{int(duration + 0.999)}",
+            f"#EXT-X-MEDIA-SEQUENCE:{first}",
+        ]
+        prefix = f"media_w{abs(hash(room)) % 100000}_b{bandwidth}_"
+        for index in range(first, live + 1):
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(f"{prefix}{index}.ts")
+        self._send(200, ("\n".join(lines) + "\n").encode(), "application/vnd.apple.mpegurl")
+
+    def _segment(self, room, name):
+        server = self.server
+        try:
+            index = int(name[:-3].rsplit("_", 1)[1])
+        except ValueError:
+            return self._send(404)
+        epoch, live = server.live_index(room)
+        if index > live or index < live - server.live_window * 4:
+            return self._send(404)
+        if server.inject("404", server.fail_404):
+            return self._send(404)
+        data = server.segment_bytes(index, variant_bandwidth(name))
+        if server.inject("corrupt", server.corrupt):
+            data = corrupt_segment(data)
+        if server.inject("stall", server.stall):
+            time.sleep(server.stall_seconds)
+        self._send(200, data, "video/mp2t")
+        server.note_served(room, epoch, index)
+
+def add_fault_arguments(parser):
+    parser.add_argument("--fail-429", type=float, default=0.0, help="share of HLS requests answered 429")
+    parser.add_argument("--fail-404", type=float, default=0.0, help="share of available segments answered 404")
+    parser.add_argument("--stall", type=float, default=0.0, help="share of segments held back for --stall-seconds")
+    parser.add_argument("--stall-seconds", type=float, default=5.0)
+    parser.add_argument("--corrupt", type=float, default=0.0, help="share of segments served with a packet missing")
+    parser.add_argument("--jump-every", type=float, default=0, help="seconds between segment number jumps per room")
+    parser.add_argument("--jump-size", type=int, default=5)
+    parser.add_argument("--restart-every", type=float, default=0, help="seconds between stream restarts per room")
+    parser.add_argument("--seed", type=int)
+
+def fault_options(args):
+    return {name: getattr(args, name) for name in (
+        "fail_429", "fail_404", "stall", "stall_seconds", "corrupt", "jump_every", "jump_size", "restart_every", "seed")}
+
+def start_server(host="127.0.0.1", port=0, **kwargs):
+    server = FakeStreamServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Chaturbate/HLS server for local benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--segment-duration", type=float, default=SEGMENT_DURATION)
+    parser.add_argument("--segment-size", type=int, default=SEGMENT_SIZE)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    server = FakeStreamServer((args.host, args.port), segment_duration=args.segment_duration, segment_size=args.segment_size,
+                              **fault_options(args))
+    print(f"[*] Fake stream server on {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,309 @@
+"""MPEG-TS and ffmpeg corruption checks shared by ChaturbateScrapeRAM.py and ChaturbateConcat.py.
+
+Kept apart from the scripts so the check processes (CheckPool workers, ChaturbateConcat.py's
+pool) only import this and not the whole GUI script with its Tk, requests and aiohttp imports.
+"""
+import os
+import re
+import subprocess
+import tempfile
+import time
+from multiprocessing import shared_memory
+
+# === ERROR PATTERNS ===
+ERROR_PATTERNS = [
+    r"non-existing PPS",
+    r"no frame!",
+    r"Invalid data found when processing input",
+    r"Decode error rate",
+    r"Could not open encoder",
+    r"Decoding error",
+    r"Task finished with error code",
+    r"Terminating thread with return code",
+    r"Cannot determine format of input",
+]
+
+IGNORED_PATTERNS = [
+    r"non monotonically increasing dts",
+    r"Nothing was written into output file",
+]
+
+def is_relevant_error(line):
+    return any(re.search(p, line) for p in ERROR_PATTERNS)
+
+def is_ignored_warning(line):
+    return any(re.search(p, line) for p in IGNORED_PATTERNS)
+
+# === MPEG-TS CHECKS ===
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+TS_NULL_PID = 0x1FFF
+H264_STREAM_TYPE = 0x1B
+H264_SLICE, H264_IDR, H264_SPS, H264_PPS = 1, 5, 7, 8
+NAL_START_CODE = re.compile(b"\x00\x00\x01")  # re searches any buffer in place, unlike memoryview
+
+def inspect_ts(ts_bytes):
+    """Check a segment in memory and return a list of problems (empty if it looks clean).
+
+    Covers packet sync, continuity counters per PID, PAT/PMT presence, PES start codes and
+    whether H.264 slices show up before any SPS/PPS (what ffmpeg reports as "non-existing PPS").
+    Works on bytes, bytearray, memoryview or shared memory without copying the segment.
+    """
+    data = memoryview(ts_bytes).cast("B")
+    size = len(data)
+    errors = []
+    if size < TS_PACKET_SIZE:
+        return ["Invalid data found when processing input: segment too short"]
+    if size % TS_PACKET_SIZE:
+        errors.append(f"Truncated packet: {size % TS_PACKET_SIZE} trailing bytes")
+    packet_count = size // TS_PACKET_SIZE
+
+    lost_sync = packet_count - data[0:packet_count * TS_PACKET_SIZE:TS_PACKET_SIZE].tobytes().count(TS_SYNC_BYTE)
+    if lost_sync:
+        errors.append(f"Lost sync on {lost_sync} of {packet_count} packets")
+
+    last_cc = {}
+    pmt_pids = set()
+    es_types = {}
+    seen_pat = seen_pmt = False
+    pes_starts = 0
+    bad_pes = 0
+    cc_errors = 0
+    transport_errors = 0
+    seen_sps = seen_pps = False
+    slice_before_pps = slice_before_sps = False
+    video_pids = set()
+
+    for offset in range(0, packet_count * TS_PACKET_SIZE, TS_PACKET_SIZE):
+        if data[offset] != TS_SYNC_BYTE:
+            continue
+        b1 = data[offset + 1]
+        pid = ((b1 & 0x1F) << 8) | data[offset + 2]
+        if pid == TS_NULL_PID:
+            continue
+        if b1 & 0x80:
+            transport_errors += 1
+        b3 = data[offset + 3]
+        afc = (b3 >> 4) & 0x03
+        cc = b3 & 0x0F
+        payload = offset + 4
+        discontinuity = False
+        if afc & 0x02:
+            af_len = data[payload]
+            if af_len:
+                discontinuity = bool(data[payload + 1] & 0x80)
+            payload += 1 + af_len
+        end = offset + TS_PACKET_SIZE
+
+        if afc & 0x01:
+            previous = last_cc.get(pid)
+            if previous is not None and not discontinuity and cc != previous and cc != (previous + 1) & 0x0F:
+                cc_errors += 1
+            last_cc[pid] = cc
+        if not afc & 0x01 or payload >= end:
+            continue
+        start = b1 & 0x40
+
+        if pid == 0:
+            if start:
+                seen_pat = True
+                pmt_pids.update(_parse_pat(data, payload, end))
+        elif pid in pmt_pids:
+            if start:
+                seen_pmt = True
+                es_types.update(_parse_pmt(data, payload, end))
+                video_pids = {p for p, t in es_types.items() if t == H264_STREAM_TYPE}
+        elif pid in es_types:
+            if start:
+                pes_starts += 1
+                if data[payload] != 0 or data[payload + 1] != 0 or data[payload + 2] != 1:
+                    bad_pes += 1
+                    continue
+                if end - payload > 9:
+                    payload += 9 + data[payload + 8]
+            if pid in video_pids:
+                match = NAL_START_CODE.search(data, payload, end)
+                while match and match.start() + 3 < end:
+                    position = match.start()
+                    nal_type = data[position + 3] & 0x1F
+                    if nal_type == H264_SPS:
+                        seen_sps = True
+                    elif nal_type == H264_PPS:
+                        seen_pps = True
+                    elif nal_type in (H264_SLICE, H264_IDR):
+                        slice_before_pps = slice_before_pps or not seen_pps
+                        slice_before_sps = slice_before_sps or not seen_sps
+                    match = NAL_START_CODE.search(data, position + 3, end)
+
+    if not seen_pat:
+        errors.append("No PAT found")
+    elif not seen_pmt:
+        errors.append("No PMT found")
+    elif not pes_starts:
+        errors.append("No PES packets found")
+    if transport_errors:
+        errors.append(f"Transport error indicator set on {transport_errors} packets")
+    if cc_errors:
+        errors.append(f"Continuity counter errors: {cc_errors}")
+    if bad_pes:
+        errors.append(f"Missing PES start code on {bad_pes} of {pes_starts} PES packets")
+    if slice_before_sps:
+        errors.append("Slice before any SPS (no frame!)")
+    if slice_before_pps:
+        errors.append("non-existing PPS referenced")
+    return errors
+
+def starts_with_keyframe(ts_bytes):
+    """True if the first video frame of a segment is an IDR frame, so a new file can start with it.
+
+    Uses the random access indicator when the packager sets it, otherwise the NAL units of
+    the first video PES packet.
+    """
+    data = memoryview(ts_bytes).cast("B")
+    packet_end = len(data) - len(data) % TS_PACKET_SIZE
+    pmt_pids = set()
+    video_pids = set()
+    video_pid = None
+    for offset in range(0, packet_end, TS_PACKET_SIZE):
+        if data[offset] != TS_SYNC_BYTE:
+            continue
+        b1 = data[offset + 1]
+        pid = ((b1 & 0x1F) << 8) | data[offset + 2]
+        afc = (data[offset + 3] >> 4) & 0x03
+        payload = offset + 4
+        random_access = False
+        if afc & 0x02:
+            af_len = data[payload]
+            if af_len:
+                random_access = bool(data[payload + 1] & 0x40)
+            payload += 1 + af_len
+        end = offset + TS_PACKET_SIZE
+        if not afc & 0x01 or payload >= end:
+            continue
+        start = b1 & 0x40
+
+        if pid == 0 and start:
+            pmt_pids.update(_parse_pat(data, payload, end))
+        elif pid in pmt_pids and start:
+            video_pids = {p for p, t in _parse_pmt(data, payload, end).items() if t == H264_STREAM_TYPE}
+        elif pid in video_pids:
+            if start:
+                if video_pid is not None:
+                    # Reached the second frame without seeing an IDR in the first.
+                    return False
+                if random_access:
+                    return True
+                video_pid = pid
+                if end - payload > 9:
+                    payload += 9 + data[payload + 8]
+            elif pid != video_pid:
+                continue
+            match = NAL_START_CODE.search(data, payload, end)
+            while match and match.start() + 3 < end:
+                nal_type = data[match.start() + 3] & 0x1F
+                if nal_type == H264_IDR:
+                    return True
+                if nal_type == H264_SLICE:
+                    return False
+                match = NAL_START_CODE.search(data, match.start() + 3, end)
+    return False
+
+def _psi_section(data, payload, end):
+    pointer = data[payload]
+    section = payload + 1 + pointer
+    if section + 3 > end:
+        return None, None
+    section_end = min(section + 3 + (((data[section + 1] & 0x0F) << 8) | data[section + 2]) - 4, end)
+    return section, section_end
+
+def _parse_pat(data, payload, end):
+    section, section_end = _psi_section(data, payload, end)
+    if section is None or data[section] != 0x00:
+        return []
+    pids = []
+    for entry in range(section + 8, section_end - 3, 4):
+        program = (data[entry] << 8) | data[entry + 1]
+        if program:
+            pids.append(((data[entry + 2] & 0x1F) << 8) | data[entry + 3])
+    return pids
+
+def _parse_pmt(data, payload, end):
+    section, section_end = _psi_section(data, payload, end)
+    if section is None or data[section] != 0x02 or section + 12 > section_end:
+        return {}
+    streams = {}
+    entry = section + 12 + (((data[section + 10] & 0x0F) << 8) | data[section + 11])
+    while entry + 5 <= section_end:
+        stream_type = data[entry]
+        pid = ((data[entry + 1] & 0x1F) << 8) | data[entry + 2]
+        streams[pid] = stream_type
+        entry += 5 + (((data[entry + 3] & 0x0F) << 8) | data[entry + 4])
+    return streams
+
+def check_shared_segment(username, segment_index, shm_name, length, mode, temp_dir):
+    """check_segment for a SegmentBuffer, attached by name inside a CheckPool worker."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        view = shm.buf[:length]
+        try:
+            return check_segment(username, segment_index, view, mode, temp_dir)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+def timed_check(check, *args):
+    """Run a check in a CheckPool worker and return (result, seconds it took there)."""
+    start = time.perf_counter()
+    result = check(*args)
+    return result, time.perf_counter() - start
+
+def check_segment(username, segment_index, ts_bytes, mode, temp_dir):
+    """Return True if the segment looks clean. Module level so pool workers can run it.
+
+    mode is "fast", "deep" or "ffmpeg" (see CORRUPTION_CHECK_MODE in the RAM script); the ffmpeg
+    decode runs on a copy written to temp_dir.
+    """
+    if mode != "ffmpeg":
+        if inspect_ts(ts_bytes):
+            return False
+        if mode == "fast":
+            return True
+    return check_ts_ffmpeg(username, segment_index, ts_bytes, temp_dir)
+
+def check_ts_ffmpeg(username, segment_index, ts_bytes, temp_dir):
+    """Decode a copy of the segment with ffmpeg. An I/O failure is not the segment's fault and counts as clean."""
+    temp_path = None
+    try:
+        temp_dir = os.path.join(temp_dir, username)
+        os.makedirs(temp_dir, exist_ok=True)
+        # A unique name: ChaturbateConcat.py's --jobs can check two sessions of one user at once,
+        # and segment indices start over with every stream.
+        with tempfile.NamedTemporaryFile(dir=temp_dir, prefix=f"temp_{segment_index:06d}_", suffix=".ts", delete=False) as temp_file:
+            temp_path = temp_file.name
+            temp_file.write(ts_bytes)
+        result = subprocess.run(
+            ["ffmpeg", "-v", "error", "-i", temp_path, "-f", "null", "-"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="replace"
+        )
+    except OSError as e:
+        print(f"[{username}] Could not run the ffmpeg check on segment {segment_index}: {e}")
+        return True
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+    errors = [
+        line for line in result.stderr.splitlines()
+        if is_relevant_error(line) and not is_ignored_warning(line)
+    ]
+    return not errors
+
+def looks_like_ts(ts_bytes):
+    """Cheap sanity check for holding segments back: at least two packets, both starting on the sync byte."""
+    return len(ts_bytes) >= 2 * TS_PACKET_SIZE and ts_bytes[0] == 0x47 and ts_bytes[TS_PACKET_SIZE] == 0x47